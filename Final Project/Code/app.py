@@ -17,6 +17,11 @@ import json
 import plotly.graph_objects as go
 import configparser
 import os
+import tempfile
+import multiprocessing
+import services
+import jobs
+import artist_search
 
 musicbrainzngs.set_useragent(app="testing MusicBrainz API", version="0")
 
@@ -33,13 +38,59 @@ else: #running locally, read in vars from config file
 START_DATE = datetime.date(2015, 1, 1)
 END_DATE = datetime.date.today()
 
-MB_EVENT_PULLER = gen.MusicBrainzPuller(app="MUMT-621 Project testing", version="0")
-SL_EVENT_PULLER = gen.SetlistPuller(api_key=SETLIST_API_KEY)
-VENUE_MAPPER = gen.VenueMapper()
-VENUE_MAPPER.load_json('venue_mapping.json')
-
-SL_ARTIST_PAGE_LIMIT = 2
-SL_VENUE_PAGE_LIMIT = 1
+# Rate limiter state, cached API responses and pulled events live in files under CACHE_DIR, so
+# that all gunicorn workers and background job processes share them
+CACHE_DIR = os.environ.get('CACHE_DIR', tempfile.gettempdir())
+# Events loaded from MusicBrainz and Setlist.fm data exports (see event_database.py), if any
+EVENT_DATABASE = os.environ.get('EVENT_DATABASE')
+SERVICE_SETTINGS = dict(cache_dir=CACHE_DIR, setlist_api_key=SETLIST_API_KEY, \
+    venue_mapping=os.path.abspath('venue_mapping.json'), \
+    event_database=os.path.abspath(EVENT_DATABASE) if EVENT_DATABASE else None)
+INDEX_MAX_AGE = 7*24*3600
+JOB_POLL_INTERVAL = 2000 # milliseconds
+
+# Job worker processes are spawned, so they import this file again (as __mp_main__) before running
+# a job. Jobs build their own services (see services.get_services), so only the web process sets
+# up the objects below
+if multiprocessing.parent_process() is None:
+    SERVICES = services.get_services(SERVICE_SETTINGS)
+    MB_EVENT_PULLER = SERVICES.mb_event_puller
+    SL_EVENT_PULLER = SERVICES.sl_event_puller
+    VENUE_MAPPER = SERVICES.venue_mapper
+    EVENT_STORE = SERVICES.event_store
+    EVENT_INDEX = SERVICES.event_index
+
+    # Artist searches are answered from the artists seen in pulled events (plus an optional list of
+    # artists, one "MBID<tab>name<tab>disambiguation" per line) when there's a close enough match
+    ARTIST_INDEX = artist_search.ArtistSearchIndex()
+    if os.environ.get('ARTIST_LIST_FILE'):
+        ARTIST_INDEX.load_artist_list(os.environ['ARTIST_LIST_FILE'])
+    ARTIST_INDEX.update_from_event_index(EVENT_INDEX)
+    ARTIST_SEARCH = artist_search.ArtistSearch(ARTIST_INDEX, rate_limiter=SERVICES.mb_rate_limiter)
+
+    # Venue events are pulled in background processes, so long pulls don't hold up a web worker. The
+    # recommendations are updated as each venue comes in and polled along with the job's progress
+    JOB_QUEUE = jobs.JobQueue(os.path.join(CACHE_DIR, 'mumt621_jobs.sqlite'), max_workers=2)
+
+    # Details of recommended artists are looked up in a thread of this process as soon as they show
+    # up in the table, so clicking on one is answered from the response cache. Artists already sent
+    # off are remembered for as long as their details stay cached (see artist_prefetched)
+    PREFETCH_QUEUE = jobs.JobQueue(JOB_QUEUE.filename, max_workers=1, processes=False)
+    PREFETCHED_ARTISTS = gen.LRUCache(maxsize=4096, ttl=SERVICES.response_cache.ttl('artist_info'))
+
+    # Query artists' events and their maps, by (MBID, date window), so repeat queries for the same
+    # artist neither pull the events nor build the figure again. Entries last as long as Setlist.fm
+    # pages stay cached, unless one of the events' venues gets mapped differently in the meantime
+    ARTIST_EVENTS_CACHE = gen.LRUCache(maxsize=128, ttl=SERVICES.response_cache.ttl('setlist'))
+
+# Setlist.fm pulls go back to START_DATE; these only cap the pages (of 20 events) spent on one seed
+SL_ARTIST_PAGE_LIMIT = 20
+SL_VENUE_PAGE_LIMIT = 5
+
+# Venue events are pulled in parallel; musicbrainzngs only lets one request through at a time anyway
+VENUE_PULL_WORKERS = 8
+MB_MAX_CONCURRENT = 1
+SL_MAX_CONCURRENT = 2
 
 REC_COLUMNS = ["Artist", "Shared Venues"]
 
@@ -66,12 +117,34 @@ def generate_table(dataframe, max_rows=10):
                         ])
         ]
 
-def generate_events_list(mbid_entry, artist_name):
-    query_events_list = []
-    return_messages = dict(card_summary = "", progress_text = "")
+def get_artist_events(mbid_entry):
+    """
+    Return the query artist's events, the pull's message, the map of the events (see
+    gen.generate_artist_events_map) and whether the events were just pulled. Events found before
+    are taken from ARTIST_EVENTS_CACHE, as long as their venues are still mapped the same way
+    """
+    key = (mbid_entry, START_DATE, END_DATE)
+    cached = ARTIST_EVENTS_CACHE.get(key)
+    if cached is not None:
+        events, message, map_out, venue_ids, fingerprint = cached
+        if VENUE_MAPPER.venue_fingerprint(venue_ids) == fingerprint:
+            return events, message, map_out, False
     events, message = gen.get_mb_and_sl_events(mbid_entry, \
                 MB_EVENT_PULLER, SL_EVENT_PULLER, VENUE_MAPPER,\
                 START_DATE, END_DATE, sl_page_limit=SL_ARTIST_PAGE_LIMIT)
+    map_out = None
+    # Nothing found may be a failed pull, so that is pulled again next time
+    if len(events) > 0:
+        map_out = gen.generate_artist_events_map(events, mbid_entry, default_map_figure)
+        venue_ids = sorted(set(venue_id for event in events for venue_id in event.venue.id.values() \
+                if venue_id is not None))
+        ARTIST_EVENTS_CACHE.put(key, (events, message, map_out, venue_ids, VENUE_MAPPER.venue_fingerprint(venue_ids)))
+    return events, message, map_out, True
+
+def generate_events_list(mbid_entry, artist_name):
+    query_events_list = []
+    return_messages = dict(card_summary = "", progress_text = "")
+    events, message, map_out, pulled = get_artist_events(mbid_entry)
 
     event_count = len(events)
     venue_count = 0
@@ -84,8 +157,16 @@ def generate_events_list(mbid_entry, artist_name):
                 venue_list.append(event.venue)
                 venue_count += 1
         query_events_list = [event.to_dict() for event in events]
-
-        map_plot_out, mappable_events, mappability_text = gen.generate_artist_events_map(events, mbid_entry, default_map_figure)
+        if pulled:
+            EVENT_INDEX.record_seed('artist', mbid_entry, gen.EventBatch.from_events(events), \
+                    START_DATE, END_DATE)
+        # Venues pulled recently are read from the event index instead of being pulled again
+        SERVICES.update_locator()
+        indexed_venue_keys, stale_events = services.split_indexed_venues(SERVICES, query_events_list, \
+                START_DATE, END_DATE, INDEX_MAX_AGE)
+        # The venue pull job looks mappings up in the shared index, not in this process's mapper
+        VENUE_MAPPER.save_new_venues()
+        map_plot_out, mappable_events, mappability_text = map_out
 
         summary_text = message + " {} events were found at {} unique venues.".format(\
                             event_count, venue_count)
@@ -95,26 +176,96 @@ def generate_events_list(mbid_entry, artist_name):
         card_text_out = html.Div([html.P(summary_text), html.Hr(), html.P(mappability_message)])
         return_messages['card_summary'] = card_text_out
 
-        # 2nd part of pull - venue events
-        events_list_out = gen.get_events_list(\
-                query_events_list, MB_EVENT_PULLER, SL_EVENT_PULLER, VENUE_MAPPER, \
-                START_DATE, END_DATE, SL_VENUE_PAGE_LIMIT)
-        if len(events_list_out) > 0:
-            return_messages['progress_text'] = "Got recommendations for {}".format(artist_name)
+        # 2nd part of pull - venue events. If every venue is fresh in the index, the recommendations
+        # are read off it; otherwise the other venues are pulled in the background so the map can
+        # show straight away
+        token = EVENT_STORE.new_token()
+        if len(stale_events) == 0:
+            count = len(services.store_indexed_venues(SERVICES, token, indexed_venue_keys, START_DATE, END_DATE))
+            recs = EVENT_INDEX.recommend(mbid_entry, START_DATE, END_DATE, \
+                    venue_keys=indexed_venue_keys).to_dict('records')
+            venue_job_out = dict(job_id=None, token=token, name=artist_name, count=count, recs=recs)
+        else:
+            job_id = JOB_QUEUE.submit(services.pull_venue_events, SERVICE_SETTINGS, mbid_entry, \
+                    stale_events, token, START_DATE, END_DATE, SL_VENUE_PAGE_LIMIT, VENUE_PULL_WORKERS, \
+                    MB_MAX_CONCURRENT, SL_MAX_CONCURRENT, INDEX_MAX_AGE, indexed_venue_keys)
+            venue_job_out = dict(job_id=job_id, token=token, name=artist_name)
     else: #no events found
         return_messages['progress_text'] = "No events found for {} between {} and {}, so no recommendations.".format(\
                     artist_name, START_DATE, END_DATE)
         map_plot_out = default_map_figure
-        events_list_out = []
+        venue_job_out = dict(job_id=None, token=None, name=artist_name)
 
-    return map_plot_out, events_list_out, return_messages
+    return map_plot_out, venue_job_out, return_messages
 
-def generate_recs_table(events_list, mbid_entry):
+def artist_prefetched(mbid):
+    """
+    Return whether the artist's details have been looked up recently or are being looked up. Artists
+    are marked with the ID of the prefetch job looking them up until it has found their details, so
+    lookups that failed are tried again
+    """
+    mark = PREFETCHED_ARTISTS.get(mbid)
+    if (mark is None) or (mark is True):
+        return mark is True
+    job = PREFETCH_QUEUE.get(mark)
+    if (job is None) or (job['status'] == 'failed'):
+        return False
+    if job['status'] == 'done':
+        if mbid in job['result']['failed']:
+            return False
+        PREFETCHED_ARTISTS.put(mbid, True)
+    return True
+
+def prefetch_artist_info(recs_table):
+    """
+    Start a background lookup of the details of the recommended artists that haven't been looked up
+    recently
+    """
+    artist_mbids = [rec['id'] for rec in recs_table if not artist_prefetched(rec['id'])]
+    if len(artist_mbids) > 0:
+        job_id = PREFETCH_QUEUE.submit(services.prefetch_artist_info, SERVICE_SETTINGS, artist_mbids)
+        for mbid in artist_mbids:
+            PREFETCHED_ARTISTS.put(mbid, job_id)
+
+def get_venue_job_status(venue_job):
+    """
+    Return events data (event store token, number of events stored so far, recommendations so far
+    and whether the pull has finished) and progress text for the venue event pull described by
+    venue_job, which has no job if everything was read from the event index
+    """
+    if venue_job['token'] is None:
+        return dict(token=None, count=0, recs=[], done=True), ""
+    if venue_job['job_id'] is None:
+        job = dict(status='done', progress=0, total=None, result=dict(count=venue_job['count'], \
+            recs=venue_job['recs']))
+    else:
+        job = JOB_QUEUE.get(venue_job['job_id'])
+    if job is None:
+        job = dict(status='failed', progress=0, total=None, result=None, error='Job not found')
+    result = job['result'] or dict(count=0, recs=[])
+    count = result['count']
+    events_data = dict(token=venue_job['token'], count=count, recs=result['recs'], \
+        done=job['status'] in ('done', 'failed'))
+    if job['status'] == 'done':
+        if count > 0:
+            progress_text = "Got recommendations for {}".format(venue_job['name'])
+        else:
+            progress_text = "No events found at {}'s venues, so no recommendations.".format(venue_job['name'])
+    elif job['status'] == 'failed':
+        progress_text = "Could not pull all venue events ({}).".format(job['error'])
+        if count > 0:
+            progress_text += " Recommendations are based on the venues pulled so far."
+    elif job['total']:
+        progress_text = "Pulled events for {} of {} venues...".format(job['progress'], job['total'])
+    else:
+        progress_text = "Pulling venue events..."
+    return events_data, progress_text
+
+def generate_recs_table(events_data, mbid_entry):
     recs_table = [{}]
-    if len(events_list) > 0:
-        events_df = pd.DataFrame(events_list)
-        recs = gen.get_basic_artist_rec_from_df(events_df, mbid_entry)
-        recs_table = recs.to_dict('records')
+    # The venue pull job ranks the artists as it goes, so the table only has to show them
+    if len(events_data['recs']) > 0:
+        recs_table = events_data['recs']
     return recs_table
 
 
@@ -131,7 +282,9 @@ secret_divs = [
     dcc.Store(id='mbid-entry-store'),
     dcc.Store(id='mbid-submission-store'),
     dcc.Store(id='init-event-pull-store'),
-    dcc.Store(id='venue-event-storage')
+    dcc.Store(id='venue-event-storage'),
+    dcc.Store(id='venue-job-store'),
+    dcc.Interval(id='venue-job-interval', interval=JOB_POLL_INTERVAL, disabled=True)
     ]
 
 # User input stuff - text box for artist name, submission button, dropdown for results
@@ -151,6 +304,7 @@ user_inputs = [
 recs_output = html.Div(id='recs-out-container',
     children=[
         dbc.Row(dbc.Spinner(html.Div(id='get-recs-spinner1'), color="primary")),
+        dbc.Row(html.Div(id='venue-job-progress')),
         dbc.Row(id='recs-table-container', 
             children = [dbc.Col(
                 children=[
@@ -218,9 +372,10 @@ app.layout = dbc.Container([
     [State('artist-input', 'value')])
 def update_artist_dropdown_options(n_clicks, artist_input_value):
     """
-    Each time user hits Submit button, use entry from text box to query MusicBrainz and populate 
-    drodpdown list with results (matching artists). Display artist name and disambiguation (when 
-    available) and store associated MBID as value for dropdown options.
+    Each time user hits Submit button, use entry from text box to search artists (locally, or on
+    MusicBrainz if there's no close match) and populate drodpdown list with results (matching
+    artists). Display artist name and disambiguation (when available) and store associated MBID as
+    value for dropdown options.
 
     Keyword arguments:
     n_clicks -- number of times Submit button has been clicked, None if never clicked
@@ -235,14 +390,15 @@ def update_artist_dropdown_options(n_clicks, artist_input_value):
         if artist_input_value == "":
             mbid_message = "Please enter an artist name"
         else:
+            # Artists pulled by the background jobs since the last search
+            ARTIST_INDEX.update_from_event_index(EVENT_INDEX)
             try:
-                result = musicbrainzngs.search_artists(artist=artist_input_value)
+                artists, num_artists = ARTIST_SEARCH.search(artist_input_value)
             except musicbrainzngs.WebServiceError as exc:
                 mbid_message = "Something went wrong with the request: %s" % exc
             else:
-                num_artists = result['artist-count']
-                for artist in result['artist-list']:
-                    if 'disambiguation' in artist.keys():
+                for artist in artists:
+                    if artist['disambiguation']:
                         artist_name = "{0} ({1})".format(artist['name'], artist['disambiguation'])
                     else:
                         artist_name = artist['name']
@@ -350,16 +506,17 @@ def toggle_rec_area_visibility(stored_mbid_entry):
 
 @app.callback(
     [Output('init-event-pull-store', 'data'), 
-    Output('get-recs-spinner1', 'children'), Output('artist-venue-map', 'figure'), Output('venue-event-storage', 'data'),
+    Output('get-recs-spinner1', 'children'), Output('artist-venue-map', 'figure'), Output('venue-job-store', 'data'),
     Output('query-events-text', 'children')],
     [Input('recs-out-container', 'style')],
     [State('mbid-submission-store', 'data'), State('init-event-pull-store', 'data'), State('artist-venue-map', 'figure'),
-    State('venue-event-storage', 'data'), State('query-events-text', 'children')]
+    State('venue-job-store', 'data'), State('venue-event-storage', 'data'), State('query-events-text', 'children')]
     )
-def update_recs_and_map(toggle, stored_mbid_entry, event_pull_entry, current_map, current_event_data, current_text):
+def update_recs_and_map(toggle, stored_mbid_entry, event_pull_entry, current_map, current_venue_job, \
+        current_event_data, current_text):
     spinner_out = ""
     map_plot_out = default_map_figure
-    events_list_out = []
+    venue_job_out = dict(job_id=None, token=None, name=None)
     summary_text = ""
 
     mbid_entry_dict = json.loads(stored_mbid_entry)
@@ -372,26 +529,45 @@ def update_recs_and_map(toggle, stored_mbid_entry, event_pull_entry, current_map
         event_entry = event_entry_dict['mbid']
 
     if mbid_entry:
-        if (mbid_entry == event_entry) and (len(current_event_data) > 0):
+        # Pull again only if the last pull for this artist finished without finding anything
+        if (mbid_entry == event_entry) and current_venue_job and current_venue_job['token'] and \
+                current_event_data and ((current_event_data['count'] > 0) or not current_event_data['done']):
             spinner_out = "Already pulled events for {}".format(artist_name)
             map_plot_out = current_map
-            events_list_out = current_event_data
+            venue_job_out = current_venue_job
             summary_text = current_text
         else:
-            map_plot_out, events_list_out, return_messages = generate_events_list(mbid_entry, artist_name)
+            map_plot_out, venue_job_out, return_messages = generate_events_list(mbid_entry, artist_name)
 
             summary_text = return_messages['card_summary']
 
             spinner_out = return_messages['progress_text']
             event_pull_entry = json.dumps(dict(mbid=mbid_entry, name=artist_name))
-    return event_pull_entry, spinner_out, map_plot_out, events_list_out, summary_text
+    return event_pull_entry, spinner_out, map_plot_out, venue_job_out, summary_text
+
+# Polls the background venue event pull until it finishes, passing on the events stored so far
+@app.callback(
+    [Output('venue-event-storage', 'data'), Output('venue-job-interval', 'disabled'),
+    Output('venue-job-progress', 'children')],
+    [Input('venue-job-store', 'data'), Input('venue-job-interval', 'n_intervals')],
+    [State('venue-event-storage', 'data')])
+def poll_venue_job(venue_job, n_intervals, current_event_data):
+    if venue_job is None:
+        raise PreventUpdate
+    else:
+        events_data, progress_text = get_venue_job_status(venue_job)
+        interval_disabled = events_data['done']
+        if events_data == current_event_data:
+            # Nothing new stored, so leave the recommendations alone
+            events_data = dash.no_update
+        return events_data, interval_disabled, progress_text
 
 @app.callback(
     [Output('recs-table', 'data'), Output('recs-table-container', 'style'), Output('recs-table-heading', 'children')],
     [Input('venue-event-storage', 'data'), Input('mbid-submission-store', 'data')],
-    [State('init-event-pull-store', 'data')])
-def display_recs_table(events_list, submit_entry, event_pull_entry):
-    if (events_list is None) or (event_pull_entry is None):
+    [State('init-event-pull-store', 'data'), State('recs-table', 'data')])
+def display_recs_table(events_data, submit_entry, event_pull_entry, current_recs_table):
+    if (events_data is None) or (event_pull_entry is None):
         raise PreventUpdate
     else:
         recs_table = [{}]
@@ -405,19 +581,25 @@ def display_recs_table(events_list, submit_entry, event_pull_entry):
         event_entry = event_entry_dict['mbid']
 
         if event_entry and (event_entry == mbid_entry):
-            recs_table = generate_recs_table(events_list, event_entry)
+            recs_table = generate_recs_table(events_data, event_entry)
             if recs_table != [{}]:
                 recs_table_heading = "Top {} Artists by Number of Shared Venues".format(len(recs_table))
+                if not events_data['done']:
+                    recs_table_heading += " (so far)"
                 toggle = TOGGLE_ON
+                prefetch_artist_info(recs_table)
+                if recs_table == current_recs_table:
+                    # Redrawing the table would clear the user's selected cell
+                    recs_table = dash.no_update
         return recs_table, toggle, recs_table_heading
 
 
 @app.callback(
     [Output('venue-events-table', 'children'), Output('venue-events-heading', 'children')],
-    [Input('artist-venue-map', 'clickData'), Input('mbid-submission-store', 'data')],
-    [State('venue-event-storage', 'data')])
-def update_venue_events_on_click(selected_data, stored_mbid_entry, events_list):
-    if (selected_data is None) or (stored_mbid_entry is None) or (events_list is None):
+    [Input('artist-venue-map', 'clickData'), Input('mbid-submission-store', 'data'),
+    Input('venue-event-storage', 'data')])
+def update_venue_events_on_click(selected_data, stored_mbid_entry, events_data):
+    if (selected_data is None) or (stored_mbid_entry is None) or (events_data is None):
         raise PreventUpdate
     else:
         events_table = []
@@ -427,22 +609,19 @@ def update_venue_events_on_click(selected_data, stored_mbid_entry, events_list):
         mbid_entry = mbid_entry_dict['mbid']
 
         if mbid_entry:
-            if len(events_list) == 0:
+            if events_data['count'] == 0:
                 raise PreventUpdate
             else:
                 chosen = [point["customdata"] for point in selected_data["points"]]
                 if len(chosen) > 0:
                     venue_name, venue_id = chosen[0]
 
-                    events_df = pd.DataFrame(events_list)
-                    events_df['venue_mbid'] = events_df['venue_mbid'].fillna('')
-                    events_df['venue_slid'] = events_df['venue_slid'].fillna('')
-                    events_df['venue_id'] = list(zip(events_df.venue_mbid, events_df.venue_slid))
-                    events_df['event_date'] = events_df['time'].apply(lambda x:str(x))
-                    events_df['link'] = list(zip(events_df.event_slurl.combine_first(events_df.event_mburl),\
-                     events_df['event_slurl'].apply(lambda x: 'Setlist.fm page' if x else 'MusicBrainz page')))
-                    events_df['Link to Event Page'] = events_df['link'].apply(lambda x: html.A(x[1], href=x[0], target='_blank'))
-                    selected = events_df[events_df['venue_id'] == tuple(venue_id)]
+                    # Rows were grouped by venue when the events were stored
+                    venue_rows = EVENT_STORE.venue_rows(events_data['token'], venue_id[0], venue_id[1])
+                    selected = pd.DataFrame(venue_rows, \
+                        columns=['event_date', 'artist_name', 'url', 'link_text'])
+                    selected['Link to Event Page'] = [html.A(text, href=url, target='_blank') \
+                        for url, text in zip(selected['url'], selected['link_text'])]
                     events_table = generate_table(selected[['event_date', 'artist_name', 'Link to Event Page']], len(selected))
                     heading_text = 'Who else played {venue} between {start_date} and {end_date}?'.format(\
                         venue=venue_name, start_date=START_DATE, end_date=END_DATE)
@@ -464,7 +643,7 @@ def clear_selected_table_cells(recs_table):
     [Output('more-info-card', 'style'), Output('rec-select-text', 'children')],
     [Input('recs-table', 'active_cell')],
     [State('mbid-submission-store', 'data'), State('venue-event-storage', 'data'), State('recs-table', 'data')])
-def display_recommended_artist_info(active_cell, stored_mbid_entry, events_list, recs_table_data):
+def display_recommended_artist_info(active_cell, stored_mbid_entry, events_data, recs_table_data):
     if (active_cell is None) or (stored_mbid_entry is None):
         raise PreventUpdate
     else:
@@ -488,7 +667,8 @@ def display_recommended_artist_info(active_cell, stored_mbid_entry, events_list,
                 card_display_out = TOGGLE_ON
 
                 if active_col_id == 'Artist':
-                    artist_info = gen.get_more_artist_info(artist_mbid)
+                    artist_info = gen.get_more_artist_info(artist_mbid, cache=SERVICES.response_cache, \
+                        rate_limiter=SERVICES.mb_rate_limiter, single_flight=SERVICES.single_flight)
                     message = []
                     if artist_info['area']:
                         message.append(html.P('Area: {}'.format(artist_info['area'])))
@@ -503,8 +683,9 @@ def display_recommended_artist_info(active_cell, stored_mbid_entry, events_list,
                     card_text_out = html.Div(message)
                     return card_display_out, card_text_out
                 else: #if active_col_id == 'Shared Venues' -- only other option
-                    relevant_events = [event for event in events_list if \
-                        event['artist_mbid'] == artist_mbid]
+                    events_df = EVENT_STORE.load(events_data['token'], columns=['artist_mbid', 'time', \
+                        'venue_slname', 'venue_mbname', 'event_slurl', 'event_mburl'])
+                    relevant_events = events_df[events_df['artist_mbid'] == artist_mbid].to_dict('records')
                     event_text = [html.A("{venue} ({date}), ".format(date=str(x['time']), venue=gen.not_none(x['venue_slname'], x['venue_mbname'])),
                         href=gen.not_none(x['event_slurl'], x['event_mburl']), target="_blank") \
                         for x in relevant_events]
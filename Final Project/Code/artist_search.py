@@ -0,0 +1,209 @@
+import array
+import csv
+import threading
+import numpy as np
+import musicbrainzngs
+
+import general_methods as gen
+from venue_matching import fold_name
+
+#####################
+
+class ArtistSearchIndex:
+  """
+  Typo-tolerant index of artist names, for searching the artists seen so far without asking
+  MusicBrainz. Each name is split into character trigrams (after fold_name, padded so the start and
+  end of each word make trigrams of their own), with a posting list of the artists containing each
+  trigram. A search only counts the postings of the query's trigrams, and scores each artist found
+  by the Dice coefficient of the two sets of trigrams, on a 0 to 100 scale (e.g. 76 for
+  "korpikaani" against "Korpiklaani"); artists seen in more events come first among equal scores
+
+  Keyword arguments:
+  n -- length of the character n-grams (default 3)
+  """
+  def __init__(self, n=3):
+    self.n = n
+    self.artists = [] # [MBID, name, disambiguation] by row
+    self.rows = {} # MBID: row
+    self.weights = array.array('d') # weight of each row's artist
+    self.gram_counts = array.array('i') # number of distinct n-grams of each row's name
+    self.postings = {} # n-gram: array of rows whose names contain it
+    self.event_rowid = 0 # last event index row added, see update_from_event_index
+    self.complete_names = set() # folded names whose artists are all in the index, see mark_complete
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.artists)
+
+  def ngrams(self, name):
+    name = ' {} '.format(fold_name(name or ''))
+    return set(name[i:i + self.n] for i in range(len(name) - self.n + 1))
+
+  def add(self, mbid, name, disambiguation=None, weight=1):
+    """
+    Add artist to the index, or fill in the disambiguation of one already there and keep the larger
+    of the weights
+
+    Keyword arguments:
+    mbid -- MBID of artist
+    name -- name of artist
+    disambiguation -- MusicBrainz comment telling artists with the same name apart (default None)
+    weight -- popularity of the artist, e.g. number of events seen, to order equal scores (default 1)
+    """
+    if (mbid is None) or (name is None):
+      return
+    grams = self.ngrams(name)
+    with self.lock:
+      row = self.rows.get(mbid)
+      if row is not None:
+        artist = self.artists[row]
+        artist[2] = gen.not_none(artist[2], disambiguation or None)
+        self.weights[row] = max(self.weights[row], weight)
+        return
+      row = self.rows[mbid] = len(self.artists)
+      self.artists.append([mbid, name, disambiguation or None])
+      self.weights.append(weight)
+      self.gram_counts.append(len(grams))
+      for gram in grams:
+        postings = self.postings.get(gram)
+        if postings is None:
+          postings = self.postings[gram] = array.array('i')
+        postings.append(row)
+
+  def mark_complete(self, name):
+    """
+    Record that every artist called name (after fold_name) is in the index, e.g. after adding all of
+    MusicBrainz's results for it
+    """
+    with self.lock:
+      self.complete_names.add(fold_name(name))
+
+  def is_complete(self, name):
+    """
+    Return whether every artist called name is known to be in the index, see mark_complete
+    """
+    with self.lock:
+      return fold_name(name) in self.complete_names
+
+  def search(self, query, limit=25, min_score=50):
+    """
+    Return list of up to limit dictionaries (keys id, name, disambiguation and score) of the artists
+    whose names are the most similar to query, if their similarity is at least min_score
+    """
+    grams = self.ngrams(query)
+    with self.lock:
+      found_grams = [gram for gram in grams if gram in self.postings]
+      if len(found_grams) == 0:
+        return []
+      # Views of the arrays only live for the expression, as arrays can't grow while they have any
+      shared = np.bincount(np.concatenate([np.frombuffer(self.postings[gram], dtype=np.intc) \
+        for gram in found_grams]))
+      rows = np.flatnonzero(shared)
+      scores = 200*shared[rows]/(len(grams) + np.frombuffer(self.gram_counts, dtype=np.intc)[rows])
+      keep = scores >= min_score
+      rows, scores = rows[keep], scores[keep]
+      weights = np.frombuffer(self.weights, dtype=np.float64)[rows]
+      order = np.lexsort((-weights, -scores))[:limit]
+      found = [self.artists[row] for row in rows[order]]
+    return [dict(id=artist[0], name=artist[1], disambiguation=artist[2], score=float(score)) \
+      for artist, score in zip(found, scores[order])]
+
+  def update_from_event_index(self, event_index):
+    """
+    Add the artists of the events added to the event index since the last update, weighted by
+    their number of events in the index
+    """
+    with self.lock:
+      after = self.event_rowid
+    with event_index.connect() as conn:
+      last = conn.execute("SELECT MAX(rowid) FROM events").fetchone()[0]
+      if (last is None) or (last <= after):
+        return
+      rows = conn.execute("""SELECT artist_mbid, MIN(artist_name), COUNT(*) FROM events
+        WHERE rowid > ? AND rowid <= ? AND artist_mbid IS NOT NULL GROUP BY artist_mbid""", \
+        (after, last)).fetchall()
+    for mbid, name, count in rows:
+      self.add(mbid, name, weight=count)
+    with self.lock:
+      self.event_rowid = max(self.event_rowid, last)
+
+  def load_artist_list(self, filename):
+    """
+    Add the artists in a tab-separated file with one artist per line: MBID, name and optionally
+    disambiguation and weight (e.g. extracted from the MusicBrainz database dump)
+    """
+    with open(filename, newline='', encoding='utf-8') as f:
+      for line in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+        if len(line) < 2:
+          continue
+        disambiguation = line[2] if len(line) > 2 else None
+        weight = int(line[3]) if (len(line) > 3) and line[3].isdigit() else 1
+        self.add(line[0], line[1], disambiguation, weight)
+
+#####################
+
+class ArtistSearch:
+  """
+  Artist search for the dropdown menu, answered from an ArtistSearchIndex when it has a confident
+  hit whose name MusicBrainz was already searched for (so that artists sharing the name, e.g. the
+  several bands called Nirvana, are in the index too), and otherwise by MusicBrainz's search, whose
+  recent results are cached and added to the index. Close local hits are added after MusicBrainz's
+  results, which covers typos that its search doesn't find anything for (e.g. "korpikaani" for
+  Korpiklaani)
+
+  Keyword arguments:
+  index -- instance of class ArtistSearchIndex
+  rate_limiter -- instance of rate_limiting.TokenBucket to take MusicBrainz searches from (default
+  None, musicbrainzngs's own limit only)
+  confident_score -- local similarity from which MusicBrainz isn't asked about names already searched
+  for (default 90)
+  min_score -- minimum local similarity to show an artist (default 50)
+  limit -- maximum number of artists to return (default 25, as MusicBrainz does)
+  cache -- instance of general_methods.LRUCache for MusicBrainz results (default None, 256
+  searches kept for an hour)
+  """
+  def __init__(self, index, rate_limiter=None, confident_score=90, min_score=50, limit=25, cache=None):
+    self.index = index
+    self.rate_limiter = rate_limiter
+    self.confident_score = confident_score
+    self.min_score = min_score
+    self.limit = limit
+    self.cache = gen.LRUCache(maxsize=256, ttl=3600) if cache is None else cache
+
+  def remote_search(self, query):
+    key = fold_name(query)
+    result = self.cache.get(key)
+    if result is None:
+      if self.rate_limiter is not None:
+        self.rate_limiter.acquire()
+      result = musicbrainzngs.search_artists(artist=query, limit=self.limit)
+      self.cache.put(key, result)
+      for artist in result['artist-list']:
+        self.index.add(artist['id'], artist['name'], artist.get('disambiguation'))
+      # Exact matches come first, so if they don't fill the results, they were all returned
+      exact = [artist for artist in result['artist-list'] if fold_name(artist['name']) == key]
+      if (len(exact) < len(result['artist-list'])) or (int(result['artist-count']) <= len(exact)):
+        self.index.mark_complete(query)
+    return result
+
+  def search(self, query):
+    """
+    Return list of dictionaries (keys id, name and disambiguation) of artists matching query and
+    the total number of matches. Raises musicbrainzngs.WebServiceError if MusicBrainz had to be
+    asked, failed and there were no local hits to fall back on
+    """
+    local = self.index.search(query, limit=self.limit, min_score=self.min_score)
+    if (len(local) > 0) and (local[0]['score'] >= self.confident_score) and \
+      self.index.is_complete(local[0]['name']):
+      return local, len(local)
+    try:
+      result = self.remote_search(query)
+    except musicbrainzngs.WebServiceError:
+      if len(local) == 0:
+        raise
+      return local, len(local)
+    artists = [dict(id=artist['id'], name=artist['name'], disambiguation=artist.get('disambiguation')) \
+      for artist in result['artist-list']]
+    seen = set(artist['id'] for artist in artists)
+    extra = [artist for artist in local if artist['id'] not in seen][:max(0, self.limit - len(artists))]
+    return artists + extra, int(result['artist-count']) + len(extra)
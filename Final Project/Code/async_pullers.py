@@ -0,0 +1,262 @@
+import asyncio
+import functools
+import httpx
+
+import general_methods as gen
+from general_methods import SetlistAPIError, SetlistNotFoundError, EventBatch
+from rate_limiting import HIGH_PRIORITY, LOW_PRIORITY, QuotaExceededError, parse_retry_after
+
+#####################
+
+async def run_blocking(func, *args, **kwargs):
+  """
+  Run func(*args, **kwargs) in a thread of the running event loop's default executor, for the
+  blocking calls (SQLite caches and indexes, file-locked rate limiters, musicbrainzngs) that would
+  otherwise hold up every other pull on the loop
+  """
+  return await asyncio.get_running_loop().run_in_executor(None, \
+    functools.partial(func, *args, **kwargs))
+
+class AsyncSetlistPuller:
+  """
+  asyncio counterpart of SetlistPuller, built on httpx.AsyncClient so that one event loop can keep
+  many pulls in flight over a shared pool of keep-alive connections. Can share its rate limiter and
+  response cache with blocking pullers. The client is tied to the event loop it is first used on,
+  so use one puller per loop and close it with aclose (or use it as an async context manager)
+
+  Keyword arguments:
+  api_key -- Setlist.fm API key
+  rate_limiter -- instance of class TokenBucket (default None)
+  cache -- instance of class ResponseCache (default None)
+  pool_size -- maximum number of open connections (default 10)
+  timeout -- seconds to wait to connect and to read (default (3.05, 30))
+  """
+  def __init__(self, api_key, rate_limiter=None, cache=None, pool_size=10, timeout=(3.05, 30)):
+    self.api_key = api_key
+    self.rate_limiter = rate_limiter
+    self.cache = cache
+    self.client = httpx.AsyncClient(headers={'Accept': 'application/json', 'x-api-key': api_key}, \
+      limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size), \
+      timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    await self.aclose()
+
+  async def aclose(self):
+    await self.client.aclose()
+
+  async def acquire(self, priority=HIGH_PRIORITY):
+    # Same bucket as the blocking pullers, but waiting doesn't block the event loop
+    if self.rate_limiter:
+      try:
+        wait = await run_blocking(self.rate_limiter.try_acquire, priority)
+        while wait > 0:
+          await asyncio.sleep(wait)
+          wait = await run_blocking(self.rate_limiter.try_acquire, priority)
+      except QuotaExceededError as err:
+        raise SetlistAPIError(str(err))
+
+  async def fetch_page(self, seed_id, seed_type, page, priority=HIGH_PRIORITY):
+    request = 'https://api.setlist.fm/rest/1.0/{0}/{1}/setlists?p={2}'.format(\
+      seed_type, seed_id, page)
+    await self.acquire(priority)
+    try:
+      results = await self.client.get(request)
+    except httpx.RequestError as err:
+      print("Setlist.fm request failed: {}".format(err))
+      return dict(code=None, message=str(err))
+    if results.status_code == 429: # too many requests, body may not be JSON
+      if self.rate_limiter:
+        await run_blocking(self.rate_limiter.backoff, parse_retry_after(results.headers.get('Retry-After')))
+      return dict(code=429)
+    try:
+      return results.json()
+    except ValueError:
+      return dict(code=results.status_code)
+
+  async def pull_page(self, seed_id, seed_type, page, priority=HIGH_PRIORITY):
+    fetch = lambda: self.fetch_page(seed_id, seed_type, page, priority=priority)
+    if self.cache:
+      json_results = await self.cache.get_or_fetch_async('setlist', seed_type, seed_id, page, fetch, \
+        is_recent=(page == 1), \
+        should_store=lambda r: ('setlist' in r) or (r.get('code') == 404))
+    else:
+      json_results = await fetch()
+    if 'code' in json_results:
+      if json_results['code'] == 404:
+        raise SetlistNotFoundError
+    return json_results
+
+  async def iter_events(self, seed_id, seed_type, start_date=None, limit=None, priority=HIGH_PRIORITY):
+    """
+    Asynchronously yield raw events of an artist or venue newest first, stopping at the first event
+    dated before start_date, see SetlistPuller.iter_events
+    """
+    steps = gen.setlist_pull_steps(start_date=start_date, limit=limit, \
+      rate_limited=self.rate_limiter is not None)
+    result = None
+    try:
+      while True:
+        try:
+          step, value = steps.send(result)
+        except StopIteration:
+          return
+        result = None
+        if step == 'page':
+          result = await self.pull_page(seed_id, seed_type, value, priority=priority)
+        elif step == 'event':
+          yield value
+        elif step == 'sleep':
+          await asyncio.sleep(value)
+        elif step == 'backoff':
+          await run_blocking(self.rate_limiter.backoff)
+        elif step == 'success':
+          await run_blocking(self.rate_limiter.success)
+    except SetlistAPIError:
+      print('Could not pull Setlist.fm events')
+      raise
+    except SetlistNotFoundError:
+      print('No Setlist.fm events found')
+
+  async def pull_events(self, seed_id, seed_type, limit=5, priority=HIGH_PRIORITY, start_date=None):
+    return [sl_event async for sl_event in self.iter_events(seed_id, seed_type, \
+      start_date=start_date, limit=limit, priority=priority)]
+
+class AsyncMusicBrainzPuller:
+  """
+  asyncio wrapper around MusicBrainzPuller. musicbrainzngs is blocking and only lets one request
+  through at a time anyway (MusicBrainz allows 1 per second), so each pull runs in a thread of the
+  event loop's default executor instead of tying up the loop. Takes the same arguments as
+  MusicBrainzPuller
+  """
+  def __init__(self, app, version, **kwargs):
+    self.puller = gen.MusicBrainzPuller(app, version, **kwargs)
+
+  async def pull_events(self, mbid, seed_type, **kwargs):
+    return await run_blocking(self.puller.pull_events, mbid, seed_type, **kwargs)
+
+class AsyncBoundedPuller:
+  """
+  Wrap an async puller so that at most max_concurrent calls to pull_events run at the same time
+  """
+  def __init__(self, puller, max_concurrent):
+    self.puller = puller
+    self.semaphore = asyncio.Semaphore(max_concurrent)
+
+  async def pull_events(self, *args, **kwargs):
+    async with self.semaphore:
+      return await self.puller.pull_events(*args, **kwargs)
+
+#####################
+
+async def pull_mb_and_sl_events(mbid, mb_event_puller, sl_event_puller, seed_type="artist", \
+  slid=None, sl_page_limit=5, start_date=None, end_date=None):
+  """
+  Same as general_methods.pull_mb_and_sl_events with async pullers, pulling from MusicBrainz and
+  Setlist.fm at the same time
+  """
+  pulled = dict(mb_events=None, sl_events=None, sl_error=False)
+  if seed_type=='artist':
+    sl_seed_id = mbid
+  else:
+    sl_seed_id = slid # only use Setlist.fm ID when pulling venue events
+
+  async def pull_mb():
+    if mbid:
+      pulled['mb_events'] = await mb_event_puller.pull_events(mbid=mbid, seed_type=seed_type, \
+        start_date=start_date, end_date=end_date)
+
+  async def pull_sl():
+    if sl_seed_id:
+      priority = LOW_PRIORITY if seed_type == 'venue' else HIGH_PRIORITY
+      try:
+        pulled['sl_events'] = await sl_event_puller.pull_events(seed_id=sl_seed_id, \
+          seed_type=seed_type, limit=sl_page_limit, priority=priority, start_date=start_date)
+      except SetlistAPIError:
+        pulled['sl_error'] = True
+        print("Issue pulling Setlist events - will use MusicBrainz only")
+
+  await asyncio.gather(pull_mb(), pull_sl())
+  return pulled
+
+async def get_mb_and_sl_events(mbid, mb_event_puller, sl_event_puller, venue_mapper, \
+  start_date, end_date, seed_type="artist", slid=None, sl_page_limit=5):
+  """
+  Same as general_methods.get_mb_and_sl_events with async pullers; return list of Event objects and
+  summary text
+
+  Keyword arguments:
+  mbid -- the MusicBrainz ID of the artist or venue for which to pull events
+  mb_event_puller -- instance of class AsyncMusicBrainzPuller
+  sl_event_puller -- instance of class AsyncSetlistPuller
+  venue_mapper -- instance of class VenueMapper
+  start_date, end_date -- range of dates for events to return (type datetime.date)
+  seed_type -- type of entity to pull events for ("artist" or "venue", default "artist")
+  slid -- Setlist.fm ID of the venue to pull events for, if seed_type is "venue" (default None)
+  sl_page_limit -- maximum number of results pages to pull from Setlist.fm, None for no cap (default 5)
+  """
+  pulled = await pull_mb_and_sl_events(mbid, mb_event_puller, sl_event_puller, \
+    seed_type=seed_type, slid=slid, sl_page_limit=sl_page_limit, \
+    start_date=start_date, end_date=end_date)
+  return await run_blocking(gen.process_pulled_events, pulled, venue_mapper, start_date, end_date, \
+    sl_page_limit=sl_page_limit)
+
+async def get_events_list(query_artist_events, mb_event_puller, sl_event_puller, venue_mapper, \
+  start_date, end_date, sl_page_limit, max_concurrent=8, mb_max_concurrent=1, sl_max_concurrent=2, \
+  as_batch=False, event_index=None, index_max_age=7*24*3600, progress=None):
+  """
+  Same as general_methods.get_events_list with async pullers: up to max_concurrent venues are
+  pulled at once on the running event loop, and the results are processed in venue order
+
+  Keyword arguments:
+  query_artist_events -- list of dictionary representations of events
+  mb_event_puller -- instance of class AsyncMusicBrainzPuller
+  sl_event_puller -- instance of class AsyncSetlistPuller
+  venue_mapper -- instance of class VenueMapper
+  start_date, end_date -- range of dates for events to return (type datetime.date)
+  sl_page_limit -- maximum number of results pages to pull from Setlist.fm for each venue, None for
+  no cap (pulls stop at start_date either way)
+  max_concurrent -- number of venues to pull at the same time (default 8)
+  mb_max_concurrent -- maximum number of MusicBrainz pulls in flight at once (default 1)
+  sl_max_concurrent -- maximum number of Setlist.fm pulls in flight at once (default 2)
+  as_batch -- return EventBatch instead of list of dictionaries (default False)
+  event_index -- instance of class EventIndex (default None, pull every venue)
+  index_max_age -- seconds after which venues in event_index are pulled again (default 1 week)
+  progress -- function called after each venue with the number of venues done, the number of
+  venues and the venue's EventBatch (default None)
+  """
+  # Mapping lookups, the event index and event processing block, so they run in the executor, one
+  # at a time and in venue order
+  seeds = await run_blocking(gen.venue_seeds, query_artist_events, venue_mapper, start_date, end_date, \
+    event_index=event_index, index_max_age=index_max_age)
+  bounded_mb_puller = AsyncBoundedPuller(mb_event_puller, mb_max_concurrent)
+  bounded_sl_puller = AsyncBoundedPuller(sl_event_puller, sl_max_concurrent)
+  semaphore = asyncio.Semaphore(max_concurrent)
+
+  async def pull_venue(venue_mbid, venue_slid):
+    async with semaphore:
+      return await pull_mb_and_sl_events(venue_mbid, bounded_mb_puller, bounded_sl_puller, \
+        seed_type="venue", slid=venue_slid, sl_page_limit=sl_page_limit, \
+        start_date=start_date, end_date=end_date)
+
+  tasks = [asyncio.ensure_future(pull_venue(venue_mbid, venue_slid)) if pull else None \
+    for venue_mbid, venue_slid, seed_key, pull in seeds]
+  all_events = EventBatch()
+  try:
+    # Collect in venue order rather than completion order to keep output deterministic
+    for i, (task, (venue_mbid, venue_slid, seed_key, pull)) in enumerate(zip(tasks, seeds)):
+      new_batch = await run_blocking(gen.venue_batch, None if task is None else await task, seed_key, \
+        venue_mapper, start_date, end_date, sl_page_limit, event_index=event_index)
+      all_events.add_batch(new_batch)
+      if progress:
+        progress(i + 1, len(seeds), new_batch)
+  finally:
+    for task in tasks:
+      if task is not None:
+        task.cancel() # no-op for finished ones
+  if as_batch:
+    return all_events
+  return all_events.to_records()
@@ -0,0 +1,84 @@
+"""
+Check that recommendations read off the event index (EventIndex.recommend) are the same as
+ArtistRecommender's on the venue events get_events_list returns, for several query artists on
+synthetic fixtures or recorded ones (see fixtures.py), with no network access. Exits with status 1
+if any differ
+
+Run from the Code folder with: python benchmarks/check_event_index.py --size 10000 --artists 20
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import general_methods as gen
+import event_index
+import fixtures as fx
+
+START_DATE = datetime.date(2015, 1, 1)
+END_DATE = datetime.date(2030, 1, 1)
+
+def compare_recommendations(fixtures, query_mbids, index, n_recs=10):
+  """
+  Index each query artist's events and its venues' events the way the app does, then return list of
+  (MBID, index recommendations, ArtistRecommender recommendations) for the artists where they differ.
+  Venues indexed for an earlier artist are read back from the index, as in the app
+
+  Keyword arguments:
+  fixtures -- instance of class fixtures.FixtureSet
+  query_mbids -- list of MBIDs of query artists
+  index -- instance of class event_index.EventIndex
+  n_recs -- number of recommended artists to compare (default 10)
+  """
+  venue_mapper = fixtures.venue_mapper()
+  mismatches = []
+  for query_mbid in query_mbids:
+    mb_puller, sl_puller = fx.ReplayMusicBrainzPuller(fixtures), fx.ReplaySetlistPuller(fixtures)
+    with contextlib.redirect_stdout(io.StringIO()): # pipeline functions print summary lines
+      query_events, _ = gen.get_mb_and_sl_events(query_mbid, mb_puller, sl_puller, venue_mapper, \
+        START_DATE, END_DATE, sl_page_limit=20)
+      index.record_seed('artist', query_mbid, gen.EventBatch.from_events(query_events), START_DATE, END_DATE)
+      query_events_list = [event.to_dict() for event in query_events]
+      venue_keys = [gen.venue_key_string(*key) for key in gen.get_venue_keys(query_events_list, venue_mapper)]
+      venue_events = gen.get_events_list(query_events_list, mb_puller, sl_puller, venue_mapper, \
+        START_DATE, END_DATE, 5, as_batch=True, event_index=index)
+    expected = gen.ArtistRecommender(venue_events.to_dataframe()).recommend(query_mbid, n_recs=n_recs)
+    found = index.recommend(query_mbid, START_DATE, END_DATE, n_recs=n_recs, venue_keys=venue_keys)
+    expected_rows = list(zip(expected['id'], expected['Shared Venues']))
+    found_rows = list(zip(found['id'], found['Shared Venues']))
+    if found_rows != expected_rows:
+      mismatches.append((query_mbid, found_rows, expected_rows))
+  return mismatches
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare event index recommendations with ArtistRecommender')
+  parser.add_argument('--size', type=int, default=10000, help='number of synthetic events')
+  parser.add_argument('--artists', type=int, default=20, help='number of synthetic query artists')
+  parser.add_argument('--fixtures', help='folder of recorded fixtures to use instead')
+  parser.add_argument('--artist', nargs='+', help='query artist MBIDs for recorded fixtures')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  if args.fixtures:
+    if not args.artist:
+      parser.error('--artist is needed with --fixtures')
+    fixtures, query_mbids = fx.FixtureSet.load(args.fixtures), args.artist
+  else:
+    fixtures = fx.make_synthetic_fixtures(args.size, seed=args.seed)
+    query_mbids = ['artist-{}'.format(i) for i in range(args.artists)]
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    index = event_index.EventIndex(os.path.join(tmp_dir, 'event_index.sqlite'))
+    mismatches = compare_recommendations(fixtures, query_mbids, index)
+  for query_mbid, found_rows, expected_rows in mismatches:
+    print("Different recommendations for {}:\n  index:       {}\n  recommender: {}".format(query_mbid, \
+      found_rows, expected_rows))
+  print("{} of {} query artists match".format(len(query_mbids) - len(mismatches), len(query_mbids)))
+  if mismatches:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
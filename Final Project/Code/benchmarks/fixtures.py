@@ -0,0 +1,283 @@
+"""
+Record/replay layer for the event pullers, so the recommendation pipeline can be run and timed
+without the network. RecordingPuller wraps a real MusicBrainzPuller or SetlistPuller and keeps every
+seed's raw events in a FixtureSet, which saves them to a folder; ReplayMusicBrainzPuller and
+ReplaySetlistPuller serve them back in place of the real pullers. Synthetic fixtures of any size
+come from make_synthetic_fixtures
+
+Record fixtures from the Code folder with: python benchmarks/fixtures.py OUT_DIR MBID [MBID ...]
+"""
+import argparse
+import configparser
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import general_methods as gen
+
+SOURCES = ('musicbrainz', 'setlist')
+SETLIST_PAGE_SIZE = 20
+
+class FixtureSet:
+  """
+  Raw events of each seed pulled from each source, in the order the puller returned them, plus the
+  venue mappings the pipeline should start from
+
+  Keyword arguments:
+  seeds -- dictionary of source: {(seed_type, seed_id): list of raw events} (default empty)
+  venues -- list of dictionary representations of mapped venues (default empty)
+  """
+  def __init__(self, seeds=None, venues=None):
+    self.seeds = dict((source, {}) for source in SOURCES) if seeds is None else seeds
+    self.venues = [] if venues is None else venues
+    self.lock = threading.Lock()
+
+  def add(self, source, seed_type, seed_id, events):
+    # Pulls of the same seed over different dates add up; events are kept in first-seen order
+    with self.lock:
+      stored = self.seeds[source].setdefault((seed_type, str(seed_id)), [])
+      seen = set(event['id'] for event in stored)
+      stored += [event for event in events if event['id'] not in seen]
+
+  def get(self, source, seed_type, seed_id):
+    return self.seeds[source].get((seed_type, str(seed_id)), [])
+
+  def n_events(self):
+    return dict((source, len(set(event['id'] for events in self.seeds[source].values() \
+      for event in events))) for source in SOURCES)
+
+  def venue_mapper(self):
+    """
+    Return new VenueMapper with the fixture's venue mappings
+    """
+    venue_mapper = gen.VenueMapper()
+    for venue_dict in self.venues:
+      venue = gen.Venue(json.loads(json.dumps(venue_dict))) # each mapper gets its own copy
+      venue.coords = tuple(venue.coords)
+      venue.city['coords'] = tuple(venue.city['coords'])
+      for venue_id in (venue.id['mbid'], venue.id['slid']):
+        venue_mapper.add_venue(venue_id, venue)
+    return venue_mapper
+
+  def save(self, folder):
+    """
+    Write one JSON line per seed to musicbrainz.jsonl and setlist.jsonl, and the venues to
+    venues.json, in folder
+    """
+    os.makedirs(folder, exist_ok=True)
+    for source in SOURCES:
+      with open(os.path.join(folder, source + '.jsonl'), 'w') as f:
+        for (seed_type, seed_id), events in sorted(self.seeds[source].items()):
+          f.write(json.dumps(dict(seed_type=seed_type, seed_id=seed_id, events=events)) + '\n')
+    with open(os.path.join(folder, 'venues.json'), 'w') as f:
+      json.dump(self.venues, f)
+
+  @classmethod
+  def load(cls, folder):
+    fixtures = cls()
+    for source in SOURCES:
+      filename = os.path.join(folder, source + '.jsonl')
+      if os.path.exists(filename):
+        with open(filename) as f:
+          for line in f:
+            seed = json.loads(line)
+            fixtures.seeds[source][(seed['seed_type'], seed['seed_id'])] = seed['events']
+    filename = os.path.join(folder, 'venues.json')
+    if os.path.exists(filename):
+      with open(filename) as f:
+        fixtures.venues = json.load(f)
+    return fixtures
+
+#####################
+
+class RecordingPuller:
+  """
+  Wrap a MusicBrainzPuller or SetlistPuller, adding the raw events of every pull to fixtures
+
+  Keyword arguments:
+  puller -- puller to record
+  fixtures -- instance of class FixtureSet
+  source -- "musicbrainz" or "setlist"
+  """
+  def __init__(self, puller, fixtures, source):
+    self.puller = puller
+    self.fixtures = fixtures
+    self.source = source
+
+  def pull_events(self, *args, **kwargs):
+    events = self.puller.pull_events(*args, **kwargs)
+    seed_id = args[0] if len(args) > 0 else kwargs.get('mbid', kwargs.get('seed_id'))
+    seed_type = args[1] if len(args) > 1 else kwargs['seed_type']
+    self.fixtures.add(self.source, seed_type, seed_id, events)
+    return events
+
+class ReplayMusicBrainzPuller:
+  """
+  Stand-in for MusicBrainzPuller serving the raw events in fixtures, limited to the requested dates
+  as pull_events_between does (undated events only without dates)
+
+  Keyword arguments:
+  fixtures -- instance of class FixtureSet
+  latency -- seconds each pull takes, to simulate the network (default 0)
+  """
+  def __init__(self, fixtures, latency=0):
+    self.fixtures = fixtures
+    self.latency = latency
+    self.calls = 0
+
+  def pull_events(self, mbid, seed_type, limit=100, offset=0, start_date=None, end_date=None):
+    self.calls += 1
+    if self.latency:
+      time.sleep(self.latency)
+    events = self.fixtures.get('musicbrainz', seed_type, mbid)
+    if (start_date is None) and (end_date is None):
+      return list(events[offset:])
+    start_date = gen.not_none(start_date, datetime.date.min)
+    end_date = gen.not_none(end_date, datetime.date.max)
+    return [event for event in events if (gen.mb_event_date(event) is not None) and \
+      (start_date <= gen.mb_event_date(event) <= end_date)]
+
+class ReplaySetlistPuller:
+  """
+  Stand-in for SetlistPuller serving the raw events in fixtures, newest first, stopping at
+  start_date or after limit pages' worth of events
+
+  Keyword arguments:
+  fixtures -- instance of class FixtureSet
+  latency -- seconds each pull takes, to simulate the network (default 0)
+  """
+  def __init__(self, fixtures, latency=0):
+    self.fixtures = fixtures
+    self.latency = latency
+    self.calls = 0
+
+  def pull_events(self, seed_id, seed_type, limit=5, priority=gen.HIGH_PRIORITY, start_date=None):
+    self.calls += 1
+    if self.latency:
+      time.sleep(self.latency)
+    events = self.fixtures.get('setlist', seed_type, seed_id)
+    if start_date is not None:
+      events = [event for event in events if gen.sl_event_date(event) >= start_date]
+    if limit is not None:
+      events = events[:limit*SETLIST_PAGE_SIZE]
+    return list(events)
+
+#####################
+
+def make_synthetic_fixtures(n_events, n_artists=None, n_venues=None, mb_share=0.6, sl_share=0.8, \
+  mapped_share=0.7, start_date=datetime.date(2015, 1, 1), n_days=2000, seed=0):
+  """
+  Return FixtureSet of synthetic raw events in the formats the pullers return. Artists and venues
+  are drawn with Zipf-like popularity, so the first artist (MBID "artist-0") has many events at many
+  venues, as a popular query artist would. Each event is in MusicBrainz with probability mb_share
+  (with all of its artists) and in Setlist.fm with probability sl_share (one setlist per artist),
+  so many events are in both and get merged
+
+  Keyword arguments:
+  n_events -- number of concerts, each giving a MusicBrainz event and/or one setlist per artist
+  n_artists, n_venues -- number of artists and venues (default None, n_events/20 and n_events/50)
+  mb_share, sl_share -- probability of an event being in each source (default 0.6 and 0.8)
+  mapped_share -- share of venues with a mapping between their MusicBrainz place and Setlist.fm
+  venue (default 0.7)
+  start_date, n_days -- range of dates of the events (default 2000 days from 2015-01-01)
+  seed -- random seed (default 0)
+  """
+  rnd = random.Random(seed)
+  n_artists = n_artists or max(10, n_events//20)
+  n_venues = n_venues or max(5, n_events//50)
+  artist_weights = [1/(i + 1) for i in range(n_artists)]
+  venue_weights = [1/(i + 1)**0.8 for i in range(n_venues)]
+  venues = []
+  for i in range(n_venues):
+    lat, long = rnd.uniform(-60, 70), rnd.uniform(-180, 180)
+    venues.append(dict(mbid='place-{}'.format(i), slid='venue-{}'.format(i), name='Venue {}'.format(i), \
+      city='City {}'.format(i % 500), coords=(round(lat, 4), round(long, 4)), \
+      city_coords=(round(lat + rnd.uniform(-0.2, 0.2), 4), round(long + rnd.uniform(-0.2, 0.2), 4))))
+  fixtures = FixtureSet()
+  mb_seeds = fixtures.seeds['musicbrainz']
+  sl_seeds = fixtures.seeds['setlist']
+  artist_indexes = rnd.choices(range(n_artists), weights=artist_weights, k=n_events)
+  venue_indexes = rnd.choices(range(n_venues), weights=venue_weights, k=n_events)
+  for i in range(n_events):
+    event_date = start_date + datetime.timedelta(days=rnd.randrange(n_days))
+    venue = venues[venue_indexes[i]]
+    artists = [artist_indexes[i]] + rnd.sample(range(n_artists), rnd.choice([0, 0, 1, 2]))
+    artists = [('artist-{}'.format(a), 'Artist {}'.format(a)) for a in dict.fromkeys(artists)]
+    if rnd.random() < mb_share:
+      mb_event = {'id': 'mb-event-{}'.format(i), 'type': 'Concert', \
+        'life-span': {'begin': event_date.isoformat()}, \
+        'artist-relation-list': [{'type': 'main performer', 'target': mbid, \
+          'artist': {'id': mbid, 'name': name}} for mbid, name in artists], \
+        'place-relation-list': [{'type': 'held at', 'target': venue['mbid'], \
+          'place': {'id': venue['mbid'], 'name': venue['name'], 'coordinates': \
+          {'latitude': str(venue['coords'][0]), 'longitude': str(venue['coords'][1])}}}]}
+      for mbid, _ in artists:
+        mb_seeds.setdefault(('artist', mbid), []).append(mb_event)
+      mb_seeds.setdefault(('venue', venue['mbid']), []).append(mb_event)
+    if rnd.random() < sl_share:
+      for j, (mbid, name) in enumerate(artists):
+        sl_event = {'id': 'sl-event-{}-{}'.format(i, j), 'eventDate': event_date.strftime('%d-%m-%Y'), \
+          'url': 'https://www.setlist.fm/setlist/{}-{}.html'.format(i, j), \
+          'artist': {'mbid': mbid, 'name': name}, \
+          'venue': {'id': venue['slid'], 'name': venue['name'], 'city': {'name': venue['city'], \
+            'coords': {'lat': venue['city_coords'][0], 'long': venue['city_coords'][1]}}}}
+        sl_seeds.setdefault(('artist', mbid), []).append(sl_event)
+        sl_seeds.setdefault(('venue', venue['slid']), []).append(sl_event)
+  # Same orders as the APIs: MusicBrainz oldest first, Setlist.fm newest first
+  for events in mb_seeds.values():
+    events.sort(key=gen.mb_event_date)
+  for events in sl_seeds.values():
+    events.sort(key=gen.sl_event_date, reverse=True)
+  for venue in venues:
+    if rnd.random() < mapped_share:
+      fixtures.venues.append(dict(id=dict(mbid=venue['mbid'], slid=venue['slid']), \
+        name=dict(mbname=venue['name'], slname=venue['name']), \
+        city=dict(name=venue['city'], coords=venue['city_coords']), coords=venue['coords']))
+  return fixtures
+
+#####################
+
+def main():
+  parser = argparse.ArgumentParser(description='Record pulls of artists and their venues as fixtures')
+  parser.add_argument('out', help='folder to save the fixtures in')
+  parser.add_argument('mbids', nargs='+', help='MusicBrainz IDs of the query artists')
+  parser.add_argument('--start', default='2015-01-01')
+  parser.add_argument('--end', default=datetime.date.today().isoformat())
+  parser.add_argument('--venue-mapping', default='venue_mapping.json')
+  parser.add_argument('--sl-page-limit', type=int, default=5)
+  args = parser.parse_args()
+
+  config = configparser.ConfigParser()
+  config.read('.config')
+  start_date = datetime.date.fromisoformat(args.start)
+  end_date = datetime.date.fromisoformat(args.end)
+  fixtures = FixtureSet.load(args.out) if os.path.exists(args.out) else FixtureSet()
+  mb_event_puller = RecordingPuller(gen.MusicBrainzPuller(app="MUMT-621 Project benchmarks", \
+    version="0"), fixtures, 'musicbrainz')
+  sl_event_puller = RecordingPuller(gen.SetlistPuller(api_key=config['API Keys']['SETLIST_API_KEY']), \
+    fixtures, 'setlist')
+  venue_mapper = gen.VenueMapper()
+  venue_mapper.load_json(args.venue_mapping)
+  for mbid in args.mbids:
+    with contextlib.redirect_stdout(io.StringIO()):
+      events, message = gen.get_mb_and_sl_events(mbid, mb_event_puller, sl_event_puller, venue_mapper, \
+        start_date, end_date, sl_page_limit=20)
+      gen.get_events_list([event.to_dict() for event in events], mb_event_puller, sl_event_puller, \
+        venue_mapper, start_date, end_date, args.sl_page_limit)
+    print('{}: {}'.format(mbid, message))
+  # Only the venues the pulls needed, so the fixtures stay small
+  seeds = set(seed_id for source in SOURCES for seed_type, seed_id in fixtures.seeds[source])
+  fixtures.venues = [venue.to_dict() for venue_id, venue in venue_mapper.all_venues() \
+    if (venue_id == venue.id['mbid']) and ((venue.id['mbid'] in seeds) or (venue.id['slid'] in seeds))]
+  fixtures.save(args.out)
+  print('Saved {} to {}'.format(fixtures.n_events(), args.out))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,120 @@
+"""
+Time merge_event_lists on synthetic MusicBrainz/Setlist.fm event lists and check that the indexed
+merge gives the same output as the original pairwise comparison
+
+Run from the Code folder with: python benchmarks/merge_event_lists_benchmark.py
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+import contextlib
+import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import general_methods as gen
+
+def nested_merge_event_lists(events1, events2, venue_mapper):
+  # merge_event_lists as it was before indexing, kept as reference for correctness and timing
+  if len(events1) == 0:
+    return events2
+  elif len(events2) == 0:
+    return events1
+  filtered_events1 = []
+  for ev1 in events1:
+    found_dupe = False
+    for ev2 in events2:
+      if ev2.same_event(ev1):
+        found_dupe = True
+        ev2.merge_with(ev1)
+        v2_mbid = ev2.venue.id['mbid']
+        v2_slid = ev2.venue.id['slid']
+        if (not venue_mapper.has_id(v2_mbid)) or (not venue_mapper.has_id(v2_slid)):
+          venue_mapper.add_venue(ev2.venue.id['mbid'], ev2.venue)
+          venue_mapper.add_venue(ev2.venue.id['slid'], ev2.venue)
+    if not found_dupe:
+      filtered_events1.append(ev1)
+  return filtered_events1 + events2
+
+def make_event_lists(n_mb, n_sl, overlap=0.4, n_artists=2000, n_venues=300, seed=0):
+  """
+  Return (MusicBrainz-like events, Setlist.fm-like events), where roughly overlap of the Setlist.fm
+  events describe one of the MusicBrainz events
+  """
+  rnd = random.Random(seed)
+  artists = [('artist-{}'.format(i), 'Artist {}'.format(i)) for i in range(n_artists)]
+  first_day = datetime.date(2015, 1, 1)
+
+  def new_event(time, event_artists, mbid=None, slid=None, venue_index=0):
+    event = gen.Event()
+    event.id['mbid'] = mbid
+    event.id['slid'] = slid
+    event.time = time
+    for artist_mbid, artist_name in event_artists:
+      artist = gen.Artist()
+      artist.mbid = artist_mbid
+      artist.name = artist_name
+      event.artists.append(artist)
+    if mbid:
+      event.venue.id['mbid'] = 'mb-venue-{}'.format(venue_index)
+      event.url['mburl'] = 'https://musicbrainz.org/event/' + mbid
+    else:
+      event.venue.id['slid'] = 'sl-venue-{}'.format(venue_index)
+      event.url['slurl'] = 'https://www.setlist.fm/setlist/' + slid
+    return event
+
+  mb_events = []
+  for i in range(n_mb):
+    time = first_day + datetime.timedelta(days=rnd.randrange(2000))
+    mb_events.append(new_event(time, rnd.sample(artists, rnd.randint(1, 3)), \
+      mbid='mb-event-{}'.format(i), venue_index=rnd.randrange(n_venues)))
+  sl_events = []
+  for i in range(n_sl):
+    if mb_events and rnd.random() < overlap:
+      match = rnd.choice(mb_events)
+      time = match.time
+      artist = rnd.choice(match.artists).to_tuple()
+    else:
+      time = first_day + datetime.timedelta(days=rnd.randrange(2000))
+      artist = rnd.choice(artists)
+    sl_events.append(new_event(time, [artist], slid='sl-event-{}'.format(i), \
+      venue_index=rnd.randrange(n_venues)))
+  return mb_events, sl_events
+
+def run_merge(merge_function, n_mb, n_sl, seed):
+  mb_events, sl_events = make_event_lists(n_mb, n_sl, seed=seed)
+  venue_mapper = gen.VenueMapper()
+  start = time.perf_counter()
+  with contextlib.redirect_stdout(io.StringIO()): # merge_event_lists prints a summary line
+    merged = merge_function(mb_events, sl_events, venue_mapper)
+  elapsed = time.perf_counter() - start
+  output = [event.to_dict() for event in merged]
+  mapping = sorted((str(k), repr(v)) for k, v in venue_mapper.venue_mapping.items())
+  return elapsed, output, mapping
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark merge_event_lists')
+  parser.add_argument('--size', type=int, default=10000, help='events per source for the indexed merge')
+  parser.add_argument('--reference-size', type=int, default=1000, \
+    help='events per source for the comparison with the pairwise merge')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  n = args.reference_size
+  nested_time, nested_output, nested_mapping = run_merge(nested_merge_event_lists, n, n, args.seed)
+  indexed_time, indexed_output, indexed_mapping = run_merge(gen.merge_event_lists, n, n, args.seed)
+  same = (nested_output == indexed_output) and (nested_mapping == indexed_mapping)
+  print("{0}x{0} events: pairwise {1:.3f}s, indexed {2:.3f}s, same output: {3}".format(\
+    n, nested_time, indexed_time, same))
+
+  n = args.size
+  indexed_time, indexed_output, _ = run_merge(gen.merge_event_lists, n, n, args.seed)
+  print("{0}x{0} events: indexed {1:.3f}s ({2} events after merge)".format(\
+    n, indexed_time, len(indexed_output)))
+  if not same:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,152 @@
+"""
+Time each stage of the recommendation pipeline, and measure its peak memory with tracemalloc, on
+synthetic fixtures of several sizes or on recorded ones (see fixtures.py), with no network access.
+Results can be saved as JSON and compared with an earlier run to catch regressions
+
+Run from the Code folder with: python benchmarks/pipeline_benchmark.py --sizes 1000 10000 100000
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import general_methods as gen
+import fixtures as fx
+
+START_DATE = datetime.date(2015, 1, 1)
+END_DATE = datetime.date(2030, 1, 1)
+
+def measure(setup, run, memory=True):
+  """
+  Return (seconds, peak MB) of run(*setup()). The time is taken without tracing, then the peak memory
+  of a second run (on a fresh setup) with tracemalloc, which slows it down
+  """
+  args = setup()
+  with contextlib.redirect_stdout(io.StringIO()): # pipeline functions print summary lines
+    start = time.perf_counter()
+    run(*args)
+    elapsed = time.perf_counter() - start
+  peak = None
+  if memory:
+    args = setup()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+      run(*args)
+    peak = tracemalloc.get_traced_memory()[1]/1024**2
+    tracemalloc.stop()
+  return elapsed, peak
+
+def pipeline_stages(fixtures, query_mbid, max_workers=8, latency=0):
+  """
+  Return list of (stage name, setup, run) for each stage of the pipeline on fixtures, for query
+  artist query_mbid. Inputs of later stages are made once here with the stages before them
+  """
+  new_pullers = lambda: (fx.ReplayMusicBrainzPuller(fixtures, latency), fx.ReplaySetlistPuller(fixtures, latency))
+  with contextlib.redirect_stdout(io.StringIO()):
+    query_events, _ = gen.get_mb_and_sl_events(query_mbid, *new_pullers(), fixtures.venue_mapper(), \
+      START_DATE, END_DATE, sl_page_limit=20)
+    query_events_list = [event.to_dict() for event in query_events]
+    venue_events = gen.get_events_list(query_events_list, *new_pullers(), fixtures.venue_mapper(), \
+      START_DATE, END_DATE, 5, max_workers=max_workers, as_batch=True)
+    gen.generate_artist_events_map(query_events, query_mbid, None) # plotly's first figure is slow
+  venue_df = venue_events.to_dataframe()
+
+  def parse_all():
+    # Every event in the fixtures, as the two lists merge_event_lists gets
+    mb_events, sl_events = [], []
+    for source, events in (('musicbrainz', mb_events), ('setlist', sl_events)):
+      seen = set()
+      for seed_events in fixtures.seeds[source].values():
+        for raw_event in seed_events:
+          if raw_event['id'] not in seen:
+            seen.add(raw_event['id'])
+            event = gen.Event()
+            if source == 'musicbrainz':
+              event.load_from_mb_event(raw_event)
+            else:
+              event.load_from_sl_event(raw_event)
+            events.append(event)
+    return mb_events, sl_events, fixtures.venue_mapper()
+
+  return [
+    ('get_mb_and_sl_events', lambda: (query_mbid,) + new_pullers() + (fixtures.venue_mapper(),), \
+      lambda mbid, mb, sl, mapper: gen.get_mb_and_sl_events(mbid, mb, sl, mapper, START_DATE, END_DATE, \
+        sl_page_limit=20)),
+    ('merge_event_lists (all events)', parse_all, gen.merge_event_lists),
+    ('get_events_list', lambda: (query_events_list,) + new_pullers() + (fixtures.venue_mapper(),), \
+      lambda events, mb, sl, mapper: gen.get_events_list(events, mb, sl, mapper, START_DATE, END_DATE, 5, \
+        max_workers=max_workers, as_batch=True)),
+    ('get_basic_artist_rec_from_df', lambda: (venue_df.copy(), query_mbid), gen.get_basic_artist_rec_from_df),
+    ('generate_artist_events_map', lambda: (query_events, query_mbid, None), gen.generate_artist_events_map),
+  ], dict(query_events=len(query_events), venue_rows=len(venue_df))
+
+def run_benchmarks(datasets, max_workers, latency, memory):
+  results = []
+  for name, fixtures, query_mbid in datasets:
+    stages, info = pipeline_stages(fixtures, query_mbid, max_workers=max_workers, latency=latency)
+    n_events = fixtures.n_events()
+    print("{}: {} MusicBrainz and {} Setlist.fm events, {} query artist events, {} venue event rows".format(\
+      name, n_events['musicbrainz'], n_events['setlist'], info['query_events'], info['venue_rows']))
+    for stage, setup, run in stages:
+      elapsed, peak = measure(setup, run, memory=memory)
+      results.append(dict(dataset=name, stage=stage, seconds=elapsed, peak_mb=peak))
+      print("  {:<32} {:>9.3f} s {:>10}".format(stage, elapsed, \
+        '' if peak is None else '{:.1f} MB'.format(peak)))
+  return results
+
+def compare(results, baseline, tolerance):
+  """
+  Print stages that got slower than tolerance times their baseline time, return whether any did
+  """
+  baseline_times = dict(((x['dataset'], x['stage']), x['seconds']) for x in baseline)
+  slower = False
+  for result in results:
+    before = baseline_times.get((result['dataset'], result['stage']))
+    # Stages taking a few milliseconds vary too much between runs to compare
+    if (before is not None) and (result['seconds'] > max(tolerance*before, before + 0.01)):
+      print("Slower: {} on {}: {:.3f} s (was {:.3f} s)".format(result['stage'], result['dataset'], \
+        result['seconds'], before))
+      slower = True
+  return slower
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the recommendation pipeline offline')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], \
+    help='numbers of synthetic events')
+  parser.add_argument('--fixtures', help='folder of recorded fixtures to use instead')
+  parser.add_argument('--artist', help='query artist MBID for recorded fixtures')
+  parser.add_argument('--workers', type=int, default=8, help='venue pulls in parallel')
+  parser.add_argument('--latency', type=float, default=0, help='simulated seconds per pull')
+  parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc runs")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--save', help='JSON file to write the results to')
+  parser.add_argument('--compare', help='JSON file of earlier results to compare with')
+  parser.add_argument('--tolerance', type=float, default=1.5, \
+    help='slowdown over the earlier results that counts as a regression')
+  args = parser.parse_args()
+
+  if args.fixtures:
+    if not args.artist:
+      parser.error('--artist is needed with --fixtures')
+    datasets = [(os.path.basename(os.path.normpath(args.fixtures)), fx.FixtureSet.load(args.fixtures), \
+      args.artist)]
+  else:
+    datasets = [('synthetic-{}'.format(n), fx.make_synthetic_fixtures(n, seed=args.seed), 'artist-0') \
+      for n in args.sizes]
+  results = run_benchmarks(datasets, args.workers, args.latency, not args.no_memory)
+  if args.save:
+    with open(args.save, 'w') as f:
+      json.dump(results, f, indent=1)
+  if args.compare:
+    with open(args.compare) as f:
+      if compare(results, json.load(f), args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,403 @@
+import os
+import io
+import bz2
+import gzip
+import json
+import lzma
+import sqlite3
+import tarfile
+import argparse
+import datetime
+import threading
+import time
+import musicbrainzngs
+
+import general_methods as gen
+
+# Setlist.fm returns 20 setlists per page
+SETLIST_PAGE_SIZE = 20
+
+# Source-wide coverage rows (e.g. from a MusicBrainz dump, which has every seed) use this seed
+ALL_SEEDS = ('*', '*')
+
+#####################
+
+class EventDatabase:
+  """
+  Local on-disk (SQLite) database of raw MusicBrainz and Setlist.fm events, loaded in bulk from
+  data exports (see ingest_musicbrainz_dump and ingest_setlist_pages) and kept in the format the
+  pullers return, so that LocalMusicBrainzPuller and LocalSetlistPuller can serve them in place of
+  the APIs. Each event is stored once and linked to the seeds (artists and venues) whose pulls
+  would return it
+
+  Coverage records, per seed or for every seed of a source, the range of dates the stored events
+  are complete for, so that the local pullers only ask the APIs for the events past it
+
+  Keyword arguments:
+  filename -- SQLite database file
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.local = threading.local()
+    with self.connect() as conn:
+      conn.execute("""CREATE TABLE IF NOT EXISTS events (
+        source TEXT, event_id TEXT, event_date TEXT, body TEXT, PRIMARY KEY (source, event_id))""")
+      conn.execute("""CREATE TABLE IF NOT EXISTS event_seeds (
+        source TEXT, seed_type TEXT, seed_id TEXT, event_id TEXT, event_date TEXT,
+        PRIMARY KEY (source, seed_type, seed_id, event_id))""")
+      conn.execute("""CREATE INDEX IF NOT EXISTS event_seeds_date
+        ON event_seeds (source, seed_type, seed_id, event_date)""")
+      conn.execute("""CREATE TABLE IF NOT EXISTS coverage (
+        source TEXT, seed_type TEXT, seed_id TEXT, covered_from TEXT, covered_through TEXT,
+        updated_at REAL, PRIMARY KEY (source, seed_type, seed_id))""")
+
+  def connect(self):
+    # sqlite3 connections can't be shared between threads, so keep one per thread
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.filename, timeout=30)
+      conn.execute("PRAGMA journal_mode=WAL")
+      self.local.conn = conn
+    return conn
+
+  def add_events(self, source, events):
+    """
+    Store raw events (replacing any stored with the same IDs) and link each one to its seeds
+
+    Keyword arguments:
+    source -- "musicbrainz" or "setlist"
+    events -- list of raw events, in the format the source's puller returns
+    """
+    event_rows = []
+    seed_rows = []
+    for event in events:
+      event_date = event_date_string(source, event)
+      event_rows.append((source, event['id'], event_date, json.dumps(event)))
+      for seed_type, seed_id in event_seeds(source, event):
+        seed_rows.append((source, seed_type, seed_id, event['id'], event_date))
+    with self.connect() as conn:
+      conn.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?)", event_rows)
+      conn.executemany("INSERT OR REPLACE INTO event_seeds VALUES (?, ?, ?, ?, ?)", seed_rows)
+
+  def events(self, source, seed_type, seed_id, start_date=None, end_date=None):
+    """
+    Return list of the seed's stored raw events in the order the source's API returns them
+    (MusicBrainz: oldest first, undated last; Setlist.fm: newest first), limited to those dated
+    between start_date and end_date (type datetime.date) if given
+    """
+    query = """SELECT events.body FROM event_seeds JOIN events ON events.source=event_seeds.source
+      AND events.event_id=event_seeds.event_id WHERE event_seeds.source=? AND event_seeds.seed_type=?
+      AND event_seeds.seed_id=?"""
+    params = [source, seed_type, str(seed_id)]
+    if start_date is not None:
+      query += " AND event_seeds.event_date >= ?"
+      params.append(start_date.isoformat())
+    if end_date is not None:
+      query += " AND event_seeds.event_date <= ?"
+      params.append(end_date.isoformat())
+    if source == 'setlist':
+      query += " ORDER BY event_seeds.event_date DESC, event_seeds.event_id"
+    else:
+      query += " ORDER BY event_seeds.event_date IS NULL, event_seeds.event_date, event_seeds.event_id"
+    with self.connect() as conn:
+      rows = conn.execute(query, params).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+  def coverage(self, source, seed_type, seed_id):
+    """
+    Return (covered_from, covered_through) dates of the seed's stored events, from its own coverage
+    or else the source's, or None if neither is known
+    """
+    with self.connect() as conn:
+      for key in ((seed_type, str(seed_id)), ALL_SEEDS):
+        row = conn.execute("""SELECT covered_from, covered_through FROM coverage WHERE source=? AND
+          seed_type=? AND seed_id=?""", (source,) + key).fetchone()
+        if row is not None:
+          return datetime.date.fromisoformat(row[0]), datetime.date.fromisoformat(row[1])
+    return None
+
+  def set_coverage(self, source, seed_type, seed_id, covered_from, covered_through):
+    """
+    Record that the stored events of a seed (or of every seed, with seed_type and seed_id "*") are
+    complete between covered_from and covered_through (type datetime.date)
+    """
+    with self.connect() as conn:
+      conn.execute("INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?, ?)", (source, seed_type, \
+        str(seed_id), covered_from.isoformat(), covered_through.isoformat(), time.time()))
+
+  def stats(self):
+    """
+    Return dictionary with the number of stored events and of seeds of each source
+    """
+    with self.connect() as conn:
+      out = {}
+      for source, count in conn.execute("SELECT source, COUNT(*) FROM events GROUP BY source"):
+        out[source + '_events'] = count
+      for source, count in conn.execute("""SELECT source, COUNT(*) FROM (SELECT DISTINCT source,
+        seed_type, seed_id FROM event_seeds) GROUP BY source"""):
+        out[source + '_seeds'] = count
+    return out
+
+  def ingest_musicbrainz_dump(self, filename, as_of, batch_size=5000):
+    """
+    Load every event of a MusicBrainz JSON data dump, either the event dump archive
+    (event.tar.xz) or its extracted mbdump/event file (one event per line, optionally compressed).
+    Events are converted to the format musicbrainzngs returns (see mb_dump_event), and every seed is
+    marked as complete through as_of, the date of the dump. Return number of events loaded
+
+    Keyword arguments:
+    filename -- dump file
+    as_of -- date the dump was made (type datetime.date)
+    batch_size -- number of events written per transaction (default 5000)
+    """
+    count = 0
+    batch = []
+    for line in dump_lines(filename):
+      line = line.strip()
+      if line:
+        batch.append(mb_dump_event(json.loads(line)))
+      if len(batch) >= batch_size:
+        self.add_events('musicbrainz', batch)
+        count += len(batch)
+        batch = []
+    self.add_events('musicbrainz', batch)
+    count += len(batch)
+    self.set_coverage('musicbrainz', *ALL_SEEDS, datetime.date.min, as_of)
+    return count
+
+  def ingest_setlist_pages(self, filenames, seed_type, as_of=None):
+    """
+    Load archived Setlist.fm search results pages, each a JSON file as returned by the API for an
+    artist's or a venue's setlists (or a plain list of setlists). The seed of each page is the
+    artist or venue all of its setlists share. A seed is marked as complete from the oldest of its
+    archived events through the date of its newest page file (or as_of), or from the start if all of
+    the seed's pages (by the total the API gave) were archived. Return number of setlists loaded
+
+    Keyword arguments:
+    filenames -- list of page files or folders of them
+    seed_type -- "artist" or "venue", what the pages were pulled for
+    as_of -- date the pages were pulled (type datetime.date, default None, the files' modification
+    dates)
+    """
+    seeds = {} # seed ID: dictionary of setlist IDs, oldest date, total and archive date
+    count = 0
+    for filename in page_files(filenames):
+      with open(filename, encoding='utf-8') as f:
+        page = json.load(f)
+      setlists = page if isinstance(page, list) else page.get('setlist', [])
+      self.add_events('setlist', setlists)
+      count += len(setlists)
+      seed_ids = set(sl_seed_id(seed_type, sl_event) for sl_event in setlists)
+      if (len(seed_ids) != 1) or (None in seed_ids):
+        continue # not one seed's page, so it says nothing about any seed's coverage
+      seed = seeds.setdefault(seed_ids.pop(), dict(ids=set(), oldest=datetime.date.max, total=None, \
+        pulled=datetime.date.min))
+      seed['ids'].update(sl_event['id'] for sl_event in setlists)
+      seed['oldest'] = min([seed['oldest']] + [gen.sl_event_date(sl_event) for sl_event in setlists])
+      if isinstance(page, dict) and ('total' in page):
+        seed['total'] = page['total']
+      pulled = as_of if as_of is not None else \
+        datetime.date.fromtimestamp(os.path.getmtime(filename))
+      seed['pulled'] = max(seed['pulled'], pulled)
+    for seed_id, seed in seeds.items():
+      complete = (seed['total'] is not None) and (len(seed['ids']) >= seed['total'])
+      self.set_coverage('setlist', seed_type, seed_id, datetime.date.min if complete else seed['oldest'], \
+        seed['pulled'])
+    return count
+
+#####################
+
+def event_date_string(source, event):
+  # ISO date of a raw event, None if it has none
+  event_date = gen.sl_event_date(event) if source == 'setlist' else gen.mb_event_date(event)
+  return None if event_date is None else event_date.isoformat()
+
+def event_seeds(source, event):
+  """
+  Return list of (seed_type, seed_id) of the seeds whose pulls return a raw event: for MusicBrainz,
+  every related artist and place; for Setlist.fm, the setlist's artist and venue
+  """
+  if source == 'setlist':
+    return [(seed_type, sl_seed_id(seed_type, event)) for seed_type in ('artist', 'venue') \
+      if sl_seed_id(seed_type, event) is not None]
+  seeds = []
+  for relation_list, seed_type in (('artist-relation-list', 'artist'), ('place-relation-list', 'venue')):
+    for relation in event.get(relation_list, []):
+      target = relation.get(relation_list.split('-')[0], {})
+      if 'id' in target:
+        seeds.append((seed_type, target['id']))
+  return sorted(set(seeds))
+
+def sl_seed_id(seed_type, sl_event):
+  # Artist MBID or venue ID of a raw Setlist.fm event
+  if seed_type == 'artist':
+    return sl_event.get('artist', {}).get('mbid')
+  return sl_event.get('venue', {}).get('id')
+
+def mb_dump_event(entity):
+  """
+  Return event from a MusicBrainz JSON dump, which uses the web service's JSON format, converted to
+  the format musicbrainzngs returns from its XML: relations grouped into lists by target type (e.g.
+  "place-relation-list"), with the target's ID under "target" and the target itself under its type,
+  and coordinates as strings
+  """
+  mb_event = {key: value for key, value in entity.items() if key != 'relations'}
+  for relation in entity.get('relations', []):
+    target_type = relation.get('target-type')
+    if (target_type is None) or (target_type not in relation):
+      continue
+    target = dict(relation[target_type])
+    if target.get('coordinates'):
+      target['coordinates'] = {key: str(value) for key, value in target['coordinates'].items()}
+    else:
+      target.pop('coordinates', None)
+    converted = dict(type=relation.get('type'), target=target.get('id', target.get('resource')), \
+      direction=relation.get('direction'))
+    if relation.get('attributes'):
+      converted['attribute-list'] = relation['attributes']
+    converted[target_type] = target
+    mb_event.setdefault('{}-relation-list'.format(target_type), []).append(converted)
+  return mb_event
+
+def dump_lines(filename, member='mbdump/event'):
+  """
+  Yield lines of a MusicBrainz JSON dump file: the member of a tar archive, or a plain, gzip, bzip2
+  or xz compressed file
+  """
+  if tarfile.is_tarfile(filename):
+    with tarfile.open(filename) as tar:
+      for info in tar:
+        if info.name.endswith(member):
+          yield from io.TextIOWrapper(tar.extractfile(info), encoding='utf-8')
+          return
+    raise ValueError("No {} in {}".format(member, filename))
+  opener = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}.get(os.path.splitext(filename)[1], open)
+  with opener(filename, 'rt', encoding='utf-8') as f:
+    yield from f
+
+def page_files(filenames):
+  # JSON files among filenames, looking inside folders
+  for filename in filenames:
+    if os.path.isdir(filename):
+      for folder, _, names in sorted(os.walk(filename)):
+        for name in sorted(names):
+          if name.endswith('.json'):
+            yield os.path.join(folder, name)
+    else:
+      yield filename
+
+#####################
+
+class LocalMusicBrainzPuller:
+  """
+  Drop-in replacement for MusicBrainzPuller that serves events from an EventDatabase, only asking
+  puller (if given) for the events after the database's coverage of the seed, or for all of them if
+  it isn't covered from the start of the requested dates. A request starting after the end of the
+  coverage is pulled from the end of the coverage, so the coverage never has gaps. Events pulled are
+  added to the database and the seed's coverage moved up to the day before end_date (or today),
+  since events can still be added for the latest days
+
+  Keyword arguments:
+  database -- instance of class EventDatabase
+  puller -- instance of class MusicBrainzPuller for the rest (default None, local events only)
+  """
+  def __init__(self, database, puller=None):
+    self.database = database
+    self.puller = puller
+
+  def pull_events(self, mbid, seed_type, limit=100, offset=0, start_date=None, end_date=None):
+    start_date = gen.not_none(start_date, datetime.date.min)
+    end_date = gen.not_none(end_date, datetime.date.max)
+    coverage = self.database.coverage('musicbrainz', seed_type, mbid)
+    if (self.puller is not None) and ((coverage is None) or (coverage[1] < end_date)):
+      extends = (coverage is not None) and (coverage[0] <= start_date) # pull carries on the coverage
+      covered = extends and (start_date <= coverage[1]) # local events answer the start of the dates
+      pull_start = coverage[1] if extends else start_date
+      try:
+        pulled = self.puller.pull_events(mbid, seed_type, limit=limit, start_date=pull_start, \
+          end_date=end_date)
+      except musicbrainzngs.WebServiceError as err:
+        if not covered:
+          raise
+        print("Could not pull new MusicBrainz events, using local ones: {}".format(err))
+      else:
+        self.database.add_events('musicbrainz', pulled)
+        covered_through = max(min(end_date, datetime.date.today()) - datetime.timedelta(days=1), pull_start)
+        if (coverage is not None) and (coverage[0] <= covered_through):
+          covered_through = max(covered_through, coverage[1]) # new events reach the stored ones
+        self.database.set_coverage('musicbrainz', seed_type, mbid, \
+          coverage[0] if extends else start_date, covered_through)
+    return self.database.events('musicbrainz', seed_type, mbid, \
+      None if start_date == datetime.date.min else start_date, \
+      None if end_date == datetime.date.max else end_date)
+
+class LocalSetlistPuller:
+  """
+  Drop-in replacement for SetlistPuller that serves events from an EventDatabase, like
+  LocalMusicBrainzPuller. Setlist.fm returns the newest events first, so the pull for the events
+  after the seed's coverage stops as soon as it reaches them
+
+  Keyword arguments:
+  database -- instance of class EventDatabase
+  puller -- instance of class SetlistPuller for the rest (default None, local events only)
+  """
+  def __init__(self, database, puller=None):
+    self.database = database
+    self.puller = puller
+
+  def pull_events(self, seed_id, seed_type, limit=5, priority=gen.HIGH_PRIORITY, start_date=None):
+    start_date = gen.not_none(start_date, datetime.date.min)
+    today = datetime.date.today()
+    coverage = self.database.coverage('setlist', seed_type, seed_id)
+    if (self.puller is not None) and ((coverage is None) or (coverage[1] < today)):
+      extends = (coverage is not None) and (coverage[0] <= start_date)
+      covered = extends and (start_date <= coverage[1])
+      pull_start = coverage[1] if extends else start_date
+      try:
+        pulled = self.puller.pull_events(seed_id, seed_type, limit=limit, priority=priority, \
+          start_date=pull_start)
+      except gen.SetlistAPIError as err:
+        if not covered:
+          raise
+        print("Could not pull new Setlist.fm events, using local ones: {}".format(err))
+      else:
+        self.database.add_events('setlist', pulled)
+        if (limit is not None) and (len(pulled) >= limit*SETLIST_PAGE_SIZE):
+          # The page limit may have cut the pull short of pull_start, leaving a gap before the coverage
+          covered_from = gen.sl_event_date(pulled[-1])
+        elif extends:
+          covered_from = coverage[0]
+        else:
+          covered_from = start_date
+        self.database.set_coverage('setlist', seed_type, seed_id, covered_from, \
+          max(today - datetime.timedelta(days=1), pull_start))
+    return self.database.events('setlist', seed_type, seed_id, \
+      None if start_date == datetime.date.min else start_date)
+
+#####################
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Load MusicBrainz and Setlist.fm data exports into a local event database")
+  parser.add_argument('database', help="event database SQLite file")
+  subparsers = parser.add_subparsers(dest='command')
+  mb_parser = subparsers.add_parser('musicbrainz', help="load a MusicBrainz JSON event dump")
+  mb_parser.add_argument('dump', help="event.tar.xz, or its mbdump/event file")
+  mb_parser.add_argument('--as-of', help="date of the dump (default the file's modification date)")
+  sl_parser = subparsers.add_parser('setlist', help="load archived Setlist.fm setlist pages")
+  sl_parser.add_argument('seed_type', choices=['artist', 'venue'], help="what the pages were pulled for")
+  sl_parser.add_argument('pages', nargs='+', help="JSON page files or folders of them")
+  sl_parser.add_argument('--as-of', help="date the pages were pulled (default the files' modification dates)")
+  args = parser.parse_args()
+
+  database = EventDatabase(args.database)
+  start_time = time.time()
+  if args.command == 'musicbrainz':
+    as_of = datetime.date.fromisoformat(args.as_of) if args.as_of else \
+      datetime.date.fromtimestamp(os.path.getmtime(args.dump))
+    count = database.ingest_musicbrainz_dump(args.dump, as_of)
+    print("Loaded {} MusicBrainz events in {:.1f} s".format(count, time.time() - start_time))
+  elif args.command == 'setlist':
+    as_of = datetime.date.fromisoformat(args.as_of) if args.as_of else None
+    count = database.ingest_setlist_pages(args.pages, args.seed_type, as_of)
+    print("Loaded {} Setlist.fm setlists in {:.1f} s".format(count, time.time() - start_time))
+  print(database.stats())
@@ -0,0 +1,284 @@
+import sqlite3
+import threading
+import time
+import datetime
+import argparse
+import pandas as pd
+
+import general_methods as gen
+
+# Events only shift while they are recent, so indexed venue histories are trusted for a week
+DEFAULT_MAX_AGE = 7*24*3600
+
+#####################
+
+class EventIndex:
+  """
+  Persistent artist-venue index of every event pulled so far, stored in SQLite. Events are kept per
+  seed (the artist or venue whose pull returned them) in flattened form, along with the date range
+  and time of the pull, so that get_events_list can take a venue's history from the index instead
+  of pulling it again, and so that recommendations for an indexed artist can be read off directly
+
+  Keyword arguments:
+  filename -- SQLite database file
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.local = threading.local()
+    with self.connect() as conn:
+      conn.execute("""CREATE TABLE IF NOT EXISTS seeds (
+        seed_type TEXT, seed_key TEXT, pulled_at REAL, start_date TEXT, end_date TEXT,
+        PRIMARY KEY (seed_type, seed_key))""")
+      conn.execute("""CREATE TABLE IF NOT EXISTS events (seed_type TEXT, seed_key TEXT,
+        venue_key TEXT, {})""".format(', '.join(gen.FLAT_EVENT_COLUMNS)))
+      conn.execute("CREATE INDEX IF NOT EXISTS events_seed ON events (seed_type, seed_key)")
+      conn.execute("CREATE INDEX IF NOT EXISTS events_artist ON events (artist_mbid, time)")
+      conn.execute("CREATE INDEX IF NOT EXISTS events_venue ON events (venue_key, time)")
+
+  def connect(self):
+    # sqlite3 connections can't be shared between threads, so keep one per thread
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.filename, timeout=30)
+      conn.execute("PRAGMA journal_mode=WAL")
+      self.local.conn = conn
+    return conn
+
+  def record_seed(self, seed_type, seed_key, batch, start_date, end_date, pulled_at=None):
+    """
+    Replace the events indexed for a seed with the rows of EventBatch
+
+    Keyword arguments:
+    seed_type -- "artist" or "venue"
+    seed_key -- artist MBID, or venue_key_string of the venue's IDs
+    batch -- EventBatch of the seed's events between start_date and end_date
+    start_date, end_date -- range of dates the events were pulled for (type datetime.date)
+    pulled_at -- time of the pull in seconds since the epoch (default None, now)
+    """
+    if pulled_at is None:
+      pulled_at = time.time()
+    c = batch.columns
+    rows = []
+    for i, row in enumerate(zip(*[c[column] for column in gen.FLAT_EVENT_COLUMNS])):
+      row = list(row)
+      event_time = row[2]
+      row[2] = None if event_time is None else event_time.isoformat()
+      rows.append([seed_type, seed_key, gen.venue_key_string(c['venue_mbid'][i], \
+        c['venue_slid'][i])] + row)
+    with self.connect() as conn:
+      conn.execute("DELETE FROM events WHERE seed_type=? AND seed_key=?", (seed_type, seed_key))
+      conn.executemany("INSERT INTO events VALUES ({})".format(\
+        ', '.join(['?']*(3 + len(gen.FLAT_EVENT_COLUMNS)))), rows)
+      conn.execute("INSERT OR REPLACE INTO seeds VALUES (?, ?, ?, ?, ?)", (seed_type, seed_key, \
+        pulled_at, start_date.isoformat(), end_date.isoformat()))
+
+  def is_fresh(self, seed_type, seed_key, start_date, end_date, max_age=DEFAULT_MAX_AGE):
+    """
+    Return whether the seed was indexed less than max_age seconds ago for a date range covering
+    start_date to end_date (events after the day of the pull can't have been missed)
+    """
+    with self.connect() as conn:
+      row = conn.execute("""SELECT pulled_at, start_date, end_date FROM seeds WHERE seed_type=?
+        AND seed_key=?""", (seed_type, seed_key)).fetchone()
+    if row is None:
+      return False
+    pulled_at, indexed_start, indexed_end = row
+    if time.time() - pulled_at > max_age:
+      return False
+    pulled_date = datetime.datetime.fromtimestamp(pulled_at, datetime.timezone.utc).date()
+    return (indexed_start <= start_date.isoformat()) and \
+      (indexed_end >= min(end_date, pulled_date).isoformat())
+
+  def seed_batch(self, seed_type, seed_key, start_date, end_date):
+    """
+    Return EventBatch of the events indexed for a seed between start_date and end_date, in the order
+    they were recorded
+    """
+    with self.connect() as conn:
+      rows = conn.execute("""SELECT {} FROM events WHERE seed_type=? AND seed_key=? AND time
+        BETWEEN ? AND ? ORDER BY rowid""".format(', '.join(gen.FLAT_EVENT_COLUMNS)), \
+        (seed_type, seed_key, start_date.isoformat(), end_date.isoformat())).fetchall()
+    batch = gen.EventBatch()
+    for column, values in zip(gen.FLAT_EVENT_COLUMNS, zip(*rows)):
+      batch.columns[column] = list(values)
+    batch.columns['time'] = [None if x is None else datetime.date.fromisoformat(x) \
+      for x in batch.columns['time']]
+    return batch
+
+  def artist_venue_keys(self, artist_mbid, start_date, end_date):
+    """
+    Return list of venue keys at which the artist has an indexed event between start_date and
+    end_date
+    """
+    with self.connect() as conn:
+      rows = conn.execute("""SELECT DISTINCT venue_key FROM events WHERE artist_mbid=? AND time
+        BETWEEN ? AND ? ORDER BY venue_key""", \
+        (artist_mbid, start_date.isoformat(), end_date.isoformat())).fetchall()
+    return [row[0] for row in rows]
+
+  def recommend(self, artist_mbid, start_date, end_date, n_recs=10, venue_keys=None):
+    """
+    Return DataFrame with columns id, Artist and Shared Venues for the n_recs artists with the most
+    venues among the events pulled for the query artist's venues between start_date and end_date,
+    same as ArtistRecommender.recommend on get_events_list's events for those venues. Only the
+    venues' own pulls are counted, not other artists' pulls that happen to pass through them. Only
+    meaningful when the query artist's venues are all indexed
+
+    Keyword arguments:
+    artist_mbid -- MBID of query artist
+    start_date, end_date -- range of dates of the events to count (type datetime.date)
+    n_recs -- number of recommended artists to return (default 10)
+    venue_keys -- keys of the query artist's venues as get_events_list finds them (see
+    general_methods.get_venue_keys), which current venue mappings may have changed since the query
+    artist was indexed (default None, the venues of the query artist's indexed events)
+    """
+    dates = (start_date.isoformat(), end_date.isoformat())
+    if venue_keys is None:
+      query_venues = """SELECT DISTINCT venue_key FROM events WHERE seed_type='artist' AND seed_key=?
+        AND time BETWEEN ? AND ?"""
+      params = (artist_mbid,) + dates
+    else:
+      query_venues = 'VALUES {}'.format(', '.join(['(?)']*len(venue_keys))) if venue_keys else 'SELECT NULL'
+      params = tuple(venue_keys)
+    with self.connect() as conn:
+      rows = conn.execute("""
+        WITH query_venues AS ({})
+        SELECT artist_mbid, artist_name, COUNT(DISTINCT venue_key) AS shared FROM events
+        WHERE seed_type='venue' AND seed_key IN query_venues AND time BETWEEN ? AND ?
+          AND artist_mbid IS NOT NULL AND artist_name IS NOT NULL AND artist_mbid != ?
+        GROUP BY artist_mbid, artist_name ORDER BY shared DESC, artist_mbid, artist_name
+        LIMIT ?""".format(query_venues), params + dates + (artist_mbid, n_recs)).fetchall()
+    return pd.DataFrame(rows, columns=['id', 'Artist', 'Shared Venues'])
+
+  def stats(self):
+    """
+    Return dictionary with the number of indexed seeds of each type and of indexed event rows
+    """
+    with self.connect() as conn:
+      out = dict(conn.execute("SELECT seed_type, COUNT(*) FROM seeds GROUP BY seed_type").fetchall())
+      out['events'] = conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+    return out
+
+  def build_from_cache(self, cache, venue_mapper, start_date=datetime.date.min, \
+    end_date=datetime.date.max, sync_store=None):
+    """
+    Index every seed with pages in a ResponseCache, so that everything pulled so far (by any worker)
+    is available without pulling it again. Each seed's pages are put back together the way the
+    pullers return them and processed with process_pulled_events. Return number of seeds indexed
+
+    Keyword arguments:
+    cache -- instance of class ResponseCache
+    venue_mapper -- instance of class VenueMapper
+    start_date, end_date -- range of dates of the events to index (default all)
+    sync_store -- instance of class SyncStore the MusicBrainz puller kept its pages in, which
+    take the place of the cached MusicBrainz pages for the seeds it has (default None)
+    """
+    sl_seeds = set(cache.seeds('setlist'))
+    mb_seeds = set(cache.seeds('musicbrainz'))
+    synced_seeds = set(sync_store.seeds('musicbrainz')) if sync_store else set()
+    seeds = []
+    for seed_type, seed_id in sorted(mb_seeds | synced_seeds):
+      slid = seed_id if seed_type == 'artist' else None
+      if (seed_type == 'venue') and venue_mapper.has_id(seed_id):
+        slid = venue_mapper.get_venue(seed_id).id['slid']
+      seeds.append((seed_type, seed_id, slid))
+    seen_sl_seeds = set((seed_type, slid) for seed_type, _, slid in seeds)
+    for seed_type, slid in sorted(sl_seeds - seen_sl_seeds):
+      mbid = slid if seed_type == 'artist' else None
+      if (seed_type == 'venue') and venue_mapper.has_id(slid):
+        mbid = venue_mapper.get_venue(slid).id['mbid']
+      seeds.append((seed_type, mbid, slid))
+
+    for seed_type, mbid, slid in seeds:
+      pulled_at = []
+      seed_start_date = start_date
+      mb_events = None
+      if (seed_type, mbid) in synced_seeds:
+        state = sync_store.get_state('musicbrainz', seed_type, mbid)
+        mb_events = sync_store.events('musicbrainz', seed_type, mbid)
+        pulled_at.append(state['synced_at'])
+        # Pages before the first synced one were skipped, so the seed is only complete from there
+        seed_start_date = max(start_date, datetime.date.fromisoformat(state['synced_from']))
+      elif mbid is not None:
+        mb_events, mb_pulled_at = cached_mb_events(cache, seed_type, mbid)
+        pulled_at += mb_pulled_at
+      sl_events = None
+      if (slid is not None) and ((seed_type, slid) in sl_seeds):
+        sl_events, sl_pulled_at = cached_sl_events(cache, seed_type, slid)
+        pulled_at += sl_pulled_at
+      pulled = dict(mb_events=mb_events, sl_events=sl_events, sl_error=False)
+      events, message = gen.process_pulled_events(pulled, venue_mapper, seed_start_date, end_date)
+      seed_key = mbid if seed_type == 'artist' else gen.venue_key_string(mbid, slid)
+      # Seed is only as fresh as its oldest page
+      self.record_seed(seed_type, seed_key, gen.EventBatch.from_events(events), seed_start_date, \
+        end_date, pulled_at=min(pulled_at) if pulled_at else None)
+    return len(seeds)
+
+def cached_mb_events(cache, seed_type, mbid):
+  """
+  Return list of raw MusicBrainz events cached for the seed, in offset order, and list of the
+  times their pages were fetched
+  """
+  pages = sorted(cache.pages('musicbrainz', seed_type, mbid), \
+    key=lambda page: int(page[0].split(':')[0]))
+  events = []
+  seen_ids = set()
+  for _, response, _ in pages:
+    for mb_event in response['event-list']:
+      # Pages pulled with different limits can overlap
+      if mb_event['id'] not in seen_ids:
+        seen_ids.add(mb_event['id'])
+        events.append(mb_event)
+  return events, [page[2] for page in pages]
+
+def cached_sl_events(cache, seed_type, slid):
+  """
+  Return list of raw Setlist.fm events cached for the seed, in page order, and list of the times
+  their pages were fetched
+  """
+  pages = sorted(cache.pages('setlist', seed_type, slid), key=lambda page: int(page[0]))
+  events = []
+  seen_ids = set()
+  for _, response, _ in pages:
+    for sl_event in response.get('setlist', []): # "not found" answers have no setlists
+      if sl_event['id'] not in seen_ids:
+        seen_ids.add(sl_event['id'])
+        events.append(sl_event)
+  return events, [page[2] for page in pages]
+
+#####################
+
+if __name__ == '__main__':
+  import response_cache
+  import sync_store
+
+  parser = argparse.ArgumentParser(description="Build or query the artist-venue event index")
+  parser.add_argument('index', help="event index SQLite file")
+  subparsers = parser.add_subparsers(dest='command')
+  build_parser = subparsers.add_parser('build', help="index every seed in a response cache")
+  build_parser.add_argument('cache', help="response cache SQLite file")
+  build_parser.add_argument('--venue-mapping', default='venue_mapping.json')
+  build_parser.add_argument('--sync-store', help="MusicBrainz sync store SQLite file")
+  recommend_parser = subparsers.add_parser('recommend', help="recommend artists from the index")
+  recommend_parser.add_argument('mbid', help="MusicBrainz ID of query artist")
+  recommend_parser.add_argument('--start', default='2015-01-01')
+  recommend_parser.add_argument('--end', default=datetime.date.today().isoformat())
+  recommend_parser.add_argument('-n', type=int, default=10)
+  args = parser.parse_args()
+
+  event_index = EventIndex(args.index)
+  if args.command == 'build':
+    venue_mapper = gen.VenueMapper()
+    venue_mapper.load_json(args.venue_mapping)
+    synced = sync_store.SyncStore(args.sync_store) if args.sync_store else None
+    n_seeds = event_index.build_from_cache(response_cache.ResponseCache(args.cache), venue_mapper, \
+      sync_store=synced)
+    print("Indexed {} seeds: {}".format(n_seeds, event_index.stats()))
+  elif args.command == 'recommend':
+    start_time = time.time()
+    recs = event_index.recommend(args.mbid, datetime.date.fromisoformat(args.start), \
+      datetime.date.fromisoformat(args.end), n_recs=args.n)
+    print(recs.to_string(index=False))
+    print("{:.1f} ms".format(1000*(time.time() - start_time)))
+  else:
+    print(event_index.stats())
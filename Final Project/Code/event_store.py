@@ -0,0 +1,143 @@
+import os
+import json
+import shutil
+import threading
+import time
+import uuid
+import collections
+import pandas as pd
+
+from general_methods import FLAT_EVENT_COLUMNS, venue_key_string
+
+#####################
+
+class EventStore:
+  """
+  Server-side store for pulled venue events, so that the browser only has to hold a token. Each
+  pull gets its own folder of Parquet files under directory, one per saved batch, which callbacks
+  can read column by column. Folders older than max_age seconds are removed on the next save
+
+  Next to each Parquet file is a JSON index of the rows for each venue, ready to display, so that
+  showing one venue's events doesn't mean loading and filtering all of them
+
+  Keyword arguments:
+  directory -- folder to keep the Parquet files in (created if missing)
+  max_age -- seconds to keep a pull's events (default 1 day)
+  cached_indexes -- number of pulls whose venue indexes are kept in memory (default 32)
+  """
+  def __init__(self, directory, max_age=24*3600, cached_indexes=32):
+    self.directory = directory
+    self.max_age = max_age
+    self.cached_indexes = cached_indexes
+    self.venue_indexes = collections.OrderedDict()
+    self.lock = threading.Lock()
+    os.makedirs(directory, exist_ok=True)
+
+  def token_dir(self, token):
+    return os.path.join(self.directory, token)
+
+  def new_token(self):
+    self.cleanup()
+    token = uuid.uuid4().hex
+    os.makedirs(self.token_dir(token))
+    return token
+
+  def save(self, batch):
+    """
+    Store EventBatch under a new token and return the token
+    """
+    token = self.new_token()
+    self.append(token, batch)
+    return token
+
+  def append(self, token, batch):
+    """
+    Add EventBatch to the events stored under token
+    """
+    df = batch.to_dataframe()
+    # Dates are kept as ISO strings, which is also how they came back from the dcc.Store before
+    df['time'] = [None if x is None else x.isoformat() for x in df['time']]
+    part = len(self.parts(token))
+    # Venue index goes first so that every part listed by parts() has one
+    index_filename = os.path.join(self.token_dir(token), 'venues-{:05d}.json'.format(part))
+    with open(index_filename + '.tmp', 'w') as f:
+      json.dump(build_venue_rows(batch), f)
+    os.replace(index_filename + '.tmp', index_filename)
+    filename = os.path.join(self.token_dir(token), 'part-{:05d}.parquet'.format(part))
+    tmp_filename = filename + '.tmp'
+    df.to_parquet(tmp_filename, index=False)
+    os.replace(tmp_filename, filename)
+
+  def parts(self, token):
+    token_dir = self.token_dir(token)
+    if (token is None) or not os.path.isdir(token_dir):
+      return []
+    return sorted(os.path.join(token_dir, x) for x in os.listdir(token_dir) if x.endswith('.parquet'))
+
+  def load(self, token, columns=None):
+    """
+    Return DataFrame with the given columns (default all) of the events stored under token, with
+    missing values as None; empty DataFrame if there is nothing stored under token
+    """
+    if columns is None:
+      columns = FLAT_EVENT_COLUMNS
+    frames = [pd.read_parquet(part, columns=columns) for part in self.parts(token)]
+    if len(frames) == 0:
+      return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True).astype(object)
+    return df.where(df.notna(), None)
+
+  def venue_rows(self, token, venue_mbid, venue_slid):
+    """
+    Return list of [date, artist name, event URL, link text] rows for the events stored under token
+    that were held at the given venue
+    """
+    parts = self.parts(token)
+    key = (token, len(parts))
+    with self.lock:
+      venue_index = self.venue_indexes.get(key)
+      if venue_index is not None:
+        self.venue_indexes.move_to_end(key)
+    if venue_index is None:
+      venue_index = {}
+      for part in parts:
+        part_dir, part_name = os.path.split(part)
+        index_name = part_name.replace('part-', 'venues-').replace('.parquet', '.json')
+        with open(os.path.join(part_dir, index_name)) as f:
+          for venue_key, rows in json.load(f).items():
+            venue_index.setdefault(venue_key, []).extend(rows)
+      with self.lock:
+        self.venue_indexes[key] = venue_index
+        while len(self.venue_indexes) > self.cached_indexes:
+          self.venue_indexes.popitem(last=False)
+    return venue_index.get(venue_key_string(venue_mbid, venue_slid), [])
+
+  def count(self, token):
+    """
+    Return number of event rows stored under token
+    """
+    return len(self.load(token, columns=['artist_mbid']))
+
+  def cleanup(self):
+    cutoff = time.time() - self.max_age
+    for token in os.listdir(self.directory):
+      token_dir = self.token_dir(token)
+      if os.path.isdir(token_dir) and os.path.getmtime(token_dir) < cutoff:
+        shutil.rmtree(token_dir, ignore_errors=True)
+
+def build_venue_rows(batch):
+  """
+  Group the rows of EventBatch by venue, return dictionary of venue key to list of
+  [date, artist name, event URL, link text] rows
+  """
+  c = batch.columns
+  venue_rows = {}
+  for i in range(len(batch)):
+    event_time = c['time'][i]
+    if c['event_slurl'][i]:
+      url, link_text = c['event_slurl'][i], 'Setlist.fm page'
+    else:
+      url, link_text = c['event_mburl'][i], 'MusicBrainz page'
+    venue_rows.setdefault(venue_key_string(c['venue_mbid'][i], c['venue_slid'][i]), []).append(\
+      [None if event_time is None else event_time.isoformat(), c['artist_name'][i], url, link_text])
+  return venue_rows
@@ -7,16 +7,28 @@ import pandas as pd
 import configparser
 import json
 import datetime
+import asyncio
+import async_pullers
 
 START_DATE = datetime.date(2015, 1, 1)
 END_DATE = datetime.date.today()
 
+async def pull_venue_events(valid_events, venue_mapper, setlist_api_key, max_concurrent):
+  # All the venues' pulls share one event loop and one pool of Setlist.fm connections
+  mb_event_puller = async_pullers.AsyncMusicBrainzPuller(app="MUMT-621 Project testing", version="0")
+  async with async_pullers.AsyncSetlistPuller(api_key=setlist_api_key) as sl_event_puller:
+    return await async_pullers.get_events_list([event.to_dict() for event in valid_events], \
+      mb_event_puller, sl_event_puller, venue_mapper, START_DATE, END_DATE, 1, \
+      max_concurrent=max_concurrent)
+
 def main():
   config = configparser.ConfigParser()
   config.read('.config')
   SETLIST_API_KEY = config['API Keys']['SETLIST_API_KEY']
   parser = argparse.ArgumentParser(description='Get artist recommendations')
   parser.add_argument('mbid')
+  parser.add_argument('--concurrent', type=int, default=0, \
+    help='pull this many venues at a time with the asyncio pullers (default 0, one after another)')
   args = parser.parse_args()
   test_mbid = args.mbid
   #test_mbid = "50eec634-7c42-41ee-9b1f-b41d9ca28b26" #Korpiklaani
@@ -31,26 +43,30 @@ def main():
 
   print(message)
 
-  venue_event_dict = {}
-  all_events = []
-  for event in valid_events:
-    venue_id = gen.not_none(event.venue.id['mbid'], event.venue.id['slid'])
-    if venue_mapper.has_id(venue_id):
-      event.set_venue(venue_mapper.get_venue(venue_id))
+  if args.concurrent > 0:
+    all_events = asyncio.run(pull_venue_events(valid_events, venue_mapper, SETLIST_API_KEY, \
+      args.concurrent))
+  else:
+    venue_event_dict = {}
+    all_events = []
+    for event in valid_events:
+      venue_id = gen.not_none(event.venue.id['mbid'], event.venue.id['slid'])
+      if venue_mapper.has_id(venue_id):
+        event.set_venue(venue_mapper.get_venue(venue_id))
     
-    venue_mbid = event.venue.id['mbid']
-    venue_slid = event.venue.id['slid']
-
-    new_events = []
-    new_key = (venue_mbid, venue_slid)
-    if new_key not in venue_event_dict:
-      new_events, message = gen.get_mb_and_sl_events(venue_mbid, mb_event_puller, sl_event_puller, venue_mapper, \
-          START_DATE, END_DATE, seed_type="venue", slid=venue_slid, sl_page_limit=1)
-      venue_event_dict[new_key] = new_events
-      flattened_events = [x.flatten() for x in new_events]
-      all_events += flattened_events
-
-  all_events = [y for x in all_events for y in x]
+      venue_mbid = event.venue.id['mbid']
+      venue_slid = event.venue.id['slid']
+
+      new_events = []
+      new_key = (venue_mbid, venue_slid)
+      if new_key not in venue_event_dict:
+        new_events, message = gen.get_mb_and_sl_events(venue_mbid, mb_event_puller, sl_event_puller, venue_mapper, \
+            START_DATE, END_DATE, seed_type="venue", slid=venue_slid, sl_page_limit=1)
+        venue_event_dict[new_key] = new_events
+        flattened_events = [x.flatten() for x in new_events]
+        all_events += flattened_events
+
+    all_events = [y for x in all_events for y in x]
 
   events_df = pd.DataFrame(all_events)
   if len(events_df) > 0:
@@ -1,11 +1,24 @@
 import networkx as nx
 import pandas as pd
+import numpy as np
+import scipy.sparse
 import plotly.graph_objects as go
 import musicbrainzngs
 import datetime
 import requests
 import time
 import json
+import threading
+import sqlite3
+import os
+import concurrent.futures
+import collections
+import bisect
+from rate_limiting import HIGH_PRIORITY, LOW_PRIORITY, QuotaExceededError, parse_retry_after
+from sync_store import SyncStore
+from venue_matching import MATCH_THRESHOLD
+
+VENUE_INDEX_MMAP_SIZE = 64*1024*1024
 
 def not_none(x, y=None):
     if x is None:
@@ -15,6 +28,8 @@ def not_none(x, y=None):
 #####################
 
 class Artist:
+  __slots__ = ('mbid', 'name')
+
   def __init__(self):
     self.mbid = None
     self.name = None
@@ -53,6 +68,8 @@ class Artist:
 ###################
 
 class Venue:
+  __slots__ = ('id', 'name', 'city', 'coords')
+
   def __init__(self, venue_dict=None):
     if venue_dict is None:
       self.id = dict(mbid=None, slid=None)
@@ -134,6 +151,8 @@ class Venue:
 ####################
 
 class Event:
+  __slots__ = ('id', 'time', 'type', 'artists', 'venue', 'url')
+
   def __init__(self):
     self.id = dict(mbid=None, slid=None)
     self.time = None
@@ -144,12 +163,7 @@ class Event:
 
   def load_from_mb_event(self, mb_event):
     self.id['mbid'] = mb_event['id']
-    if 'life-span' in mb_event.keys():
-      for fmt in ('%Y-%m-%d', '%Y-%m', '%Y'):
-          try:
-            self.time = datetime.datetime.strptime(mb_event['life-span']['begin'], fmt).date()
-          except ValueError:
-            pass
+    self.time = mb_event_date(mb_event)
     if 'type' in mb_event.keys():
       self.type = mb_event['type']
     if 'artist-relation-list' in mb_event.keys():
@@ -163,7 +177,7 @@ class Event:
 
   def load_from_sl_event(self, sl_event):
     self.id['slid'] = sl_event['id']
-    self.time = datetime.datetime.strptime(sl_event['eventDate'], '%d-%m-%Y').date()
+    self.time = sl_event_date(sl_event)
     new_artist = Artist()
     new_artist.load_from_sl_event(sl_event)
     self.artists.append(new_artist)
@@ -176,7 +190,8 @@ class Event:
     self.type = event_dict['type']
     for artist in event_dict['artists']:
       new_artist = Artist()
-      self.artists.append(new_artist.from_dict(artist))
+      new_artist.from_dict(artist)
+      self.artists.append(new_artist)
     self.venue.from_dict(event_dict['venue'])
     self.url = event_dict['url']
 
@@ -242,11 +257,131 @@ class Event:
           artist_node_id = artist.add_to_bigraph(G)
           G.add_edge(artist_node_id, venue_node_id)
 
+def mb_event_date(mb_event):
+  """
+  Return begin date (type datetime.date) of raw MusicBrainz event, or None if it has none
+  """
+  begin = mb_event.get('life-span', {}).get('begin')
+  if begin:
+    for fmt in ('%Y-%m-%d', '%Y-%m', '%Y'):
+      try:
+        return datetime.datetime.strptime(begin, fmt).date()
+      except ValueError:
+        pass
+  return None
+
+def sl_event_date(sl_event):
+  """
+  Return date (type datetime.date) of raw Setlist.fm event
+  """
+  return datetime.datetime.strptime(sl_event['eventDate'], '%d-%m-%Y').date()
+
+def date_sort_key(date):
+  """
+  Return date, or datetime.date.max if it is None, which is where MusicBrainz sorts undated events
+  """
+  return datetime.date.max if date is None else date
+
+def venue_key_string(venue_mbid, venue_slid):
+  """
+  Return single string key for a venue's (MBID, Setlist.fm ID) pair, either of which may be None
+  """
+  return '{}|{}'.format(venue_mbid or '', venue_slid or '')
+
+#####################
+
+# Columns of the flattened form of an event, in the order used by Event.flatten
+FLAT_EVENT_COLUMNS = ['event_mbid', 'event_slid', 'time', 'event_type', 'event_mburl', 'event_slurl', \
+  'venue_mbid', 'venue_slid', 'venue_mbname', 'venue_slname', 'city_name', 'city_lat', 'city_long', \
+  'venue_lat', 'venue_long', 'artist_mbid', 'artist_name']
+
+class EventBatch:
+  """
+  Flattened events stored column by column (one list per entry of FLAT_EVENT_COLUMNS), with one row
+  per (event, artist) pair as in Event.flatten, but without building a dictionary for each row
+  """
+  __slots__ = ('columns',)
+
+  def __init__(self):
+    self.columns = {column: [] for column in FLAT_EVENT_COLUMNS}
+
+  def __len__(self):
+    return len(self.columns['artist_mbid'])
+
+  @classmethod
+  def from_events(cls, events):
+    batch = cls()
+    batch.add_events(events)
+    return batch
+
+  @classmethod
+  def from_records(cls, records):
+    batch = cls()
+    for record in records:
+      for column in FLAT_EVENT_COLUMNS:
+        batch.columns[column].append(record[column])
+    return batch
+
+  def add_event(self, event):
+    c = self.columns
+    venue = event.venue
+    n = len(event.artists)
+    c['event_mbid'] += [event.id['mbid']]*n
+    c['event_slid'] += [event.id['slid']]*n
+    c['time'] += [event.time]*n
+    c['event_type'] += [event.type]*n
+    c['event_mburl'] += [event.url['mburl']]*n
+    c['event_slurl'] += [event.url['slurl']]*n
+    c['venue_mbid'] += [venue.id['mbid']]*n
+    c['venue_slid'] += [venue.id['slid']]*n
+    c['venue_mbname'] += [venue.name['mbname']]*n
+    c['venue_slname'] += [venue.name['slname']]*n
+    c['city_name'] += [venue.city['name']]*n
+    c['city_lat'] += [venue.city['coords'][0]]*n
+    c['city_long'] += [venue.city['coords'][1]]*n
+    c['venue_lat'] += [venue.coords[0]]*n
+    c['venue_long'] += [venue.coords[1]]*n
+    for artist in event.artists:
+      c['artist_mbid'].append(artist.mbid)
+      c['artist_name'].append(artist.name)
+
+  def add_events(self, events):
+    for event in events:
+      self.add_event(event)
+
+  def add_batch(self, other):
+    for column in FLAT_EVENT_COLUMNS:
+      self.columns[column] += other.columns[column]
+
+  def to_records(self):
+    """
+    Return list of dictionaries, same as concatenating Event.flatten for each event
+    """
+    return [dict(zip(FLAT_EVENT_COLUMNS, row)) for row in \
+      zip(*[self.columns[column] for column in FLAT_EVENT_COLUMNS])]
+
+  def to_dataframe(self, columns=None):
+    """
+    Return pandas DataFrame built straight from the columns
+
+    Keyword arguments:
+    columns -- list of columns to include (default None, all of FLAT_EVENT_COLUMNS)
+    """
+    if columns is None:
+      columns = FLAT_EVENT_COLUMNS
+    return pd.DataFrame({column: self.columns[column] for column in columns}, columns=columns)
+
 #####################
 # For now assume one-to-one mapping (prob a faulty assumption...)
 class VenueMapper:
   def __init__(self):
-    self.venue_mapping = {}
+    self.venue_mapping = {} # venues loaded from JSON or added while pulling events
+    self.index_file = None # compiled SQLite index, see load_index
+    self.index_local = threading.local()
+    self.index_venues = {} # Venue objects already built from the index, by row
+    self.locator = None # finds nearby venues for unmapped ones, see set_locator
+    self.locator_thresholds = {}
+    self.new_venues = {} # venues added since the last save_new_venues, by ID
 
   #takes form id: dictionary rep of Venue object
   def load_json(self, filename):
@@ -257,20 +392,214 @@ class VenueMapper:
 
   def dump_json(self, filename):
     venue_dump = {}
-    for venue_id, venue in self.venue_mapping.items():
+    for venue_id, venue in self.all_venues():
       venue_dump[venue_id] = venue.to_dict()
     if bool(venue_dump):
       with open(filename, 'w') as f:
         json.dump(venue_dump, f)
 
+  def compile_index(self, filename):
+    """
+    Write current mappings to a SQLite index file that stores each venue once, with a lookup row 
+    for each of its IDs; load it with load_index
+    """
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    if os.path.exists(tmp_filename):
+      os.remove(tmp_filename)
+    conn = sqlite3.connect(tmp_filename)
+    with conn:
+      conn.execute("""CREATE TABLE venues (venue_row INTEGER PRIMARY KEY, mbid TEXT, slid TEXT,
+        mbname TEXT, slname TEXT, city_name TEXT, city_lat REAL, city_long REAL, lat REAL, long REAL)""")
+      conn.execute("CREATE TABLE venue_ids (id TEXT PRIMARY KEY, venue_row INTEGER) WITHOUT ROWID")
+      venue_rows = {}
+      for venue_id, venue in self.all_venues():
+        if venue_id is None:
+          continue
+        # The JSON format repeats each venue under both of its IDs
+        venue_key = json.dumps(venue.to_dict(), sort_keys=True)
+        if venue_key not in venue_rows:
+          cursor = conn.execute("INSERT INTO venues VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)", \
+            (venue.id['mbid'], venue.id['slid'], venue.name['mbname'], venue.name['slname'], \
+            venue.city['name'], venue.city['coords'][0], venue.city['coords'][1], \
+            venue.coords[0], venue.coords[1]))
+          venue_rows[venue_key] = cursor.lastrowid
+        conn.execute("INSERT OR REPLACE INTO venue_ids VALUES (?, ?)", \
+          (venue_id, venue_rows[venue_key]))
+    conn.close()
+    os.replace(tmp_filename, filename)
+
+  def load_index(self, filename):
+    """
+    Look up venues in a SQLite index written by compile_index instead of holding them all in memory.
+    The file is memory-mapped, so processes using the same index share its pages; Venue objects 
+    are only built when get_venue asks for them
+    """
+    self.index_file = filename
+    self.index_local = threading.local()
+    self.index_venues = {}
+
+  def index_query(self, query, params=()):
+    # sqlite3 connections can't be shared between threads, so open one per thread
+    conn = getattr(self.index_local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect('file:{}?mode=ro'.format(self.index_file), uri=True, \
+        check_same_thread=False)
+      conn.execute("PRAGMA mmap_size={}".format(VENUE_INDEX_MMAP_SIZE))
+      self.index_local.conn = conn
+    return conn.execute(query, params).fetchall()
+
+  def index_row(self, venue_id):
+    if (self.index_file is None) or (venue_id is None):
+      return None
+    rows = self.index_query("SELECT venue_row FROM venue_ids WHERE id=?", (venue_id,))
+    if len(rows) == 0:
+      return None
+    return rows[0][0]
+
+  def index_venue(self, venue_row):
+    # Both IDs of a venue share one Venue object, as with mappings added by merge_event_lists
+    venue = self.index_venues.get(venue_row)
+    if venue is None:
+      row = self.index_query("""SELECT mbid, slid, mbname, slname, city_name, city_lat, city_long,
+        lat, long FROM venues WHERE venue_row=?""", (venue_row,))[0]
+      venue = Venue(dict(id=dict(mbid=row[0], slid=row[1]), name=dict(mbname=row[2], slname=row[3]), \
+        city=dict(name=row[4], coords=(row[5], row[6])), coords=(row[7], row[8])))
+      venue = self.index_venues.setdefault(venue_row, venue)
+    return venue
+
+  def all_venues(self):
+    """
+    Return list of (ID, Venue) pairs for every mapping, including those in a loaded index
+    """
+    venues = []
+    if self.index_file:
+      for venue_id, venue_row in self.index_query("SELECT id, venue_row FROM venue_ids"):
+        if venue_id not in self.venue_mapping:
+          venues.append((venue_id, self.index_venue(venue_row)))
+    venues += list(self.venue_mapping.items())
+    return venues
+
   def add_venue(self, map_id, venue):
-      self.venue_mapping[map_id] = venue
+      if self.venue_mapping.get(map_id) is not venue:
+        self.venue_mapping[map_id] = venue
+        self.new_venues[map_id] = venue
+
+  def save_new_venues(self):
+    """
+    Write the mappings added since the last call to the loaded index file, so that other processes
+    using the same index (e.g. the app and its background jobs) can look them up too. They last
+    until the index is compiled again. Return number of IDs saved
+    """
+    new_venues, self.new_venues = self.new_venues, {}
+    if (self.index_file is None) or (len(new_venues) == 0):
+      return 0
+    conn = sqlite3.connect(self.index_file, timeout=30)
+    with conn:
+      venue_rows = {} # both IDs of a venue share its row
+      for venue_id, venue in new_venues.items():
+        if venue_id is None:
+          continue
+        if id(venue) not in venue_rows:
+          cursor = conn.execute("INSERT INTO venues VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)", \
+            (venue.id['mbid'], venue.id['slid'], venue.name['mbname'], venue.name['slname'], \
+            venue.city['name'], venue.city['coords'][0], venue.city['coords'][1], \
+            venue.coords[0], venue.coords[1]))
+          venue_rows[id(venue)] = cursor.lastrowid
+        conn.execute("INSERT OR REPLACE INTO venue_ids VALUES (?, ?)", (venue_id, venue_rows[id(venue)]))
+    conn.close()
+    return len(new_venues)
 
   def has_id(self, check_id):
-    return(check_id in self.venue_mapping)
+    return (check_id in self.venue_mapping) or (self.index_row(check_id) is not None)
 
   def get_venue(self, query_id):
-    return self.venue_mapping[query_id]
+    if query_id in self.venue_mapping:
+      return self.venue_mapping[query_id]
+    venue_row = self.index_row(query_id)
+    if venue_row is None:
+      raise KeyError(query_id)
+    return self.index_venue(venue_row)
+
+  def venue_fingerprint(self, venue_ids):
+    """
+    Return tuple of (venue ID, flattened fields of the venue it is mapped to) for each of venue_ids
+    (None for unmapped IDs). It only holds strings and numbers, so it doesn't change along with venues
+    merged or updated in place later, and results built from those venues can tell when they did
+    """
+    return tuple((venue_id, tuple(self.get_venue(venue_id).flatten().values()) if self.has_id(venue_id) \
+      else None) for venue_id in venue_ids)
+
+  def set_locator(self, locator, distance_threshold=25, match_threshold=MATCH_THRESHOLD):
+    """
+    Map venues that only have one of their IDs to a nearby venue from the other source with a
+    similar name, if locator knows of one (see match_nearby)
+
+    Keyword arguments:
+    locator -- instance of class venue_matching.VenueLocator
+    distance_threshold, match_threshold -- see VenueLocator.match (match_threshold defaults to
+    venue_matching.MATCH_THRESHOLD, calibrated on venue_mapping.json)
+    """
+    self.locator = locator
+    self.locator_thresholds = dict(distance_threshold=distance_threshold, match_threshold=match_threshold)
+
+  def locate_venues(self, batch):
+    """
+    Add the venues of EventBatch's events to the locator, if there is one, so that venues pulled
+    after it was built can be matched too
+    """
+    if self.locator is None:
+      return
+    c = batch.columns
+    seen = set()
+    for i, key in enumerate(zip(c['venue_mbid'], c['venue_slid'])):
+      if key not in seen:
+        seen.add(key)
+        self.locator.add(dict(id=dict(mbid=key[0], slid=key[1]), \
+          name=dict(mbname=c['venue_mbname'][i], slname=c['venue_slname'][i]), \
+          city=dict(name=c['city_name'][i], coords=(c['city_lat'][i], c['city_long'][i])), \
+          coords=(c['venue_lat'][i], c['venue_long'][i])))
+
+  def match_nearby(self, venue):
+    """
+    Return venue merged with the venue found for it by the locator, adding the mapping, or venue
+    itself if there is no locator or no match. The locator claims the match, so no other venue is
+    mapped to it, and skips venues already mapped (e.g. by another process sharing the index)
+    """
+    if (self.locator is None) or ((venue.id['mbid'] is None) == (venue.id['slid'] is None)):
+      return venue
+    other_id = 'mbid' if venue.id['mbid'] is None else 'slid'
+    match = self.locator.match(venue.to_dict(), claim=True, \
+      exclude=lambda candidate: self.has_id(candidate['id'][other_id]), **self.locator_thresholds)
+    if match is None:
+      return venue
+    if venue.id['slid'] is None:
+      mb_venue, sl_venue = venue.to_dict(), match
+    else:
+      mb_venue, sl_venue = match, venue.to_dict()
+    # Same fields from each source as the venue mapping scripts use
+    merged = Venue(dict(id=dict(mbid=mb_venue['id']['mbid'], slid=sl_venue['id']['slid']), \
+      name=dict(mbname=mb_venue['name']['mbname'], slname=sl_venue['name']['slname']), \
+      city=dict(name=sl_venue['city']['name'], coords=tuple(sl_venue['city']['coords'])), \
+      coords=tuple(mb_venue['coords'])))
+    self.add_venue(merged.id['mbid'], merged)
+    self.add_venue(merged.id['slid'], merged)
+    return merged
+
+def compile_venue_index(json_filename, index_filename):
+  """
+  Compile JSON venue mapping file into a SQLite index for VenueMapper.load_index, unless the index
+  is already newer than the JSON file. Return name of index file
+
+  Keyword arguments:
+  json_filename -- venue mapping in the format written by VenueMapper.dump_json
+  index_filename -- SQLite file to write
+  """
+  if (not os.path.exists(index_filename)) or \
+    (os.path.getmtime(index_filename) < os.path.getmtime(json_filename)):
+    venue_mapper = VenueMapper()
+    venue_mapper.load_json(json_filename)
+    venue_mapper.compile_index(index_filename)
+  return index_filename
 
 #####################
 
@@ -282,71 +611,242 @@ class SetlistNotFoundError(Exception):
 
 #####################
 
+class PooledSession:
+  """
+  Give each thread its own requests.Session (sessions aren't thread-safe), all mounted on one
+  HTTPAdapter so that they share a single pool of keep-alive connections instead of paying a new
+  TCP and TLS handshake for every request
+
+  Keyword arguments:
+  headers -- dictionary of headers sent with every request (default None)
+  pool_size -- maximum number of connections kept open per host (default 10)
+  timeout -- seconds to wait to connect and to read, passed to requests (default (3.05, 30))
+  """
+  def __init__(self, headers=None, pool_size=10, timeout=(3.05, 30)):
+    self.headers = {'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'}
+    self.headers.update(headers or {})
+    self.timeout = timeout
+    self.adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    self.local = threading.local()
+
+  def session(self):
+    session = getattr(self.local, 'session', None)
+    if session is None:
+      session = requests.Session()
+      session.headers.update(self.headers)
+      session.mount('https://', self.adapter)
+      session.mount('http://', self.adapter)
+      self.local.session = session
+    return session
+
+  def get(self, url, **kwargs):
+    kwargs.setdefault('timeout', self.timeout)
+    return self.session().get(url, **kwargs)
+
 class SetlistPuller:
-  def __init__(self, api_key):
+  def __init__(self, api_key, rate_limiter=None, cache=None, pool_size=10, timeout=(3.05, 30), \
+    single_flight=None):
     self.api_key = api_key
+    self.rate_limiter = rate_limiter
+    self.cache = cache
+    self.single_flight = single_flight # coalesces concurrent pulls of the same page
+    self.http = PooledSession(headers={'Accept': 'application/json', 'x-api-key': api_key}, \
+      pool_size=pool_size, timeout=timeout)
 
-  def pull_page(self, seed_id, seed_type, page):
+  def fetch_page(self, seed_id, seed_type, page, priority=HIGH_PRIORITY):
     request = 'https://api.setlist.fm/rest/1.0/{0}/{1}/setlists?p={2}'.format(\
       seed_type, seed_id, page)
-    headers = {'Accept': 'application/json', 'x-api-key': self.api_key}
-    results = requests.get(request, headers=headers)
-    json_results = results.json()
+    if self.rate_limiter:
+      try:
+        self.rate_limiter.acquire(priority)
+      except QuotaExceededError as err:
+        raise SetlistAPIError(str(err))
+    try:
+      results = self.http.get(request)
+    except requests.exceptions.RequestException as err:
+      # Timeouts and dropped connections are retried by setlist_pull_steps like other failed pages
+      print("Setlist.fm request failed: {}".format(err))
+      return dict(code=None, message=str(err))
+    if results.status_code == 429: # too many requests, body may not be JSON
+      if self.rate_limiter:
+        self.rate_limiter.backoff(parse_retry_after(results.headers.get('Retry-After')))
+      return dict(code=429)
+    try:
+      return results.json()
+    except ValueError: # e.g. an HTML error page from a proxy, retried like other failed pages
+      return dict(code=results.status_code)
+
+  def pull_page(self, seed_id, seed_type, page, priority=HIGH_PRIORITY):
+    fetch = lambda: self.fetch_page(seed_id, seed_type, page, priority=priority)
+    if self.cache:
+      # Only keep real results pages and "not found" answers, not rate limit errors. Setlist.fm
+      # returns newest events first, so page 1 is the one that changes
+      get_page = lambda: self.cache.get_or_fetch('setlist', seed_type, seed_id, page, fetch, \
+        is_recent=(page == 1), \
+        should_store=lambda r: ('setlist' in r) or (r.get('code') == 404))
+      if self.single_flight:
+        json_results = self.single_flight.do(('page', 'setlist', seed_type, str(seed_id), str(page)), \
+          get_page)
+      else:
+        json_results = get_page()
+    else:
+      json_results = fetch()
     if 'code' in json_results:
       if json_results['code'] == 404:
         raise SetlistNotFoundError
     return json_results
 
-  def pull_until_success(self, seed_id, seed_type, page, check_key, limit=10):
+  def iter_events(self, seed_id, seed_type, start_date=None, limit=None, priority=HIGH_PRIORITY):
+    """
+    Yield raw events of an artist or venue one at a time, newest first (the order Setlist.fm
+    returns them in), pulling the next page only once the previous one has been used up. Stops at
+    the first event dated before start_date, so no pages are pulled past the requested dates. Pages
+    that fail are pulled again, backing off in between (see setlist_pull_steps)
+
+    Keyword arguments:
+    seed_id -- MusicBrainz ID of the artist or Setlist.fm ID of the venue
+    seed_type -- "artist" or "venue"
+    start_date -- earliest date of the events to yield (type datetime.date, default None, all)
+    limit -- maximum number of results pages to pull, to cap the quota spent on one seed
+    (default None, no cap)
+    priority -- rate limiter priority of the requests (default HIGH_PRIORITY)
+    """
+    steps = setlist_pull_steps(start_date=start_date, limit=limit, \
+      rate_limited=self.rate_limiter is not None)
+    result = None
     try:
-      page_results = self.pull_page(seed_id, seed_type, page) 
-      attempts = 1
-      while (check_key not in page_results.keys()) and (attempts < limit):
-          time.sleep(1)
-          page_results = self.pull_page(seed_id, seed_type, page)
-          attempts += 1
-      if check_key in page_results.keys():
-        return page_results
-    except SetlistNotFoundError:
-      raise
-    raise SetlistAPIError("Too many attempts")
-
-  def pull_events(self, seed_id, seed_type, limit=5):
-    page = 1
-    try:
-      page_results = self.pull_until_success(seed_id, seed_type, page, 'total')
-      total_events = page_results['total']
-      per_page = page_results['itemsPerPage']
-      events = page_results['setlist']
-      while (page < limit) and (len(events) < total_events):
-        page += 1
-        page_results = self.pull_until_success(seed_id, seed_type, page, 'setlist')
-        events += page_results['setlist']
-      return events
+      while True:
+        step, value = steps.send(result)
+        result = None
+        if step == 'page':
+          result = self.pull_page(seed_id, seed_type, value, priority=priority)
+        elif step == 'event':
+          yield value
+        elif step == 'sleep':
+          time.sleep(value)
+        elif step == 'backoff':
+          self.rate_limiter.backoff()
+        elif step == 'success':
+          self.rate_limiter.success()
+    except StopIteration:
+      return
     except SetlistAPIError:
       print('Could not pull Setlist.fm events')
       raise
     except SetlistNotFoundError:
       print('No Setlist.fm events found')
-      return []
+
+  def pull_events(self, seed_id, seed_type, limit=5, priority=HIGH_PRIORITY, start_date=None):
+    """
+    Return list of raw events of an artist or venue, newest first, going back to start_date (if
+    given) or until limit pages have been pulled, see iter_events
+    """
+    return list(self.iter_events(seed_id, seed_type, start_date=start_date, limit=limit, \
+      priority=priority))
+
+def setlist_pull_steps(start_date=None, limit=None, rate_limited=False, attempts=10):
+  """
+  Paging, retry and stop-date logic of pulling a seed's events from Setlist.fm, without any I/O, so
+  that SetlistPuller and async_pullers.AsyncSetlistPuller only differ in how they carry out each
+  step. Generator of (step, value) pairs, one of
+  ("page", page) -- pull results page number page and send its JSON results back in
+  ("sleep", seconds) -- wait before pulling the same page again (pullers without a rate limiter)
+  ("backoff", None) -- back off the rate limiter before pulling the same page again
+  ("success", None) -- tell the rate limiter that a page came through
+  ("event", sl_event) -- next raw event, newest first
+  Raises SetlistAPIError once a page has been pulled attempts times without success
+
+  Keyword arguments:
+  start_date, limit -- see SetlistPuller.iter_events
+  rate_limited -- whether the puller has a rate limiter (default False)
+  attempts -- maximum number of pulls of each page (default 10)
+  """
+  page = 1
+  seen = 0
+  total = 0
+  while True:
+    # The first page has to say how many events there are; later ones only need their events
+    check_key = 'total' if page == 1 else 'setlist'
+    page_results = {}
+    for attempt in range(attempts):
+      if attempt > 0:
+        if not rate_limited:
+          yield ('sleep', 1)
+        elif page_results.get('code') != 429: # pull_page already backed off for a 429
+          yield ('backoff', None)
+      page_results = yield ('page', page)
+      if check_key in page_results:
+        break
+    else:
+      raise SetlistAPIError("Too many attempts")
+    if rate_limited:
+      yield ('success', None)
+    total = page_results.get('total', total)
+    events = page_results['setlist']
+    for sl_event in events:
+      if (start_date is not None) and (sl_event_date(sl_event) < start_date):
+        return
+      yield ('event', sl_event)
+    seen += len(events)
+    if (len(events) == 0) or (seen >= total) or ((limit is not None) and (page >= limit)):
+      return
+    page += 1
 
 #####################
 
 class MusicBrainzPuller:
-  def __init__(self, app, version):
+  def __init__(self, app, version, rate_limiter=None, cache=None, sync_store=None, sync_max_age=24*3600, \
+    single_flight=None):
     musicbrainzngs.set_useragent(app=app, version=version)
+    self.rate_limiter = rate_limiter
+    self.cache = cache
+    self.single_flight = single_flight # coalesces concurrent pulls of the same page
+    self.sync_store = sync_store # remembers each seed's pulled pages, see pull_events_between
+    self.sync_max_age = sync_max_age
 
-  def pull_page(self, mbid, seed_type, limit, offset):
+  def fetch_page(self, mbid, seed_type, limit, offset):
     args = dict(includes=["event-rels", "place-rels", "artist-rels"], \
       limit=limit, offset=offset)
     if seed_type=='venue':
       args['place']=mbid
     else:
       args[seed_type]=mbid
-    result = musicbrainzngs.browse_events(**args)
+    if self.rate_limiter:
+      self.rate_limiter.acquire()
+    try:
+      result = musicbrainzngs.browse_events(**args)
+    except musicbrainzngs.WebServiceError as err:
+      # musicbrainzngs already retried 503s; make other workers sharing the limiter slow down too
+      if self.rate_limiter and getattr(err.cause, 'code', None) == 503:
+        self.rate_limiter.backoff(parse_retry_after(err.cause.headers.get('Retry-After')))
+      raise
+    if self.rate_limiter:
+      self.rate_limiter.success()
     return result
 
-  def pull_events(self, mbid, seed_type, limit=100, offset=0):
+  def pull_page(self, mbid, seed_type, limit, offset, max_age=None):
+    # max_age caps how old a cached page can be, see ResponseCache.get_or_fetch
+    fetch = lambda: self.fetch_page(mbid, seed_type, limit, offset)
+    if self.cache:
+      # The last (partial) page is the only one new events get added to
+      page = '{0}:{1}'.format(offset, limit)
+      get_page = lambda: self.cache.get_or_fetch('musicbrainz', seed_type, mbid, page, fetch, \
+        is_recent=lambda r: len(r['event-list']) < limit, max_age=max_age)
+      if self.single_flight:
+        return self.single_flight.do(('page', 'musicbrainz', seed_type, str(mbid), page, str(max_age)), \
+          get_page)
+      return get_page()
+    return fetch()
+
+  def pull_events(self, mbid, seed_type, limit=100, offset=0, start_date=None, end_date=None):
+    """
+    Return list of raw events of an artist or venue, all of them from offset on unless start_date
+    or end_date is given, in which case only the events between them are pulled (see
+    pull_events_between, offset is then ignored)
+    """
+    if (start_date is not None) or (end_date is not None):
+      return self.pull_events_between(mbid, seed_type, not_none(start_date, datetime.date.min), \
+        not_none(end_date, datetime.date.max), limit=limit)
     events = []
     page = 1
     result = self.pull_page(mbid, seed_type, limit, offset)
@@ -360,12 +860,108 @@ class MusicBrainzPuller:
       events += events_list
     return events
 
+  def pull_events_between(self, mbid, seed_type, start_date, end_date, limit=100):
+    """
+    Return list of raw events of an artist or venue dated between start_date and end_date
+
+    MusicBrainz browses events in date order (undated ones last), so pages that are entirely before
+    start_date are skipped with a binary search over offsets, and paging stops at the first page
+    reaching past end_date. Pulled pages are kept in sync_store (if any), so later calls only pull
+    the pages after the last one stored, and nothing at all if the seed was synced less than
+    sync_max_age seconds ago and the stored pages already reach past end_date. Pages are taken from
+    the response cache only if they are less than sync_max_age seconds old too, so a sync doesn't
+    miss events added since
+    """
+    sync_store = self.sync_store if self.sync_store else SyncStore(':memory:')
+    state = sync_store.get_state('musicbrainz', seed_type, mbid)
+    probed_pages = {}
+    if (state is None) or (start_date.isoformat() < state['synced_from']):
+      state, probed_pages = self.start_sync(sync_store, mbid, seed_type, start_date, limit)
+    for attempt in range(2):
+      recent = time.time() - state['synced_at'] < self.sync_max_age
+      covered = state['complete'] or (not_none(state['synced_through'], '') > end_date.isoformat())
+      if recent and covered and not probed_pages:
+        break
+      offset = state['next_offset']
+      overlap = None
+      if (offset > state['first_offset']) and not probed_pages:
+        # Pull again from the last stored event, to check that nothing was added or removed before it
+        offset -= 1
+        overlap = sync_store.event_at('musicbrainz', seed_type, mbid, offset)
+      shifted = False
+      while True:
+        result = probed_pages.pop(offset, None) or \
+          self.pull_page(mbid, seed_type, limit, offset, max_age=self.sync_max_age)
+        events_list = result['event-list']
+        if overlap is not None:
+          shifted = (len(events_list) == 0) or (events_list[0]['id'] != overlap['id'])
+          overlap = None
+          if shifted:
+            break
+        event_dates = [mb_event_date(mb_event) for mb_event in events_list]
+        complete = len(events_list) < limit # last page should have less than the limit
+        last_date = date_sort_key(event_dates[-1]).isoformat() if events_list else None
+        sync_store.add_page('musicbrainz', seed_type, mbid, offset, events_list, \
+          [None if x is None else x.isoformat() for x in event_dates], complete, last_date)
+        offset += len(events_list)
+        if complete or (last_date > end_date.isoformat()):
+          break
+      if (shifted or (complete and (result.get('event-count', offset) != offset))) and (attempt == 0):
+        # Events were added or removed before the stored offset, so the stored pages are shifted
+        state, probed_pages = self.start_sync(sync_store, mbid, seed_type, start_date, limit)
+      else:
+        break
+    events = []
+    seen_ids = set()
+    for mb_event in sync_store.events('musicbrainz', seed_type, mbid, \
+      start_date.isoformat(), end_date.isoformat()):
+      if mb_event['id'] not in seen_ids:
+        seen_ids.add(mb_event['id'])
+        events.append(mb_event)
+    return events
+
+  def start_sync(self, sync_store, mbid, seed_type, start_date, limit):
+    """
+    Reset the seed in sync_store to start from the first page that can have events on or after
+    start_date, found by binary search. Return the new sync state and dictionary of the pages
+    pulled along the way by offset
+    """
+    pages = {0: self.pull_page(mbid, seed_type, limit, 0, max_age=self.sync_max_age)}
+    n_pages = -(-pages[0].get('event-count', 0)//limit)
+
+    def page_end(page):
+      offset = page*limit
+      if offset not in pages:
+        pages[offset] = self.pull_page(mbid, seed_type, limit, offset, max_age=self.sync_max_age)
+      events_list = pages[offset]['event-list']
+      if len(events_list) == 0:
+        return datetime.date.max
+      return date_sort_key(mb_event_date(events_list[-1]))
+
+    low, high = 0, max(n_pages - 1, 0)
+    while low < high:
+      middle = (low + high)//2
+      if page_end(middle) < start_date:
+        low = middle + 1
+      else:
+        high = middle
+    first_offset = low*limit
+    synced_from = start_date if low > 0 else datetime.date.min
+    sync_store.reset('musicbrainz', seed_type, mbid, first_offset, synced_from.isoformat())
+    # Only the first stored page is reused, the other probes were before it or will be pulled again
+    probed_pages = {first_offset: pages[first_offset]} if first_offset in pages else {}
+    return sync_store.get_state('musicbrainz', seed_type, mbid), probed_pages
+
 #####################
 
 def merge_event_lists(events1, events2, venue_mapper):
   """
   Combine two event lists, merging Event objects that describe same event
 
+  Events in events2 are indexed by MBID, by Setlist.fm ID and by (date, artist), so each event in
+  events1 is only compared with the events it could match rather than with all of events2. Matches
+  are still merged in the same order as comparing every pair would, so the output is the same
+
   Keyword arguments:
   events1, events2 -- lists of Event objects to merge
   venue_mapper -- instance of class VenueMapper to update with any new venue mappings found
@@ -375,14 +971,46 @@ def merge_event_lists(events1, events2, venue_mapper):
   elif len(events2) == 0:
     return events1
   else:
+    indexes = dict(mbid={}, slid={}, date={}, date_artist={}, no_artists_date={})
+
+    def index_keys(ev):
+      keys = [('mbid', ev.id['mbid']), ('slid', ev.id['slid']), ('date', ev.time)]
+      if len(ev.artists) == 0:
+        keys.append(('no_artists_date', ev.time))
+      for artist in ev.artists:
+        keys.append(('date_artist', (ev.time, artist.to_tuple())))
+      return keys
+
+    def lookup(index_name, key):
+      return indexes[index_name].get(key, set())
+
+    for i, ev2 in enumerate(events2):
+      for index_name, key in index_keys(ev2):
+        indexes[index_name].setdefault(key, set()).add(i)
+
     filtered_events1 = []
     merged_count = 0
     for ev1 in events1:
       found_dupe = False
-      for ev2 in events2:
+      candidates = lookup('mbid', ev1.id['mbid']) | lookup('slid', ev1.id['slid'])
+      if len(ev1.artists) == 0: # empty artist set is a subset of any other
+        candidates = candidates | lookup('date', ev1.time)
+      else:
+        candidates = candidates | lookup('no_artists_date', ev1.time)
+        for artist in ev1.artists:
+          candidates = candidates | lookup('date_artist', (ev1.time, artist.to_tuple()))
+      for i in sorted(candidates):
+        ev2 = events2[i]
         if ev2.same_event(ev1):
           found_dupe = True
+          old_keys = index_keys(ev2)
           ev2.merge_with(ev1) # update ev2 in place with values from ev1
+          new_keys = index_keys(ev2)
+          if new_keys != old_keys: # IDs or artists filled in from ev1
+            for index_name, key in old_keys:
+              indexes[index_name][key].discard(i)
+            for index_name, key in new_keys:
+              indexes[index_name].setdefault(key, set()).add(i)
           merged_count += 1
           v2_mbid = ev2.venue.id['mbid']
           v2_slid = ev2.venue.id['slid']
@@ -391,37 +1019,64 @@ def merge_event_lists(events1, events2, venue_mapper):
             venue_mapper.add_venue(ev2.venue.id['mbid'], ev2.venue)
             venue_mapper.add_venue(ev2.venue.id['slid'], ev2.venue)
       if not found_dupe:
-        v1_id = not_none(ev1.venue.id['mbid'], ev1.venue.id['slid'])
         filtered_events1.append(ev1)
     print("Merged {} events".format(merged_count))
     return filtered_events1 + events2
 
-def get_mb_and_sl_events(mbid, mb_event_puller, sl_event_puller, venue_mapper, \
-  start_date, end_date, seed_type="artist", slid=None, sl_page_limit=5):
+def pull_mb_and_sl_events(mbid, mb_event_puller, sl_event_puller, seed_type="artist", \
+  slid=None, sl_page_limit=5, start_date=None, end_date=None):
   """
-  Pull entity's events from MusicBrainz and Setlist.fm and apply venue mappings when applicable. 
-  Attempt to merge events that occur in both, return list of Event objects and summary text
+  Pull entity's raw events from MusicBrainz and Setlist.fm without parsing or merging them. Return
+  dictionary with the raw MusicBrainz events, the raw Setlist.fm events (None if that source was
+  not queried) and whether the Setlist.fm pull failed. Does not touch any VenueMapper, so it is safe
+  to call from several threads at once
 
   Keyword arguments:
   mbid -- the MusicBrainz ID of the artist or venue for which to pull events
   mb_event_puller -- instance of class MusicBrainzPuller
   sl_event_puller -- instance of class SetlistPuller
-  venue_mapper -- instance of class VenueMapper
-  start_date, end_date -- range of dates for events to return (type datetime.date)
   seed_type -- type of entity to pull events for ("artist" or "venue", default "artist")
   slid -- Setlist.fm ID of the venue to pull events for, if seed_type is "venue" (default None)
-  sl_page_limit -- maximum number of results pages to pull from Setlist.fm (default 5)
+  sl_page_limit -- maximum number of results pages to pull from Setlist.fm, None for no cap (default 5)
+  start_date, end_date -- range of dates of the events to pull (type datetime.date, default None,
+  pull them all); Setlist.fm pulls stop at start_date
   """
-  valid_mb_events = []
-  valid_sl_events = []
-  message = ""
+  pulled = dict(mb_events=None, sl_events=None, sl_error=False)
   if seed_type=='artist':
     sl_seed_id = mbid
   else:
     sl_seed_id = slid # only use Setlist.fm ID when pulling venue events
   if mbid:
-    mb_events = mb_event_puller.pull_events(mbid=mbid, seed_type=seed_type)
-    for mb_event in mb_events:
+    pulled['mb_events'] = mb_event_puller.pull_events(mbid=mbid, seed_type=seed_type, \
+      start_date=start_date, end_date=end_date)
+  if sl_seed_id: 
+    # Venue pulls only refine the recommendations, so they are the first to be dropped near the quota
+    priority = LOW_PRIORITY if seed_type == 'venue' else HIGH_PRIORITY
+    try:
+      pulled['sl_events'] = sl_event_puller.pull_events(seed_id=sl_seed_id, seed_type=seed_type, \
+        limit=sl_page_limit, priority=priority, start_date=start_date)
+    except SetlistAPIError:
+      pulled['sl_error'] = True
+      print("Issue pulling Setlist events - will use MusicBrainz only")
+  return pulled
+
+def process_pulled_events(pulled, venue_mapper, start_date, end_date, sl_page_limit=5):
+  """
+  Convert raw events returned by pull_mb_and_sl_events to Event objects, apply venue mappings when
+  applicable and merge events that occur in both sources. Return list of Event objects and summary text
+
+  Keyword arguments:
+  pulled -- dictionary returned by pull_mb_and_sl_events
+  venue_mapper -- instance of class VenueMapper
+  start_date, end_date -- range of dates for events to return (type datetime.date)
+  sl_page_limit -- maximum number of results pages pulled from Setlist.fm, for summary text, None if
+  there was no cap (default 5)
+  """
+  valid_mb_events = []
+  valid_sl_events = []
+  message = ""
+  if pulled['mb_events'] is not None:
+    for mb_event in pulled['mb_events']:
       event = Event()
       event.load_from_mb_event(mb_event)
       if event.valid_date(start_date, end_date):
@@ -432,28 +1087,191 @@ def get_mb_and_sl_events(mbid, mb_event_puller, sl_event_puller, venue_mapper, \
     message = "Retrieved {} MusicBrainz events between {} and {}. ".format(\
       len(valid_mb_events), start_date, end_date)
 
-  if sl_seed_id: 
-    try:
-      sl_events = sl_event_puller.pull_events(\
-        seed_id=sl_seed_id, seed_type=seed_type, limit=sl_page_limit)
-      for sl_event in sl_events:
-        event = Event()
-        event.load_from_sl_event(sl_event)
-        if event.valid_date(start_date, end_date):
-          if venue_mapper.has_id(event.venue.id['slid']):
-            event.set_venue(venue_mapper.get_venue(event.venue.id['slid']))
-          valid_sl_events.append(event)
-      message = message + "Retrieved {} Setlist events between {} and {},".format(\
-        len(valid_sl_events), start_date, end_date)
-      message = message + " limited to the {} most recent. ".format(sl_page_limit*20)
-    except SetlistAPIError:
-      message = message + "Setlist daily query limit reached, so no events pulled. "
-      print("Issue pulling Setlist events - will use MusicBrainz only")
-      pass
+  if pulled['sl_error']:
+    message = message + "Setlist daily query limit reached, so no events pulled. "
+  elif pulled['sl_events'] is not None:
+    for sl_event in pulled['sl_events']:
+      event = Event()
+      event.load_from_sl_event(sl_event)
+      if event.valid_date(start_date, end_date):
+        if venue_mapper.has_id(event.venue.id['slid']):
+          event.set_venue(venue_mapper.get_venue(event.venue.id['slid']))
+        valid_sl_events.append(event)
+    message = message + "Retrieved {} Setlist events between {} and {}".format(\
+      len(valid_sl_events), start_date, end_date)
+    # Pulls stop at start_date, so only a full set of pages means older events may be missing
+    if (sl_page_limit is not None) and (len(pulled['sl_events']) >= sl_page_limit*20):
+      message = message + ", limited to the {} most recent. ".format(sl_page_limit*20)
+    else:
+      message = message + ". "
   print("Retrieved {} MB events, {} SL events".format(len(valid_mb_events), len(valid_sl_events)))
   valid_events = merge_event_lists(valid_mb_events, valid_sl_events, venue_mapper)
   return valid_events, message
 
+def get_mb_and_sl_events(mbid, mb_event_puller, sl_event_puller, venue_mapper, \
+  start_date, end_date, seed_type="artist", slid=None, sl_page_limit=5):
+  """
+  Pull entity's events from MusicBrainz and Setlist.fm and apply venue mappings when applicable. 
+  Attempt to merge events that occur in both, return list of Event objects and summary text
+
+  Keyword arguments:
+  mbid -- the MusicBrainz ID of the artist or venue for which to pull events
+  mb_event_puller -- instance of class MusicBrainzPuller
+  sl_event_puller -- instance of class SetlistPuller
+  venue_mapper -- instance of class VenueMapper
+  start_date, end_date -- range of dates for events to return (type datetime.date)
+  seed_type -- type of entity to pull events for ("artist" or "venue", default "artist")
+  slid -- Setlist.fm ID of the venue to pull events for, if seed_type is "venue" (default None)
+  sl_page_limit -- maximum number of results pages to pull from Setlist.fm, None for no cap (default 5)
+  """
+  pulled = pull_mb_and_sl_events(mbid, mb_event_puller, sl_event_puller, \
+    seed_type=seed_type, slid=slid, sl_page_limit=sl_page_limit, \
+    start_date=start_date, end_date=end_date)
+  return process_pulled_events(pulled, venue_mapper, start_date, end_date, \
+    sl_page_limit=sl_page_limit)
+
+class LRUCache:
+  """
+  Small thread-safe least-recently-used cache with optional time-to-live, for objects that are
+  expensive to rebuild but only valid in this process
+
+  Keyword arguments:
+  maxsize -- maximum number of entries (default 32)
+  ttl -- seconds after which an entry is treated as missing (default None, never expires)
+  """
+  def __init__(self, maxsize=32, ttl=None):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self.lock:
+      if key not in self.entries:
+        return default
+      value, stored_at = self.entries[key]
+      if (self.ttl is not None) and (time.time() - stored_at > self.ttl):
+        del self.entries[key]
+        return default
+      self.entries.move_to_end(key)
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = (value, time.time())
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+  def get_or_create(self, key, create):
+    value = self.get(key)
+    if value is None:
+      value = create()
+      self.put(key, value)
+    return value
+
+class ArtistRecommender:
+  """
+  Shared-venue recommendations from a sparse artist x venue incidence matrix, built from a
+  DataFrame of venue events
+
+  Keyword arguments:
+  df -- pandas DataFrame of events with columns artist_mbid, artist_name, venue_mbid, venue_slid
+  """
+  def __init__(self, df):
+    df = df[df['artist_mbid'].notna() & df['artist_name'].notna()]
+    # Artist codes follow the sorted (mbid, name) order that groupby used, which breaks score ties
+    self.artist_codes = df.groupby(['artist_mbid', 'artist_name'], sort=True).ngroup().to_numpy()
+    artists = df[['artist_mbid', 'artist_name']].drop_duplicates().sort_values(['artist_mbid', 'artist_name'])
+    self.artist_mbids = artists['artist_mbid'].to_numpy()
+    self.artist_names = artists['artist_name'].to_numpy()
+    venue_keys = df['venue_mbid'].fillna('').astype(str) + '|' + df['venue_slid'].fillna('').astype(str)
+    self.venue_codes, _ = pd.factorize(venue_keys)
+    n_artists = len(self.artist_mbids)
+    n_venues = self.venue_codes.max() + 1 if len(self.venue_codes) > 0 else 0
+    incidence = scipy.sparse.csr_matrix((np.ones(len(self.artist_codes)), \
+      (self.artist_codes, self.venue_codes)), shape=(n_artists, n_venues))
+    incidence.sum_duplicates()
+    incidence.data[:] = 1 # count each venue once per artist
+    self.incidence = incidence
+    self.artist_degree = np.diff(incidence.indptr) # number of unique venues per artist
+
+  def recommend(self, query_id, n_recs=10):
+    """
+    Return DataFrame with columns id, Artist and Shared Venues for the n_recs artists other than the
+    query artist that have performed at the most (unique) venues
+
+    Keyword arguments:
+    query_id -- MBID of query artist (ensures that query artist not in list of recommendations)
+    n_recs -- number of recommended artists to return (default 10)
+    """
+    scores = self.artist_degree
+    candidates = np.flatnonzero(self.artist_mbids != query_id)
+    k = min(n_recs, len(candidates))
+    if k > 0:
+      # Partial sort: only the top k candidates get fully ordered. argpartition picks arbitrarily
+      # among artists tied with the k-th score, so take those in artist order instead
+      kth_score = -np.partition(-scores[candidates], k - 1)[k - 1]
+      above = candidates[scores[candidates] > kth_score]
+      tied = candidates[scores[candidates] == kth_score][:k - len(above)]
+      top = np.concatenate([above, tied])
+      top = top[np.lexsort((top, -scores[top]))]
+    else:
+      top = candidates[:0]
+    return pd.DataFrame({'id': self.artist_mbids[top], 'Artist': self.artist_names[top], \
+      'Shared Venues': self.artist_degree[top]})
+
+class IncrementalRecommender:
+  """
+  Running version of ArtistRecommender's ranking, for venue events that arrive one batch
+  at a time. Keeps each artist's set of venues and the current top n_recs artists, so that adding a
+  venue's events only touches the artists who played there instead of ranking everyone again. Venue
+  counts only ever go up, so an artist can only enter the top n_recs when its own count changes
+
+  Keyword arguments:
+  query_id -- MBID of query artist (left out of the recommendations)
+  n_recs -- number of recommended artists to keep (default 10)
+  """
+  def __init__(self, query_id, n_recs=10):
+    self.query_id = query_id
+    self.n_recs = n_recs
+    self.artist_venues = {} # (artist MBID, artist name): set of venue keys
+    self.top = [] # (-shared venues, artist MBID, artist name), best first as in ArtistRecommender
+
+  def add_batch(self, batch):
+    """
+    Add the events of EventBatch and update the top artists
+    """
+    c = batch.columns
+    changed = set()
+    for artist_mbid, artist_name, venue_mbid, venue_slid in zip(c['artist_mbid'], c['artist_name'], \
+      c['venue_mbid'], c['venue_slid']):
+      if (artist_mbid is None) or (artist_name is None) or (artist_mbid == self.query_id):
+        continue
+      artist = (artist_mbid, artist_name)
+      venues = self.artist_venues.setdefault(artist, set())
+      venue_key = venue_key_string(venue_mbid, venue_slid)
+      if venue_key not in venues:
+        venues.add(venue_key)
+        changed.add(artist)
+    for artist in changed:
+      self.update_top(artist)
+
+  def update_top(self, artist):
+    entry = (-len(self.artist_venues[artist]),) + artist
+    self.top = [x for x in self.top if x[1:] != artist]
+    if (len(self.top) < self.n_recs) or (entry < self.top[-1]):
+      bisect.insort(self.top, entry)
+      del self.top[self.n_recs:]
+
+  def recommend(self):
+    """
+    Return list of dictionaries with keys id, Artist and Shared Venues for the top artists so far,
+    the same rows as ArtistRecommender.recommend on all the events added
+    """
+    return [{'id': artist_mbid, 'Artist': artist_name, 'Shared Venues': -neg_venues} \
+      for neg_venues, artist_mbid, artist_name in self.top]
+
 def get_basic_artist_rec_from_df(df, query_id, n_recs=10):
   """
   Generate DataFrame of artists in the event dataset that have performed at the most (unique) venues
@@ -464,23 +1282,22 @@ def get_basic_artist_rec_from_df(df, query_id, n_recs=10):
   n_recs -- number of recommended artists to return (default 10)
 
   """
-  df['venue_id'] = list(zip(df.venue_mbid, df.venue_slid))
-  df = df[df['artist_mbid'] != query_id]
-  grouped_df = df.groupby(['artist_mbid', 'artist_name']).agg({'venue_id':'nunique'})
-  top_artists = grouped_df.sort_values(by=['venue_id'], ascending=False).head(n=n_recs)
-  top_artists = top_artists.reset_index()
-  top_artists = top_artists.rename(columns={'artist_mbid':'id', 
-    'artist_name':'Artist', 
-    'venue_id':'Shared Venues'})
-  cols_to_return = ['id', 'Artist', 'Shared Venues']
-  top_artists = top_artists[cols_to_return]
-  return top_artists
+  return ArtistRecommender(df).recommend(query_id, n_recs=n_recs)
 
 def get_events_list(query_artist_events, mb_event_puller, sl_event_puller, venue_mapper, \
-  start_date, end_date, sl_page_limit):
+  start_date, end_date, sl_page_limit, max_workers=1, mb_max_concurrent=1, sl_max_concurrent=2, \
+  as_batch=False, event_index=None, index_max_age=7*24*3600, progress=None):
   """
   For each event in input list, pull all events held at venue; return list of events in standardized
-  (flattened) form
+  (flattened) form, or EventBatch of them if as_batch is True
+
+  With max_workers > 1 the venues are pulled in parallel from a thread pool. The venue keys are then
+  resolved against venue_mapper before any pull starts, and the pulled events are parsed, merged and
+  added to venue_mapper one venue at a time in input order, so the result does not depend on the
+  order in which the pulls finish.
+
+  With an event_index, venues it has seen recently enough are read from it instead of being pulled,
+  and the venues that are pulled are recorded in it.
 
   Keyword arguments:
   query_artist_events -- list of dictionary representations of events, expected to each have keys 
@@ -489,127 +1306,326 @@ def get_events_list(query_artist_events, mb_event_puller, sl_event_puller, venue
   sl_event_puller -- instance of class SetlistPuller
   venue_mapper -- instance of class VenueMapper
   start_date, end_date -- range of dates for events to return (type datetime.date)
-  sl_page_limit -- maximum number of results pages to pull from Setlist.fm
+  sl_page_limit -- maximum number of results pages to pull from Setlist.fm for each venue, None for
+  no cap (pulls stop at start_date either way)
+  max_workers -- number of venues to pull at the same time (default 1, i.e. one after another)
+  mb_max_concurrent -- maximum number of MusicBrainz pulls in flight at once (default 1)
+  sl_max_concurrent -- maximum number of Setlist.fm pulls in flight at once (default 2)
+  as_batch -- return EventBatch instead of list of dictionaries (default False)
+  event_index -- instance of class EventIndex (default None, pull every venue)
+  index_max_age -- seconds after which venues in event_index are pulled again (default 1 week)
+  progress -- function called after each venue with the number of venues done, the number of
+  venues and the venue's EventBatch (default None)
   """
+  if max_workers > 1:
+    return get_events_list_concurrent(query_artist_events, mb_event_puller, sl_event_puller, \
+      venue_mapper, start_date, end_date, sl_page_limit, max_workers=max_workers, \
+      mb_max_concurrent=mb_max_concurrent, sl_max_concurrent=sl_max_concurrent, as_batch=as_batch, \
+      event_index=event_index, index_max_age=index_max_age, progress=progress)
   venue_event_dict = {}
-  all_events = []
+  all_events = EventBatch()
+  n_venues = len(set(known_venue_key(event_dict, venue_mapper) for event_dict in query_artist_events)) \
+    if progress else 0
   for event_dict in query_artist_events:
-    event = Event()
-    event.from_dict(event_dict)
-    venue_id = not_none(event.venue.id['mbid'], event.venue.id['slid'])
-    if venue_mapper.has_id(venue_id):
-      event.set_venue(venue_mapper.get_venue(venue_id))
-    
-    venue_mbid = event.venue.id['mbid']
-    venue_slid = event.venue.id['slid']
-
-    new_events = []
-    new_key = (venue_mbid, venue_slid)
+    new_key = event_venue_key(event_dict, venue_mapper)
+    venue_mbid, venue_slid = new_key
     if new_key not in venue_event_dict:
-      new_events, message = get_mb_and_sl_events(venue_mbid, \
-        mb_event_puller, sl_event_puller, venue_mapper, \
-        start_date, end_date, seed_type="venue", slid=venue_slid, \
-        sl_page_limit=sl_page_limit)
-      venue_event_dict[new_key] = new_events
-      flattened_events = [x.flatten() for x in new_events]
-      all_events += flattened_events
-  all_events = [y for x in all_events for y in x]
-  return all_events
+      seed_key = venue_key_string(venue_mbid, venue_slid)
+      pulled = None # read from the index by venue_batch
+      if not (event_index and event_index.is_fresh('venue', seed_key, start_date, end_date, index_max_age)):
+        pulled = pull_mb_and_sl_events(venue_mbid, mb_event_puller, sl_event_puller, \
+          seed_type="venue", slid=venue_slid, sl_page_limit=sl_page_limit, \
+          start_date=start_date, end_date=end_date)
+      new_batch = venue_batch(pulled, seed_key, venue_mapper, start_date, end_date, sl_page_limit, \
+        event_index=event_index)
+      venue_event_dict[new_key] = new_batch
+      all_events.add_batch(new_batch)
+      if progress:
+        # Venues mapped during the pull (or matched to nearby ones) can change the number of keys, so
+        # the count is only an estimate up front
+        progress(len(venue_event_dict), max(n_venues, len(venue_event_dict)), new_batch)
+  if as_batch:
+    return all_events
+  return all_events.to_records()
+
+def known_venue_key(event_dict, venue_mapper):
+  """
+  Return (venue MBID, venue Setlist.fm ID) of the venue of an event's dictionary representation,
+  with existing venue mappings applied but without looking for nearby matches, which claim locator
+  entries and add mappings (see event_venue_key)
+  """
+  venue_ids = event_dict['venue']['id']
+  venue_id = not_none(venue_ids['mbid'], venue_ids['slid'])
+  if venue_mapper.has_id(venue_id):
+    venue_ids = venue_mapper.get_venue(venue_id).id
+  return (venue_ids['mbid'], venue_ids['slid'])
+
+def event_venue_key(event_dict, venue_mapper):
+  """
+  Return (venue MBID, venue Setlist.fm ID) of the venue of an event's dictionary representation,
+  with existing venue mappings (and venue_mapper's nearby matches) applied
+  """
+  event = Event()
+  event.from_dict(event_dict)
+  venue_id = not_none(event.venue.id['mbid'], event.venue.id['slid'])
+  if venue_mapper.has_id(venue_id):
+    event.set_venue(venue_mapper.get_venue(venue_id))
+  else:
+    event.set_venue(venue_mapper.match_nearby(event.venue))
+  return (event.venue.id['mbid'], event.venue.id['slid'])
+
+def get_venue_keys(query_artist_events, venue_mapper):
+  """
+  Return list of unique (venue MBID, venue Setlist.fm ID) pairs for the venues of the input events, 
+  in order of first appearance and with existing venue mappings (and venue_mapper's nearby matches,
+  see VenueMapper.set_locator) applied
+
+  Keyword arguments:
+  query_artist_events -- list of dictionary representations of events
+  venue_mapper -- instance of class VenueMapper
+  """
+  venue_keys = []
+  for event_dict in query_artist_events:
+    new_key = event_venue_key(event_dict, venue_mapper)
+    if new_key not in venue_keys:
+      venue_keys.append(new_key)
+  return venue_keys
+
+def venue_seeds(query_artist_events, venue_mapper, start_date, end_date, event_index=None, \
+  index_max_age=7*24*3600):
+  """
+  Return list of (venue MBID, venue Setlist.fm ID, seed key, whether to pull the venue) for the
+  venues of the input events, in the order of get_venue_keys. Venues that event_index has seen
+  recently enough are read from it instead of being pulled (see venue_batch)
+
+  Keyword arguments:
+  query_artist_events -- list of dictionary representations of events
+  venue_mapper -- instance of class VenueMapper
+  start_date, end_date -- range of dates for events to return (type datetime.date)
+  event_index -- instance of class EventIndex (default None, pull every venue)
+  index_max_age -- seconds after which venues in event_index are pulled again (default 1 week)
+  """
+  seeds = []
+  for venue_mbid, venue_slid in get_venue_keys(query_artist_events, venue_mapper):
+    seed_key = venue_key_string(venue_mbid, venue_slid)
+    fresh = event_index and event_index.is_fresh('venue', seed_key, start_date, end_date, index_max_age)
+    seeds.append((venue_mbid, venue_slid, seed_key, not fresh))
+  return seeds
+
+def venue_batch(pulled, seed_key, venue_mapper, start_date, end_date, sl_page_limit, event_index=None):
+  """
+  Return EventBatch of a venue's events, processed from pulled and recorded in event_index (if
+  given) and in venue_mapper's locator, or read from event_index if pulled is None
+
+  Keyword arguments:
+  pulled -- dictionary returned by pull_mb_and_sl_events for the venue, or None
+  seed_key -- venue's key in event_index (see venue_key_string)
+  venue_mapper -- instance of class VenueMapper
+  start_date, end_date -- range of dates for events to return (type datetime.date)
+  sl_page_limit -- maximum number of results pages pulled from Setlist.fm, see process_pulled_events
+  event_index -- instance of class EventIndex (default None)
+  """
+  if pulled is None:
+    return event_index.seed_batch('venue', seed_key, start_date, end_date)
+  new_events, message = process_pulled_events(pulled, venue_mapper, start_date, end_date, \
+    sl_page_limit=sl_page_limit)
+  new_batch = EventBatch.from_events(new_events)
+  if event_index:
+    event_index.record_seed('venue', seed_key, new_batch, start_date, end_date)
+  venue_mapper.locate_venues(new_batch)
+  return new_batch
+
+class BoundedPuller:
+  """
+  Wrap a MusicBrainzPuller or SetlistPuller so that at most max_concurrent calls to pull_events run 
+  at the same time, however many threads share it
+  """
+  def __init__(self, puller, max_concurrent):
+    self.puller = puller
+    self.semaphore = threading.BoundedSemaphore(max_concurrent)
+
+  def pull_events(self, *args, **kwargs):
+    with self.semaphore:
+      return self.puller.pull_events(*args, **kwargs)
+
+class CoalescingPuller:
+  """
+  Wrap a MusicBrainzPuller or SetlistPuller so that concurrent calls to pull_events for the same
+  seed and arguments (e.g. the same venue and date range, asked for by two users at once) share a
+  single pull, within this process and, through the SingleFlight's lock files, across processes
+
+  Keyword arguments:
+  puller -- instance of class MusicBrainzPuller or SetlistPuller
+  single_flight -- instance of class SingleFlight
+  source -- name of the puller's source, to keep keys apart ("musicbrainz" or "setlist")
+  """
+  def __init__(self, puller, single_flight, source):
+    self.puller = puller
+    self.single_flight = single_flight
+    self.source = source
+
+  def pull_events(self, *args, **kwargs):
+    key = ('seed', self.source) + tuple(str(x) for x in args) + \
+      tuple('{}={}'.format(k, kwargs[k]) for k in sorted(kwargs))
+    return self.single_flight.do(key, lambda: self.puller.pull_events(*args, **kwargs))
+
+def get_events_list_concurrent(query_artist_events, mb_event_puller, sl_event_puller, venue_mapper, \
+  start_date, end_date, sl_page_limit, max_workers=8, mb_max_concurrent=1, sl_max_concurrent=2, \
+  as_batch=False, event_index=None, index_max_age=7*24*3600, progress=None):
+  """
+  Same as get_events_list, but pull the venues in parallel from a pool of max_workers threads, with
+  separate caps on the number of MusicBrainz and Setlist.fm pulls in flight. Only the network pulls 
+  run in the pool; events are processed and venue_mapper is updated in venue order in this thread
+
+  Keyword arguments:
+  query_artist_events -- list of dictionary representations of events
+  mb_event_puller -- instance of MusicBrainzPuller class
+  sl_event_puller -- instance of class SetlistPuller
+  venue_mapper -- instance of class VenueMapper
+  start_date, end_date -- range of dates for events to return (type datetime.date)
+  sl_page_limit -- maximum number of results pages to pull from Setlist.fm for each venue, None for
+  no cap (pulls stop at start_date either way)
+  max_workers -- number of venues to pull at the same time (default 8)
+  mb_max_concurrent -- maximum number of MusicBrainz pulls in flight at once (default 1)
+  sl_max_concurrent -- maximum number of Setlist.fm pulls in flight at once (default 2)
+  as_batch -- return EventBatch instead of list of dictionaries (default False)
+  event_index -- instance of class EventIndex (default None, pull every venue)
+  index_max_age -- seconds after which venues in event_index are pulled again (default 1 week)
+  progress -- function called after each venue with the number of venues done, the number of
+  venues and the venue's EventBatch (default None)
+  """
+  seeds = venue_seeds(query_artist_events, venue_mapper, start_date, end_date, event_index=event_index, \
+    index_max_age=index_max_age)
+  bounded_mb_puller = BoundedPuller(mb_event_puller, mb_max_concurrent)
+  bounded_sl_puller = BoundedPuller(sl_event_puller, sl_max_concurrent)
+  all_events = EventBatch()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = []
+    for venue_mbid, venue_slid, seed_key, pull in seeds:
+      futures.append(executor.submit(pull_mb_and_sl_events, venue_mbid, \
+        bounded_mb_puller, bounded_sl_puller, seed_type="venue", slid=venue_slid, \
+        sl_page_limit=sl_page_limit, start_date=start_date, end_date=end_date) if pull else None)
+    # Collect in submission order rather than completion order to keep output deterministic
+    for i, (future, (venue_mbid, venue_slid, seed_key, pull)) in enumerate(zip(futures, seeds)):
+      new_batch = venue_batch(None if future is None else future.result(), seed_key, venue_mapper, \
+        start_date, end_date, sl_page_limit, event_index=event_index)
+      all_events.add_batch(new_batch)
+      if progress:
+        progress(i + 1, len(seeds), new_batch)
+  if as_batch:
+    return all_events
+  return all_events.to_records()
 
 def generate_artist_events_map(query_artist_events, query_mbid, default_map_figure):
   """
   Create geographical plot of query artist events with lat/long data,
   return plot object, number of events plotted, and text summarizing events not
-  plotted
+  plotted. Events are split into mappable and non-mappable ones and grouped by
+  venue in a single pass
 
   Keyword arguments:
   query_artist_events -- list of Event objects
   query_mbid -- MBID of artist whose events we want to plot
+  default_map_figure -- figure to return if no events can be plotted
   """
-  std_events = [event.flatten() for event in query_artist_events]
-  std_events =  [y for x in std_events for y in x if \
-    y['artist_mbid'] == query_mbid]
-
-  query_artist_name = std_events[0]['artist_name']
-  mappable_events = [event for event in std_events if \
-    (event['venue_lat'] is not None) or (event['city_lat'] is not None)]
-  non_mappable_events = [event for event in std_events if \
-    event not in mappable_events]
-  
-  non_mappable_text = ["{artist} @ {venue} ({date})".format(date=str(x['time']), \
-      artist=x['artist_name'], venue=not_none(x['venue_mbname'], x['venue_slname'])) \
-      for x in non_mappable_events]
-  non_mappable_text = "; ".join(non_mappable_text)
-
-  if len(mappable_events) > 0:
-    for event in mappable_events:
-      event['url'] = not_none(event['event_slurl'], event['event_mburl'])
-      if event['venue_lat']: #not None
-          event['venue_name'] = event['venue_mbname']
-          event['coord_type'] = 'venue'
-          event['lat'] = event['venue_lat']
-          event['lon'] = event['venue_long']
+  venue_texts = {} # (venue name, venue IDs, lat, lon, coordinate type): event texts, in event order
+  mappable_count = 0
+  non_mappable_text = []
+  for event in query_artist_events:
+    for std_event in event.flatten():
+      if std_event['artist_mbid'] != query_mbid:
+        continue
+      if std_event['venue_lat'] is not None:
+        venue_name = not_none(std_event['venue_mbname'], std_event['venue_slname'])
+        key = (venue_name, (not_none(std_event['venue_mbid'], ''), not_none(std_event['venue_slid'], '')), \
+          std_event['venue_lat'], std_event['venue_long'], 'venue')
+      elif std_event['city_lat'] is not None:
+        venue_name = not_none(std_event['venue_slname'], std_event['venue_mbname'])
+        key = (venue_name, (not_none(std_event['venue_mbid'], ''), not_none(std_event['venue_slid'], '')), \
+          std_event['city_lat'], std_event['city_long'], not_none(std_event['city_name'], 'city'))
       else:
-          event['venue_name'] = event['venue_slname']
-          event['coord_type'] = event['city_name']
-          event['lat'] = event['city_lat']
-          event['lon'] = event['city_long']
-
-    df = pd.DataFrame(mappable_events)
-    df['text'] = df['artist_name'] + ' @ ' + df['venue_name'] + \
-        ' (' + df['time'].apply(lambda x: str(x)) + ')'
-
-    df['venue_mbid'] = df['venue_mbid'].fillna('')
-    df['venue_slid'] = df['venue_slid'].fillna('')
-    df['venue_id'] = list(zip(df.venue_mbid, df.venue_slid))
-    df_grouped = df.groupby(['venue_name', 'venue_id', 'lat', 'lon', 'coord_type'])
-    events_by_venue_text = df_grouped['text'].agg(lambda x:'<br>'.join(x))
-    events_by_venue = events_by_venue_text.reset_index()
-    events_by_venue['text'] = events_by_venue['text'] + '<br>Mapped using '+ \
-      events_by_venue['coord_type'] + ' coordinates.' 
-      #LightSeaGreen
-    fig = go.Figure(data=go.Scattergeo(
-        lon = events_by_venue['lon'],
-        lat = events_by_venue['lat'],
-        text = events_by_venue['text'],
-        hoverinfo = 'text',
-        customdata = events_by_venue[['venue_name', 'venue_id']].apply(tuple, axis=1),
-        mode = 'markers',
-        marker = dict(color="LightSeaGreen", size=8, opacity=0.6, symbol='star',
-          line=dict(width=2, color='DarkSlateGrey'))
-        ), 
-      layout=go.Layout(autosize=True, margin=go.layout.Margin(l=0, r=0, t=0, b=0),
-        showlegend=False))
-    fig.update_geos(showcountries=True)
-    return fig, len(mappable_events), non_mappable_text
-  else:
-      return default_map_figure, 0, non_mappable_text
+        non_mappable_text.append("{artist} @ {venue} ({date})".format(date=str(std_event['time']), \
+          artist=std_event['artist_name'], \
+          venue=not_none(std_event['venue_mbname'], std_event['venue_slname'])))
+        continue
+      venue_texts.setdefault(key, []).append("{artist} @ {venue} ({date})".format(\
+        artist=std_event['artist_name'], venue=venue_name, date=str(std_event['time'])))
+      mappable_count += 1
+  non_mappable_text = "; ".join(non_mappable_text)
 
-def get_more_artist_info(mbid):
+  if mappable_count == 0:
+    return default_map_figure, 0, non_mappable_text
+
+  # Markers in the order the earlier groupby gave them, by venue name, IDs, coordinates and type
+  venue_keys = sorted(venue_texts, key=lambda key: (not_none(key[0], ''),) + key[1:])
+  #LightSeaGreen
+  fig = go.Figure(data=go.Scattergeo(
+      lon = [key[3] for key in venue_keys],
+      lat = [key[2] for key in venue_keys],
+      text = ['<br>'.join(venue_texts[key]) + '<br>Mapped using {} coordinates.'.format(key[4]) \
+        for key in venue_keys],
+      hoverinfo = 'text',
+      customdata = [(key[0], key[1]) for key in venue_keys],
+      mode = 'markers',
+      marker = dict(color="LightSeaGreen", size=8, opacity=0.6, symbol='star',
+        line=dict(width=2, color='DarkSlateGrey'))
+      ), 
+    layout=go.Layout(autosize=True, margin=go.layout.Margin(l=0, r=0, t=0, b=0),
+      showlegend=False))
+  fig.update_geos(showcountries=True)
+  return fig, mappable_count, non_mappable_text
+
+def fetch_artist_info(mbid):
+  # Area, life span and top 3 tags of an artist from MusicBrainz
   out_dict = dict(area=None, life_span=None, top_tags=[])
+  mb_info = musicbrainzngs.get_artist_by_id(mbid, includes=['tags'])
+  mb_info = mb_info['artist']
+  if 'area' in mb_info:
+    out_dict['area'] = mb_info['area']['name']
+  if 'life-span' in mb_info:
+    life_span = mb_info['life-span']
+    begin = ''
+    end = ''
+    if 'begin' in life_span:
+      begin = life_span['begin']
+    if 'end' in life_span:
+      end = life_span['end']
+    out_dict['life_span'] = '{} - {}'.format(begin, end)
+  if 'tag-list' in mb_info:
+    tag_dicts = mb_info['tag-list']
+    sorted_tag_list = sorted(tag_dicts, key = lambda i: -int(i['count'])) 
+    sorted_tag_list = [x['name'] for x in sorted_tag_list] 
+    out_dict['top_tags'] = sorted_tag_list[:3]
+  return out_dict
+
+def get_more_artist_info(mbid, cache=None, rate_limiter=None, single_flight=None, \
+  priority=HIGH_PRIORITY):
+  """
+  Return dictionary with the area, life span and top 3 tags of an artist on MusicBrainz (None and
+  an empty list where unknown or if the lookup failed)
+
+  Keyword arguments:
+  mbid -- MBID of artist
+  cache -- instance of response_cache.ResponseCache to keep the details in (default None)
+  rate_limiter -- instance of rate_limiting.TokenBucket for MusicBrainz (default None)
+  single_flight -- instance of class SingleFlight, so that a click and a prefetch of the same artist
+  only look it up once (default None)
+  priority -- rate limiter priority, LOW_PRIORITY for prefetching (default HIGH_PRIORITY)
+  """
+  def fetch():
+    if rate_limiter:
+      rate_limiter.acquire(priority)
+    return fetch_artist_info(mbid)
+
+  get_info = fetch
+  if cache:
+    get_info = lambda: cache.get_or_fetch('artist_info', 'artist', mbid, 0, fetch)
   try:
-    mb_info = musicbrainzngs.get_artist_by_id(mbid, includes=['tags'])
-    mb_info = mb_info['artist']
-    if 'area' in mb_info:
-      out_dict['area'] = mb_info['area']['name']
-    if 'life-span' in mb_info:
-      life_span = mb_info['life-span']
-      begin = ''
-      end = ''
-      if 'begin' in life_span:
-        begin = life_span['begin']
-      if 'end' in life_span:
-        end = life_span['end']
-      out_dict['life_span'] = '{} - {}'.format(begin, end)
-    if 'tag-list' in mb_info:
-      tag_dicts = mb_info['tag-list']
-      sorted_tag_list = sorted(tag_dicts, key = lambda i: -int(i['count'])) 
-      sorted_tag_list = [x['name'] for x in sorted_tag_list] 
-      out_dict['top_tags'] = sorted_tag_list[:3]
+    if single_flight:
+      return single_flight.do(('artist_info', mbid), get_info)
+    return get_info()
   except requests.HTTPError as err:
     print("HTTPError: {0}".format(err))
-    pass
   except musicbrainzngs.ResponseError as err:
     print("ResponseError: {0}".format(err))
-    pass
-  return out_dict
+  return dict(area=None, life_span=None, top_tags=[])
@@ -0,0 +1,168 @@
+import json
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+import multiprocessing
+import concurrent.futures
+
+#####################
+
+class JobQueue:
+  """
+  Background jobs run in a local pool of worker processes, with each job's status, progress and
+  result kept in a SQLite table, so that a web worker can poll a job whichever worker submitted it.
+  A job's function runs in the pool as func(job, *args), where job is a Job it can report progress
+  through; its return value (anything that converts to JSON) becomes the job's result
+
+  Running jobs are touched every stale_after/4 seconds while their function runs, however long it
+  goes without reporting progress. Jobs that are queued or running but haven't been updated for
+  stale_after seconds (e.g. because their worker process died, or the process that submitted them
+  was restarted) are marked as failed when next looked up
+
+  Keyword arguments:
+  filename -- SQLite database file, shared by every process that submits or polls jobs
+  max_workers -- number of jobs to run at the same time (default 2)
+  processes -- run jobs in worker processes rather than threads of this process (default True)
+  stale_after -- seconds without an update after which a job is treated as failed (default 600)
+  max_age -- seconds to keep finished jobs (default 1 day)
+  """
+  def __init__(self, filename, max_workers=2, processes=True, stale_after=600, max_age=24*3600):
+    self.filename = filename
+    self.max_workers = max_workers
+    self.processes = processes
+    self.stale_after = stale_after
+    self.max_age = max_age
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.pool = None # started on first submit, so that importing the app doesn't start processes
+    with self.connect() as conn:
+      conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+        job_id TEXT PRIMARY KEY, kind TEXT, status TEXT, progress INTEGER, total INTEGER, result TEXT,
+        error TEXT, created_at REAL, updated_at REAL)""")
+
+  def connect(self):
+    # sqlite3 connections can't be shared between threads, so keep one per thread
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.filename, timeout=30)
+      conn.execute("PRAGMA journal_mode=WAL")
+      self.local.conn = conn
+    return conn
+
+  def executor(self):
+    with self.lock:
+      if self.pool is None:
+        if self.processes:
+          # Spawn rather than fork: the web process has threads and open SQLite connections
+          self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers, \
+            mp_context=multiprocessing.get_context('spawn'))
+        else:
+          self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+      return self.pool
+
+  def submit(self, func, *args):
+    """
+    Queue func(job, *args) to run in the pool and return the new job's ID
+
+    Keyword arguments:
+    func -- module-level function (worker processes look it up by name)
+    args -- arguments for func, which have to be picklable when running in processes
+    """
+    self.cleanup()
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with self.connect() as conn:
+      conn.execute("INSERT INTO jobs VALUES (?, ?, 'queued', 0, NULL, NULL, NULL, ?, ?)", \
+        (job_id, func.__name__, now, now))
+    try:
+      future = self.executor().submit(run_job, self.filename, job_id, func, args, self.stale_after/4)
+    except concurrent.futures.process.BrokenProcessPool:
+      # A worker process died; its jobs fail, but later ones get a new pool
+      with self.lock:
+        self.pool = None
+      future = self.executor().submit(run_job, self.filename, job_id, func, args, self.stale_after/4)
+
+    def record_pool_error(future):
+      # run_job records the function's own errors, so this only catches the pool failing
+      if future.exception() is not None:
+        self.update(job_id, status='failed', error=repr(future.exception()))
+
+    future.add_done_callback(record_pool_error)
+    return job_id
+
+  def update(self, job_id, **fields):
+    """
+    Set the given fields (status, progress, total, result, error) of a job
+    """
+    if 'result' in fields:
+      fields['result'] = json.dumps(fields['result'])
+    fields['updated_at'] = time.time()
+    names = sorted(fields)
+    with self.connect() as conn:
+      conn.execute("UPDATE jobs SET {} WHERE job_id=?".format(', '.join(x + '=?' for x in names)), \
+        [fields[x] for x in names] + [job_id])
+
+  def get(self, job_id):
+    """
+    Return dictionary with the job's kind, status ("queued", "running", "done" or "failed"),
+    progress, total, result and error, or None if there is no such job
+    """
+    with self.connect() as conn:
+      row = conn.execute("""SELECT kind, status, progress, total, result, error, updated_at FROM jobs
+        WHERE job_id=?""", (job_id,)).fetchone()
+    if row is None:
+      return None
+    job = dict(kind=row[0], status=row[1], progress=row[2], total=row[3], \
+      result=None if row[4] is None else json.loads(row[4]), error=row[5])
+    if (job['status'] in ('queued', 'running')) and (time.time() - row[6] > self.stale_after):
+      job['status'], job['error'] = 'failed', 'Job stopped responding'
+      self.update(job_id, status=job['status'], error=job['error'])
+    return job
+
+  def cleanup(self):
+    with self.connect() as conn:
+      conn.execute("DELETE FROM jobs WHERE updated_at < ?", (time.time() - self.max_age,))
+
+  def shutdown(self, wait=True):
+    with self.lock:
+      pool, self.pool = self.pool, None
+    if pool is not None:
+      pool.shutdown(wait=wait)
+
+class Job:
+  """
+  Handle passed to a running job's function, to report its progress (and partial results) through
+  """
+  def __init__(self, queue, job_id):
+    self.queue = queue
+    self.job_id = job_id
+
+  def update(self, **fields):
+    self.queue.update(self.job_id, **fields)
+
+def run_job(filename, job_id, func, args, heartbeat_interval=150):
+  # Runs in the pool, with its own connection to the jobs table
+  queue = JobQueue(filename, processes=False)
+  queue.update(job_id, status='running')
+  stopped = threading.Event()
+
+  def heartbeat():
+    # Only moves updated_at, so a long step without progress isn't taken for a dead job
+    while not stopped.wait(heartbeat_interval):
+      queue.update(job_id)
+
+  heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+  heartbeat_thread.start()
+  try:
+    result = func(Job(queue, job_id), *args)
+  except Exception as err:
+    traceback.print_exc()
+    fields = dict(status='failed', error=str(err) or repr(err))
+  else:
+    fields = dict(status='done', result=result)
+  finally:
+    stopped.set()
+    heartbeat_thread.join()
+  queue.update(job_id, **fields)
@@ -0,0 +1,204 @@
+import json
+import threading
+import time
+import datetime
+
+try:
+  import fcntl
+except ImportError: # not available on Windows; state is then only shared between threads
+  fcntl = None
+
+HIGH_PRIORITY = 'high'
+LOW_PRIORITY = 'low'
+
+# Published API limits: Setlist.fm standard keys get 2 requests/second and 1440 requests/day,
+# MusicBrainz asks for no more than 1 request/second on average
+SETLIST_LIMITS = dict(rate=2.0, capacity=2, daily_quota=1440, low_priority_reserve=288)
+MUSICBRAINZ_LIMITS = dict(rate=1.0, capacity=1, daily_quota=None, low_priority_reserve=0)
+
+#####################
+
+class QuotaExceededError(Exception):
+  pass
+
+#####################
+
+class MemoryState:
+  """
+  Bucket state kept in this process only, shared by all threads using the same TokenBucket
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.state = {}
+
+  def update(self, func):
+    with self.lock:
+      result, self.state = func(dict(self.state))
+      return result
+
+class FileState:
+  """
+  Bucket state kept in a small JSON file, locked with flock so that every process (e.g. each
+  gunicorn worker) using the same file draws from the same bucket
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.lock = threading.Lock()
+
+  def update(self, func):
+    with self.lock:
+      with open(self.filename, 'a+') as f:
+        if fcntl:
+          fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+          f.seek(0)
+          contents = f.read()
+          state = json.loads(contents) if contents else {}
+          result, state = func(state)
+          f.seek(0)
+          f.truncate()
+          json.dump(state, f)
+          f.flush()
+        finally:
+          if fcntl:
+            fcntl.flock(f, fcntl.LOCK_UN)
+      return result
+
+#####################
+
+class TokenBucket:
+  """
+  Token bucket rate limiter with adaptive backoff and an optional daily quota
+
+  Keyword arguments:
+  rate -- tokens added per second
+  capacity -- maximum number of tokens in the bucket (size of allowed bursts)
+  daily_quota -- maximum number of requests per (UTC) day, None for no quota
+  low_priority_reserve -- number of requests of the daily quota kept back for high priority requests;
+  low priority requests are refused once the remaining quota falls to this level
+  state_file -- JSON file used to share the bucket between processes, None to keep it in memory
+  min_backoff, max_backoff -- bounds in seconds of the backoff applied after rejected requests
+  """
+  def __init__(self, rate, capacity, daily_quota=None, low_priority_reserve=0, state_file=None, \
+    min_backoff=1.0, max_backoff=60.0):
+    self.rate = rate
+    self.capacity = capacity
+    self.daily_quota = daily_quota
+    self.low_priority_reserve = low_priority_reserve
+    self.min_backoff = min_backoff
+    self.max_backoff = max_backoff
+    if state_file is None:
+      self.state = MemoryState()
+    else:
+      self.state = FileState(state_file)
+
+  def _refill(self, state, now):
+    today = datetime.datetime.fromtimestamp(now, datetime.timezone.utc).date().isoformat()
+    if state.get('day') != today:
+      state['day'] = today
+      state['used'] = 0
+    last = state.get('last', now)
+    tokens = state.get('tokens', self.capacity)
+    state['tokens'] = min(self.capacity, tokens + (now - last)*self.rate)
+    state['last'] = now
+    state.setdefault('blocked_until', 0.0)
+    state.setdefault('backoff', 0.0)
+    return state
+
+  def try_acquire(self, priority=HIGH_PRIORITY):
+    """
+    Take a token if one is available. Return 0 on success, otherwise the number of seconds to wait
+    before trying again; raise QuotaExceededError if the daily quota does not allow the request
+    """
+    def take(state):
+      now = time.time()
+      state = self._refill(state, now)
+      if self.daily_quota is not None:
+        remaining = self.daily_quota - state['used']
+        reserve = self.low_priority_reserve if priority == LOW_PRIORITY else 0
+        if remaining <= reserve:
+          return None, state
+      if now < state['blocked_until']:
+        return state['blocked_until'] - now, state
+      if state['tokens'] >= 1:
+        state['tokens'] -= 1
+        state['used'] += 1
+        return 0, state
+      return (1 - state['tokens'])/self.rate, state
+    wait = self.state.update(take)
+    if wait is None:
+      raise QuotaExceededError("Daily quota used up for {} priority requests".format(priority))
+    return wait
+
+  def acquire(self, priority=HIGH_PRIORITY):
+    """
+    Block until a token is available; raise QuotaExceededError if the daily quota does not allow
+    the request
+    """
+    wait = self.try_acquire(priority)
+    while wait > 0:
+      time.sleep(wait)
+      wait = self.try_acquire(priority)
+
+  def backoff(self, retry_after=None):
+    """
+    Record a rejected request: block the bucket for retry_after seconds if the API said how long to
+    wait, otherwise for an exponentially growing backoff
+    """
+    def block(state):
+      now = time.time()
+      state = self._refill(state, now)
+      if retry_after is not None:
+        delay = float(retry_after)
+      else:
+        delay = min(self.max_backoff, max(self.min_backoff, state['backoff']*2))
+        state['backoff'] = delay
+      state['blocked_until'] = max(state['blocked_until'], now + delay)
+      state['tokens'] = 0
+      return delay, state
+    return self.state.update(block)
+
+  def success(self):
+    """
+    Record a successful request, shrinking the adaptive backoff
+    """
+    def relax(state):
+      state['backoff'] = state.get('backoff', 0.0)/2
+      if state['backoff'] < self.min_backoff:
+        state['backoff'] = 0.0
+      return None, state
+    self.state.update(relax)
+
+  def remaining_quota(self):
+    """
+    Return number of requests left in today's quota (None if there is no daily quota)
+    """
+    if self.daily_quota is None:
+      return None
+    return self.state.update(lambda state: \
+      (self.daily_quota - self._refill(state, time.time())['used'], state))
+
+def parse_retry_after(value):
+  """
+  Return number of seconds to wait from a Retry-After header value (either a number of seconds or
+  an HTTP date), or None if value is missing or unreadable
+  """
+  if value is None:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    retry_time = datetime.datetime.strptime(value, '%a, %d %b %Y %H:%M:%S GMT')
+  except ValueError:
+    return None
+  retry_time = retry_time.replace(tzinfo=datetime.timezone.utc)
+  now = datetime.datetime.now(datetime.timezone.utc)
+  return max(0.0, (retry_time - now).total_seconds())
+
+def setlist_rate_limiter(state_file=None):
+  return TokenBucket(state_file=state_file, **SETLIST_LIMITS)
+
+def musicbrainz_rate_limiter(state_file=None):
+  return TokenBucket(state_file=state_file, **MUSICBRAINZ_LIMITS)
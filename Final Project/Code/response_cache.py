@@ -0,0 +1,276 @@
+import asyncio
+import functools
+import json
+import sqlite3
+import threading
+import time
+
+# Past events rarely change, so pages can be kept for a long time; Setlist.fm pages shift whenever
+# a new setlist is added for the seed, so they are refreshed more often. Artist details (area, life
+# span and tags) change slowly too
+DEFAULT_TTLS = dict(musicbrainz=7*24*3600, setlist=24*3600, artist_info=3*24*3600)
+
+# Reading a page only moves its last access time if it is older than this, so that most reads don't
+# have to write; least recently used order only needs to be roughly right
+ACCESS_RESOLUTION = 600
+
+#####################
+
+class ResponseCache:
+  """
+  On-disk (SQLite) cache of API response pages keyed by (source, seed_type, seed_id, page), with a
+  time-to-live per source and a total size cap enforced by evicting the least recently used pages.
+  The total size is kept up to date by triggers in a one-row table, so checking it after each write
+  doesn't scan the cache. Safe to share between threads and between processes using the same file
+
+  Keyword arguments:
+  filename -- SQLite database file
+  ttls -- dictionary of source name to time-to-live in seconds (default DEFAULT_TTLS)
+  default_ttl -- time-to-live in seconds for sources not in ttls (default 1 day)
+  max_bytes -- maximum total size of the cached response bodies (default 200 MB)
+  """
+  def __init__(self, filename, ttls=None, default_ttl=24*3600, max_bytes=200*1024*1024):
+    self.filename = filename
+    self.ttls = dict(DEFAULT_TTLS) if ttls is None else ttls
+    self.default_ttl = default_ttl
+    self.max_bytes = max_bytes
+    self.local = threading.local()
+    self.stats_lock = threading.Lock()
+    self.counts = dict(hits=0, misses=0, stale_hits=0, refreshes=0, revalidations=0, evictions=0)
+    self.revalidating = set()
+    self.revalidation_tasks = set()
+    with self.connect() as conn:
+      # One transaction, so the size total starts from the pages of a cache made before it existed
+      conn.execute("BEGIN IMMEDIATE")
+      conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+        source TEXT, seed_type TEXT, seed_id TEXT, page TEXT, body TEXT, size INTEGER,
+        fetched_at REAL, accessed_at REAL, PRIMARY KEY (source, seed_type, seed_id, page))""")
+      conn.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (accessed_at)")
+      conn.execute("CREATE TABLE IF NOT EXISTS responses_size (total INTEGER)")
+      conn.execute("""INSERT INTO responses_size SELECT COALESCE(SUM(size), 0) FROM responses
+        WHERE NOT EXISTS (SELECT 1 FROM responses_size)""")
+      conn.execute("""CREATE TRIGGER IF NOT EXISTS responses_size_insert AFTER INSERT ON responses
+        BEGIN UPDATE responses_size SET total = total + new.size; END""")
+      conn.execute("""CREATE TRIGGER IF NOT EXISTS responses_size_delete AFTER DELETE ON responses
+        BEGIN UPDATE responses_size SET total = total - old.size; END""")
+
+  def connect(self):
+    # sqlite3 connections can't be shared between threads, so keep one per thread
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.filename, timeout=30)
+      conn.execute("PRAGMA journal_mode=WAL")
+      # INSERT OR REPLACE only fires the delete trigger for the replaced page with this on
+      conn.execute("PRAGMA recursive_triggers=ON")
+      self.local.conn = conn
+    return conn
+
+  def count(self, name):
+    with self.stats_lock:
+      self.counts[name] += 1
+
+  def ttl(self, source):
+    return self.ttls.get(source, self.default_ttl)
+
+  def get(self, source, seed_type, seed_id, page):
+    """
+    Return (response, fetched_at) for the cached page, or (None, None) if it isn't cached
+    """
+    key = (source, seed_type, str(seed_id), str(page))
+    with self.connect() as conn:
+      row = conn.execute("""SELECT body, fetched_at, accessed_at FROM responses WHERE source=?
+        AND seed_type=? AND seed_id=? AND page=?""", key).fetchone()
+      if row is None:
+        return None, None
+      now = time.time()
+      if now - row[2] > ACCESS_RESOLUTION:
+        conn.execute("""UPDATE responses SET accessed_at=? WHERE source=? AND seed_type=?
+          AND seed_id=? AND page=?""", (now,) + key)
+    return json.loads(row[0]), row[1]
+
+  def put(self, source, seed_type, seed_id, page, response):
+    body = json.dumps(response)
+    now = time.time()
+    with self.connect() as conn:
+      conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)", \
+        (source, seed_type, str(seed_id), str(page), body, len(body), now, now))
+      total = conn.execute("SELECT total FROM responses_size").fetchone()[0]
+    if total > self.max_bytes:
+      self.evict()
+
+  def evict(self):
+    """
+    Remove least recently used pages until the cache is back under max_bytes
+    """
+    with self.connect() as conn:
+      total = conn.execute("SELECT total FROM responses_size").fetchone()[0]
+      if total <= self.max_bytes:
+        return
+      # Only reads the least recently used pages it needs, through the index
+      rows = conn.execute("SELECT rowid, size FROM responses ORDER BY accessed_at")
+      evicted = []
+      for rowid, size in rows:
+        if total <= self.max_bytes:
+          break
+        evicted.append((rowid,))
+        total -= size
+      rows.close()
+      conn.executemany("DELETE FROM responses WHERE rowid=?", evicted)
+    with self.stats_lock:
+      self.counts['evictions'] += len(evicted)
+
+  def get_or_fetch(self, source, seed_type, seed_id, page, fetch, is_recent=False, should_store=None, \
+    max_age=None):
+    """
+    Return cached page if it is still fresh, otherwise call fetch() to get it and store the result.
+    Pages flagged as the most recent one for the seed are served stale while a background thread
+    revalidates them, unless max_age is given
+
+    Keyword arguments:
+    source, seed_type, seed_id, page -- cache key (page may be a page number or an offset string)
+    fetch -- function taking no arguments that pulls the page from the API
+    is_recent -- whether this is the seed's most recent page, either a bool or a function of the
+    cached response returning a bool (default False)
+    should_store -- function of a fetched response returning whether it should be cached, e.g. to
+    skip error responses (default None, store everything)
+    max_age -- seconds after which the page is fetched again even if the source's time-to-live is
+    longer, for callers that need pages at least that recent (default None)
+    """
+    cached, status = self.lookup(source, seed_type, seed_id, page, is_recent, max_age=max_age)
+    if status == 'hit':
+      return cached
+    if status == 'stale':
+      self.revalidate(source, seed_type, seed_id, page, fetch, should_store)
+      return cached
+    result = fetch()
+    self.store(source, seed_type, seed_id, page, result, should_store)
+    return result
+
+  async def get_or_fetch_async(self, source, seed_type, seed_id, page, fetch, is_recent=False, \
+    should_store=None):
+    """
+    Same as get_or_fetch, for use from asyncio code: fetch is a coroutine function, stale pages are
+    revalidated in a task on the running event loop instead of a thread, and the SQLite reads and
+    writes run in the loop's default executor
+    """
+    loop = asyncio.get_running_loop()
+    cached, status = await loop.run_in_executor(None, \
+      functools.partial(self.lookup, source, seed_type, seed_id, page, is_recent))
+    if status == 'hit':
+      return cached
+    if status == 'stale':
+      if self.start_revalidation((source, seed_type, str(seed_id), str(page))):
+        # Keep a reference, the event loop only holds a weak one to running tasks
+        task = asyncio.ensure_future(\
+          self.revalidate_async(source, seed_type, seed_id, page, fetch, should_store))
+        self.revalidation_tasks.add(task)
+        task.add_done_callback(self.revalidation_tasks.discard)
+      return cached
+    result = await fetch()
+    await loop.run_in_executor(None, \
+      functools.partial(self.store, source, seed_type, seed_id, page, result, should_store))
+    return result
+
+  def lookup(self, source, seed_type, seed_id, page, is_recent=False, max_age=None):
+    """
+    Return (cached page or None, status), where status is "hit" if the cached page is fresh, "stale"
+    if it is out of date but should be served while it is revalidated, and "fetch" if the page has
+    to be fetched now (see get_or_fetch for is_recent and max_age)
+    """
+    cached, fetched_at = self.get(source, seed_type, seed_id, page)
+    if cached is not None:
+      ttl = self.ttl(source) if max_age is None else min(self.ttl(source), max_age)
+      if time.time() - fetched_at < ttl:
+        self.count('hits')
+        return cached, 'hit'
+      recent = is_recent(cached) if callable(is_recent) else is_recent
+      if recent and (max_age is None):
+        self.count('stale_hits')
+        return cached, 'stale'
+      self.count('refreshes')
+    else:
+      self.count('misses')
+    return cached, 'fetch'
+
+  def store(self, source, seed_type, seed_id, page, result, should_store=None):
+    if (should_store is None) or should_store(result):
+      self.put(source, seed_type, seed_id, page, result)
+
+  def start_revalidation(self, key):
+    """
+    Mark key as being revalidated, return False if it already is
+    """
+    with self.stats_lock:
+      if key in self.revalidating:
+        return False
+      self.revalidating.add(key)
+      self.counts['revalidations'] += 1
+      return True
+
+  def finish_revalidation(self, key):
+    with self.stats_lock:
+      self.revalidating.discard(key)
+
+  async def revalidate_async(self, source, seed_type, seed_id, page, fetch, should_store):
+    key = (source, seed_type, str(seed_id), str(page))
+    try:
+      result = await fetch()
+      await asyncio.get_running_loop().run_in_executor(None, \
+        functools.partial(self.store, source, seed_type, seed_id, page, result, should_store))
+    except Exception as err:
+      print("Could not revalidate cached page {}: {}".format(key, err))
+    finally:
+      self.finish_revalidation(key)
+
+  def revalidate(self, source, seed_type, seed_id, page, fetch, should_store):
+    key = (source, seed_type, str(seed_id), str(page))
+    if not self.start_revalidation(key):
+      return
+
+    def refresh():
+      try:
+        self.store(source, seed_type, seed_id, page, fetch(), should_store)
+      except Exception as err:
+        print("Could not revalidate cached page {}: {}".format(key, err))
+      finally:
+        self.finish_revalidation(key)
+    threading.Thread(target=refresh, daemon=True).start()
+
+  def stats(self):
+    """
+    Return dictionary of hit/miss counts for this process plus the number of cached pages and their
+    total size
+    """
+    with self.stats_lock:
+      out = dict(self.counts)
+    lookups = out['hits'] + out['stale_hits'] + out['refreshes'] + out['misses']
+    out['hit_rate'] = (out['hits'] + out['stale_hits'])/lookups if lookups else None
+    with self.connect() as conn:
+      out['entries'], out['bytes'] = conn.execute(\
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+    return out
+
+  def seeds(self, source):
+    """
+    Return list of (seed_type, seed_id) pairs with pages cached for source
+    """
+    with self.connect() as conn:
+      return conn.execute("""SELECT DISTINCT seed_type, seed_id FROM responses WHERE source=?
+        ORDER BY seed_type, seed_id""", (source,)).fetchall()
+
+  def pages(self, source, seed_type, seed_id):
+    """
+    Return list of (page, response, fetched_at) for the pages cached for the seed, in no particular
+    order
+    """
+    with self.connect() as conn:
+      rows = conn.execute("""SELECT page, body, fetched_at FROM responses WHERE source=? AND
+        seed_type=? AND seed_id=?""", (source, seed_type, str(seed_id))).fetchall()
+    return [(page, json.loads(body), fetched_at) for page, body, fetched_at in rows]
+
+  def clear(self, source=None):
+    with self.connect() as conn:
+      if source is None:
+        conn.execute("DELETE FROM responses")
+      else:
+        conn.execute("DELETE FROM responses WHERE source=?", (source,))
@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+
+import general_methods as gen
+import rate_limiting
+import response_cache
+import event_store
+import event_index
+import sync_store
+import single_flight
+import venue_matching
+import event_database
+
+#####################
+
+class Services:
+  """
+  The long-lived objects the app pulls and stores events with. Their state lives in files under
+  the cache folder, so the web workers and the background job processes can each build their own
+  copy from the same settings and still share rate limits, cached responses and stored events
+
+  Keyword arguments:
+  settings -- dictionary with keys cache_dir (folder for the shared files), setlist_api_key,
+  venue_mapping (JSON venue mapping file) and optionally event_database (event_database.EventDatabase
+  file loaded from data exports, which the pullers then only ask the APIs for newer events than)
+  """
+  def __init__(self, settings):
+    cache_dir = settings['cache_dir']
+    self.mb_rate_limiter = rate_limiting.musicbrainz_rate_limiter(\
+      state_file=os.path.join(cache_dir, 'mumt621_musicbrainz_bucket.json'))
+    self.sl_rate_limiter = rate_limiting.setlist_rate_limiter(\
+      state_file=os.path.join(cache_dir, 'mumt621_setlist_bucket.json'))
+    self.response_cache = response_cache.ResponseCache(os.path.join(cache_dir, 'mumt621_responses.sqlite'))
+    # MusicBrainz pulls only fetch pages in the date range that haven't been pulled before
+    self.sync_store = sync_store.SyncStore(os.path.join(cache_dir, 'mumt621_sync.sqlite'))
+    # Users asking about artists on the same tour pull the same venues at once; they share one pull
+    self.single_flight = single_flight.SingleFlight(os.path.join(cache_dir, 'mumt621_locks'))
+    mb_event_puller = gen.MusicBrainzPuller(app="MUMT-621 Project testing", version="0", \
+      rate_limiter=self.mb_rate_limiter, cache=self.response_cache, sync_store=self.sync_store, \
+      single_flight=self.single_flight)
+    sl_event_puller = gen.SetlistPuller(api_key=settings['setlist_api_key'], \
+      rate_limiter=self.sl_rate_limiter, cache=self.response_cache, single_flight=self.single_flight)
+    self.event_database = None
+    if settings.get('event_database'):
+      self.event_database = event_database.EventDatabase(settings['event_database'])
+      mb_event_puller = event_database.LocalMusicBrainzPuller(self.event_database, mb_event_puller)
+      sl_event_puller = event_database.LocalSetlistPuller(self.event_database, sl_event_puller)
+    self.mb_event_puller = gen.CoalescingPuller(mb_event_puller, self.single_flight, 'musicbrainz')
+    self.sl_event_puller = gen.CoalescingPuller(sl_event_puller, self.single_flight, 'setlist')
+    # Mapping is compiled once into a memory-mapped index shared by all processes
+    self.venue_mapper = gen.VenueMapper()
+    self.venue_mapper.load_index(gen.compile_venue_index(settings['venue_mapping'], \
+      os.path.join(cache_dir, 'mumt621_venue_mapping.sqlite')))
+    # Pulled venue events stay on the server; the browser only keeps the token to look them up
+    self.event_store = event_store.EventStore(os.path.join(cache_dir, 'mumt621_events'))
+    # Every artist and venue pulled so far, so venues seen recently don't have to be pulled again
+    self.event_index = event_index.EventIndex(os.path.join(cache_dir, 'mumt621_event_index.sqlite'))
+    # Venues pulled so far that only have one of their IDs can be mapped to nearby ones with the other
+    self.venue_mapper.set_locator(venue_matching.VenueLocator())
+    self.update_locator()
+
+  def update_locator(self):
+    """
+    Add the venues indexed since the last update, by this process or others, to the venue locator
+    """
+    return self.venue_mapper.locator.update_from_event_index(self.event_index.filename)
+
+_services = {}
+_services_lock = threading.Lock()
+
+def get_services(settings):
+  """
+  Return this process's Services for settings, building them on first use
+  """
+  key = tuple(sorted(settings.items()))
+  with _services_lock:
+    if key not in _services:
+      _services[key] = Services(settings)
+    return _services[key]
+
+#####################
+
+def split_indexed_venues(services, query_events_list, start_date, end_date, max_age):
+  """
+  Return list of the event index keys (see general_methods.venue_key_string) of the query artist's
+  venues indexed less than max_age seconds ago for start_date to end_date, and list of the query
+  artist's events at the other venues, which need pulling
+
+  Keyword arguments:
+  services -- instance of class Services
+  query_events_list -- list of dictionary representations of the query artist's events
+  start_date, end_date -- range of dates of the venue events (type datetime.date)
+  max_age -- see event_index.EventIndex.is_fresh
+  """
+  seed_keys = [gen.venue_key_string(*gen.event_venue_key(event_dict, services.venue_mapper)) \
+    for event_dict in query_events_list]
+  fresh = {} # seed key: whether it's fresh
+  for seed_key in seed_keys:
+    if seed_key not in fresh:
+      fresh[seed_key] = services.event_index.is_fresh('venue', seed_key, start_date, end_date, max_age)
+  stale_events = [event_dict for event_dict, seed_key in zip(query_events_list, seed_keys) \
+    if not fresh[seed_key]]
+  return [seed_key for seed_key, is_fresh in fresh.items() if is_fresh], stale_events
+
+def store_indexed_venues(services, token, seed_keys, start_date, end_date):
+  """
+  Append the indexed events of venues to the event store under token, return them as an EventBatch
+
+  Keyword arguments:
+  services -- instance of class Services
+  token -- event store token
+  seed_keys -- list of the venues' event index keys
+  start_date, end_date -- range of dates of the events (type datetime.date)
+  """
+  batch = gen.EventBatch()
+  for seed_key in seed_keys:
+    batch.add_batch(services.event_index.seed_batch('venue', seed_key, start_date, end_date))
+  if len(batch) > 0:
+    services.event_store.append(token, batch)
+  return batch
+
+def pull_venue_events(job, settings, query_mbid, query_events_list, token, start_date, end_date, \
+  sl_page_limit, max_workers=8, mb_max_concurrent=1, sl_max_concurrent=2, index_max_age=7*24*3600, \
+  indexed_venue_keys=(), n_recs=10, flush_rows=2000, flush_interval=2):
+  """
+  Job (see jobs.JobQueue) pulling the events at every venue of the query artist's events into the
+  event store under token. Events are appended as venues finish, at most every flush_interval
+  seconds unless flush_rows are waiting, and the venue mappings learned from them are saved to the
+  shared mapping index along with them, since the job's VenueMapper is its own process's copy. The
+  job's progress counts venues, and after each venue its result holds the number of stored event
+  rows and the recommendations so far, kept up to date by an IncrementalRecommender, so that pollers
+  can show them without loading the events. Venues already found fresh in the event index (see
+  split_indexed_venues) are stored and counted first without a pull
+
+  Keyword arguments:
+  job -- instance of class jobs.Job
+  settings -- settings for get_services
+  query_mbid -- MBID of query artist
+  query_events_list -- list of dictionary representations of the query artist's events
+  token -- event store token to append the events to
+  start_date, end_date -- range of dates for events to pull (type datetime.date)
+  sl_page_limit -- maximum number of results pages to pull from Setlist.fm for each venue
+  max_workers, mb_max_concurrent, sl_max_concurrent, index_max_age -- see get_events_list
+  indexed_venue_keys -- event index keys of venues whose events are taken from the index, with none
+  of query_events_list at them (default none)
+  n_recs -- number of recommended artists (default 10)
+  flush_rows -- number of waiting event rows that are appended straight away (default 2000)
+  flush_interval -- seconds between appends otherwise (default 2)
+  """
+  services = get_services(settings)
+  # Venues pulled by other processes since this one's last job can be matched too
+  services.update_locator()
+  recommender = gen.IncrementalRecommender(query_mbid, n_recs=n_recs)
+  indexed = store_indexed_venues(services, token, indexed_venue_keys, start_date, end_date)
+  recommender.add_batch(indexed)
+  state = dict(pending=gen.EventBatch(), count=len(indexed), flushed_at=time.time())
+  if len(indexed_venue_keys) > 0:
+    job.update(result=dict(count=state['count'], recs=recommender.recommend()))
+
+  def flush():
+    if len(state['pending']) > 0:
+      services.event_store.append(token, state['pending'])
+      state['count'] += len(state['pending'])
+      state['pending'] = gen.EventBatch()
+    services.venue_mapper.save_new_venues()
+    state['flushed_at'] = time.time()
+
+  def progress(done, total, new_batch):
+    recommender.add_batch(new_batch)
+    state['pending'].add_batch(new_batch)
+    if (done == total) or (len(state['pending']) >= flush_rows) or \
+      (time.time() - state['flushed_at'] >= flush_interval):
+      flush()
+    job.update(progress=done, total=total, result=dict(count=state['count'], recs=recommender.recommend()))
+
+  gen.get_events_list(query_events_list, services.mb_event_puller, services.sl_event_puller, \
+    services.venue_mapper, start_date, end_date, sl_page_limit, max_workers=max_workers, \
+    mb_max_concurrent=mb_max_concurrent, sl_max_concurrent=sl_max_concurrent, as_batch=True, \
+    event_index=services.event_index, index_max_age=index_max_age, progress=progress)
+  flush()
+  return dict(count=state['count'], recs=recommender.recommend())
+
+def prefetch_artist_info(job, settings, artist_mbids):
+  """
+  Job (see jobs.JobQueue) looking up the details shown for recommended artists (see
+  general_methods.get_more_artist_info) ahead of any click, one at a time at low priority under the
+  MusicBrainz rate limit, skipping artists whose details are already cached. Returns the number of
+  artists looked up and the list of those whose details still aren't cached, e.g. because the lookup
+  failed
+
+  Keyword arguments:
+  job -- instance of class jobs.Job
+  settings -- settings for get_services
+  artist_mbids -- list of MBIDs of artists
+  """
+  services = get_services(settings)
+  fetched = 0
+  failed = []
+  for i, mbid in enumerate(artist_mbids):
+    cached, status = services.response_cache.lookup('artist_info', 'artist', mbid, 0)
+    if status != 'hit':
+      gen.get_more_artist_info(mbid, cache=services.response_cache, rate_limiter=services.mb_rate_limiter, \
+        single_flight=services.single_flight, priority=rate_limiting.LOW_PRIORITY)
+      fetched += 1
+      # get_more_artist_info only caches details it actually got
+      if services.response_cache.get('artist_info', 'artist', mbid, 0)[0] is None:
+        failed.append(mbid)
+    job.update(progress=i + 1, total=len(artist_mbids))
+  return dict(fetched=fetched, failed=failed)
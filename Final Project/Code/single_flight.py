@@ -0,0 +1,85 @@
+import os
+import copy
+import hashlib
+import threading
+import concurrent.futures
+
+try:
+  import fcntl
+except ImportError: # not available on Windows; calls are then only coalesced within a process
+  fcntl = None
+
+#####################
+
+class SingleFlight:
+  """
+  Coalesce concurrent calls for the same key so that only one of them does the work. Within a
+  process, the first caller runs the function and the others wait for its result and get their
+  own copy of it. Across processes (e.g. gunicorn workers), callers take an exclusive lock on a
+  file named after the key, so that a duplicate call only starts once the first one has finished,
+  by which time it can find the result in a shared cache instead of fetching it again
+
+  Keyword arguments:
+  lock_dir -- folder for the lock files, None to only coalesce calls within this process
+  """
+  def __init__(self, lock_dir=None):
+    self.lock_dir = lock_dir
+    self.lock = threading.Lock()
+    self.calls = {} # key: Future of the call in flight and number of callers waiting for it
+    self.counts = dict(calls=0, shared=0)
+    if lock_dir is not None:
+      os.makedirs(lock_dir, exist_ok=True)
+
+  def do(self, key, func):
+    """
+    Return func(), unless a call with the same key is already running in this process, in which
+    case wait for it and return a copy of its result (or raise its exception)
+
+    Keyword arguments:
+    key -- tuple of strings identifying the call
+    func -- function taking no arguments that does the work, which should look in the shared cache
+    before fetching anything
+    """
+    with self.lock:
+      call = self.calls.get(key)
+      leader = call is None
+      if leader:
+        call = self.calls[key] = dict(future=concurrent.futures.Future(), followers=0)
+        self.counts['calls'] += 1
+      else:
+        call['followers'] += 1
+        self.counts['shared'] += 1
+    future = call['future']
+    if not leader:
+      # Results are lists and dictionaries that callers may change, so each gets its own copy
+      return copy.deepcopy(future.result())
+    try:
+      result = self.call_locked(key, func)
+    except BaseException as err:
+      with self.lock:
+        del self.calls[key]
+      future.set_exception(err)
+      raise
+    with self.lock:
+      del self.calls[key] # no more followers can join after this
+      followers = call['followers']
+    # Followers copy from a snapshot, since the leader's caller may start changing the result
+    future.set_result(copy.deepcopy(result) if followers else result)
+    return result
+
+  def call_locked(self, key, func):
+    if (self.lock_dir is None) or (fcntl is None):
+      return func()
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    with open(os.path.join(self.lock_dir, digest + '.lock'), 'a') as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        return func()
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  def stats(self):
+    with self.lock:
+      out = dict(self.counts)
+      out['in_flight'] = len(self.calls)
+    return out
@@ -0,0 +1,135 @@
+import json
+import sqlite3
+import threading
+import time
+
+#####################
+
+class SyncStore:
+  """
+  On-disk (SQLite) record of how far each seed's event history has been synced from an API that
+  pages through events in date order, along with the raw events already pulled, so that later pulls
+  only have to fetch the pages past the end of what is stored
+
+  For each (source, seed_type, seed_id) the state holds the offset of the first stored event (pulls
+  may skip pages that are entirely before the requested dates), the offset to continue from, the
+  earliest date the stored events are complete from, the date of the last stored event, whether
+  the last page has been reached and when the seed was last synced
+
+  Keyword arguments:
+  filename -- SQLite database file
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.local = threading.local()
+    with self.connect() as conn:
+      conn.execute("""CREATE TABLE IF NOT EXISTS sync_state (
+        source TEXT, seed_type TEXT, seed_id TEXT, first_offset INTEGER, next_offset INTEGER,
+        synced_from TEXT, synced_through TEXT, complete INTEGER, synced_at REAL,
+        PRIMARY KEY (source, seed_type, seed_id))""")
+      conn.execute("""CREATE TABLE IF NOT EXISTS synced_events (
+        source TEXT, seed_type TEXT, seed_id TEXT, position INTEGER, event_date TEXT, body TEXT,
+        PRIMARY KEY (source, seed_type, seed_id, position))""")
+
+  def connect(self):
+    # sqlite3 connections can't be shared between threads, so keep one per thread
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.filename, timeout=30)
+      conn.execute("PRAGMA journal_mode=WAL")
+      self.local.conn = conn
+    return conn
+
+  def get_state(self, source, seed_type, seed_id):
+    """
+    Return dictionary with the seed's sync state, or None if it has never been synced
+    """
+    with self.connect() as conn:
+      row = conn.execute("""SELECT first_offset, next_offset, synced_from, synced_through, complete,
+        synced_at FROM sync_state WHERE source=? AND seed_type=? AND seed_id=?""", \
+        (source, seed_type, str(seed_id))).fetchone()
+    if row is None:
+      return None
+    return dict(first_offset=row[0], next_offset=row[1], synced_from=row[2], synced_through=row[3], \
+      complete=bool(row[4]), synced_at=row[5])
+
+  def reset(self, source, seed_type, seed_id, first_offset, synced_from):
+    """
+    Forget the seed's stored events and start syncing again from first_offset
+
+    Keyword arguments:
+    source, seed_type, seed_id -- seed to reset
+    first_offset -- offset of the first page that will be stored
+    synced_from -- ISO date from which the stored events will be complete
+    """
+    key = (source, seed_type, str(seed_id))
+    with self.connect() as conn:
+      conn.execute("DELETE FROM synced_events WHERE source=? AND seed_type=? AND seed_id=?", key)
+      conn.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", \
+        key + (first_offset, first_offset, synced_from, None, 0, time.time()))
+
+  def add_page(self, source, seed_type, seed_id, offset, events, event_dates, complete, \
+    synced_through=None):
+    """
+    Store a page of raw events pulled at offset and move the seed's next offset past it
+
+    Keyword arguments:
+    source, seed_type, seed_id -- seed the page was pulled for
+    offset -- offset the page was pulled from
+    events -- list of raw events on the page
+    event_dates -- list of ISO dates of the events (None if unknown)
+    complete -- whether this was the seed's last page
+    synced_through -- ISO date up to which the seed is synced after this page (default None, keep
+    the previous one)
+    """
+    key = (source, seed_type, str(seed_id))
+    with self.connect() as conn:
+      conn.executemany("INSERT OR REPLACE INTO synced_events VALUES (?, ?, ?, ?, ?, ?)", \
+        [key + (offset + i, event_date, json.dumps(event)) \
+        for i, (event, event_date) in enumerate(zip(events, event_dates))])
+      conn.execute("""UPDATE sync_state SET next_offset=?, synced_through=COALESCE(?, synced_through),
+        complete=?, synced_at=? WHERE source=? AND seed_type=? AND seed_id=?""", \
+        (offset + len(events), synced_through, int(complete), time.time()) + key)
+
+  def seeds(self, source):
+    """
+    Return list of (seed_type, seed_id) pairs synced from source
+    """
+    with self.connect() as conn:
+      return conn.execute("""SELECT seed_type, seed_id FROM sync_state WHERE source=?
+        ORDER BY seed_type, seed_id""", (source,)).fetchall()
+
+  def event_at(self, source, seed_type, seed_id, position):
+    """
+    Return the seed's raw event stored at offset position, or None if there is none
+    """
+    with self.connect() as conn:
+      row = conn.execute("""SELECT body FROM synced_events WHERE source=? AND seed_type=? AND
+        seed_id=? AND position=?""", (source, seed_type, str(seed_id), position)).fetchone()
+    return None if row is None else json.loads(row[0])
+
+  def events(self, source, seed_type, seed_id, start_date=None, end_date=None):
+    """
+    Return list of the seed's stored raw events in offset order, limited to those dated between
+    start_date and end_date (ISO dates) if given
+    """
+    query = "SELECT body FROM synced_events WHERE source=? AND seed_type=? AND seed_id=?"
+    params = [source, seed_type, str(seed_id)]
+    if start_date is not None:
+      query += " AND event_date >= ?"
+      params.append(start_date)
+    if end_date is not None:
+      query += " AND event_date <= ?"
+      params.append(end_date)
+    with self.connect() as conn:
+      rows = conn.execute(query + " ORDER BY position", params).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+  def clear(self, source=None):
+    with self.connect() as conn:
+      if source is None:
+        conn.execute("DELETE FROM synced_events")
+        conn.execute("DELETE FROM sync_state")
+      else:
+        conn.execute("DELETE FROM synced_events WHERE source=?", (source,))
+        conn.execute("DELETE FROM sync_state WHERE source=?", (source,))
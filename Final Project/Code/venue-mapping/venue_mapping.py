@@ -1,29 +1,66 @@
 import musicbrainzngs
 import requests
-import fuzzywuzzy
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
-import math
+import time
+import threading
+import json
+import os
+import sys
+import sqlite3
+import concurrent.futures
+
+# Rate limiting, geographic and name matching are shared with the app, one folder up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rate_limiting
+import venue_matching
+import numpy as np
 
 import configparser # Only needed for stuff in main()
 import argparse # Only needed for stuff in main()
 
-#from https://gist.github.com/rochacbruno/2883505
+# Haversine distance in km; see venue_matching.haversine for whole arrays of points at once
 def distance(origin, destination):
-    lat1, lon1 = origin
-    lat2, lon2 = destination
-    radius = 6371 # km
+    return float(venue_matching.haversine(origin[0], origin[1], destination[0], destination[1]))
+
+# Compares names with equal weights for all n-grams, when there's no locator to learn weights from
+NAME_MATCHER = venue_matching.VenueNameMatcher()
+
+# Setlist.fm searches share one pool of keep-alive connections; each thread gets its own session
+# since sessions aren't thread-safe
+SETLIST_POOL_SIZE = 10
+SETLIST_TIMEOUT = (3.05, 30) # seconds to connect, seconds to read
+# Searches that fail this many times in a row are given up on, and the venue is tried again next run
+SETLIST_SEARCH_ATTEMPTS = 10
+setlist_adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SETLIST_POOL_SIZE)
+session_local = threading.local()
 
-    dlat = math.radians(lat2-lat1)
-    dlon = math.radians(lon2-lon1)
-    a = math.sin(dlat/2) * math.sin(dlat/2) + math.cos(math.radians(lat1)) \
-        * math.cos(math.radians(lat2)) * math.sin(dlon/2) * math.sin(dlon/2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    d = radius * c
+def get_session():
+    session = getattr(session_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update({'Accept': 'application/json', \
+            'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        session.mount('https://', setlist_adapter)
+        session_local.session = session
+    return session
 
-    return d
+class SetlistSearchError(Exception):
+    pass
 
-def match_venue_by_coordinates(venue_mbid, setlist_api_key, distance_threshold=25, match_threshold=80):
+def search_setlist_venues(name, setlist_api_key, rate_limiter=None):
+    request = 'https://api.setlist.fm/rest/1.0/search/venues'
+    if rate_limiter:
+        rate_limiter.acquire(rate_limiting.LOW_PRIORITY) # leave the app's share of the daily quota
+    results = get_session().get(request, params={'name': name}, \
+        headers={'x-api-key': setlist_api_key}, timeout=SETLIST_TIMEOUT)
+    if rate_limiter and (results.status_code == 429):
+        rate_limiter.backoff(rate_limiting.parse_retry_after(results.headers.get('Retry-After')))
+    try:
+        return results.json()
+    except ValueError: # e.g. "Too Many Requests" in plain text
+        return dict(status=results.status_code)
+
+def match_venue_by_coordinates(venue_mbid, setlist_api_key, distance_threshold=25, \
+        match_threshold=venue_matching.MATCH_THRESHOLD, rate_limiter=None, locator=None):
     mb_venue = musicbrainzngs.get_place_by_id(venue_mbid)
     mb_venue = mb_venue['place']
 
@@ -38,44 +75,62 @@ def match_venue_by_coordinates(venue_mbid, setlist_api_key, distance_threshold=2
         matched_venue_dict['venue_lat'] = venue_lat
         matched_venue_dict['venue_long'] = venue_long
 
-        # Search Setlist.fm venues by the name of the MB venue
-        request = 'https://api.setlist.fm/rest/1.0/search/venues?name={}'.format(mb_venue['name'])
-        headers = {'Accept': 'application/json', 'x-api-key': setlist_api_key}
-        results = requests.get(request, headers=headers)
-        json_results = results.json()
+        # Venues already seen nearby may include the match, with no need to search for it
+        if locator is not None:
+            local_match = locator.match(dict(id=dict(mbid=mb_venue['id'], slid=None), \
+                name=dict(mbname=mb_venue['name'], slname=None), city=dict(name=None, coords=(None, None)), \
+                coords=(venue_lat, venue_long)), distance_threshold=distance_threshold, \
+                match_threshold=match_threshold, claim=True)
+            if local_match is not None:
+                set_setlist_venue(matched_venue_dict, local_match)
+                return matched_venue_dict
 
-        if 'code' in json_results.keys():
-            if json_results['code'] == 404:
-                print('No match found in Setlist for venue {}'.format(mb_venue['name']))
-        else:
-            sleep_time = 1
-            while 'venue' not in json_results.keys():
+        # Search Setlist.fm venues by the name of the MB venue, which the search only finds written
+        # plainly (e.g. "O2 Shepherd's Bush Empire" rather than "O₂ Shepherd’s Bush Empire")
+        query_name = venue_matching.search_name(mb_venue['name'])
+        json_results = search_setlist_venues(query_name, setlist_api_key, rate_limiter)
+
+        # Anything but results or "not found" (e.g. a 429, or a 500 with its own code) is retried; a
+        # search that keeps failing raises, so the venue isn't checkpointed as having no match
+        sleep_time = 1
+        attempts = 1
+        while ('venue' not in json_results.keys()) and (json_results.get('code') != 404):
+            if attempts >= SETLIST_SEARCH_ATTEMPTS:
+                raise SetlistSearchError('Setlist.fm search for venue {} failed {} times: {}'.format(\
+                    mb_venue['name'], attempts, json_results))
+            if rate_limiter is None:
                 time.sleep(sleep_time)
-                print("Trying again...")
-                results = requests.get(request, headers=headers)
-                json_results = results.json() 
-                sleep_time = sleep_time*1.5
+            elif 429 not in (json_results.get('status'), json_results.get('code')): # search backed off already
+                rate_limiter.backoff()
+            print("Trying again...")
+            json_results = search_setlist_venues(query_name, setlist_api_key, rate_limiter)
+            sleep_time = sleep_time*1.5
+            attempts += 1
+
+        if 'venue' not in json_results.keys():
+            print('No match found in Setlist for venue {}'.format(mb_venue['name']))
+        else:
             potential_matches = json_results['venue']
 
             # Calculate distance between query venue coords and city coords for each SL venue
             # Filter out SL venues with distance above threshold
-            filter_matches = []
-            for venue in potential_matches:
-              if 'lat' in venue['city']['coords'].keys():
-                city_lat = venue['city']['coords']['lat']
-                city_long = venue['city']['coords']['long']
-                if distance((venue_lat, venue_long), (city_lat, city_long)) < distance_threshold:
-                   filter_matches.append(venue)
-            potential_matches = filter_matches
-
-            # Calculate match between venue names based on edit distance            
-            best_match = match_threshold
-            best_venue = {}
-            for venue in potential_matches:
-                fuzzy_match = fuzz.ratio(mb_venue['name'], venue['name'])
-                if fuzzy_match > best_match:
-                  best_venue = venue
-            if bool(best_venue):
+            potential_matches = [venue for venue in potential_matches if 'lat' in venue['city']['coords'].keys()]
+            if len(potential_matches) > 0:
+                city_coords = np.array([(venue['city']['coords']['lat'], venue['city']['coords']['long']) \
+                    for venue in potential_matches])
+                distances = venue_matching.haversine(venue_lat, venue_long, city_coords[:, 0], city_coords[:, 1])
+                potential_matches = [venue for venue, d in zip(potential_matches, distances) \
+                    if d < distance_threshold]
+
+            # Take the most similar name (the first in case of ties), if it's similar enough
+            name_matcher = NAME_MATCHER if locator is None else locator.name_matcher
+            best, similarity = name_matcher.best_match(mb_venue['name'], \
+                [venue['name'] for venue in potential_matches], threshold=match_threshold)
+            if best is not None:
+                best_venue = potential_matches[best]
+                if locator is not None: # so the locator doesn't match the venue to another place
+                    locator.claim(dict(id=dict(mbid=mb_venue['id'], slid=None)), \
+                        dict(id=dict(mbid=None, slid=best_venue['id'])))
                 matched_venue_dict['slid'] = best_venue['id']
                 matched_venue_dict['sl_name'] = best_venue['name']
                 matched_venue_dict['city_lat'] = best_venue['city']['coords']['lat']
@@ -83,6 +138,13 @@ def match_venue_by_coordinates(venue_mbid, setlist_api_key, distance_threshold=2
                 matched_venue_dict['city_name'] = best_venue['city']['name']
     return matched_venue_dict
 
+def set_setlist_venue(matched_venue_dict, sl_venue):
+    # Fill in the Setlist.fm side of a match from a venue dictionary as in venue_mapping.json
+    matched_venue_dict['slid'] = sl_venue['id']['slid']
+    matched_venue_dict['sl_name'] = sl_venue['name']['slname']
+    matched_venue_dict['city_lat'], matched_venue_dict['city_long'] = sl_venue['city']['coords']
+    matched_venue_dict['city_name'] = sl_venue['city']['name']
+
 def add_to_venue_map(venue, venue_map):
     venue_entry = {}
     venue_entry['id'] = {'mbid': venue['mbid'], 'slid': venue['slid']}
@@ -92,6 +154,143 @@ def add_to_venue_map(venue, venue_map):
     venue_map[venue['mbid']] = venue_entry
     venue_map[venue['slid']] = venue_entry
 
+def load_venue_map(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+def write_venue_map(venue_map, filename):
+    # Write to a temporary file first so the app never reads a half-written mapping
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(venue_map, f)
+    os.replace(tmp_filename, filename)
+
+def load_checkpoint(filename):
+    """
+    Return dictionary of MBID: record for the venues already matched in checkpoint file (one JSON
+    record per line); a line cut off by an interrupted run is ignored
+    """
+    done = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('error') is None: # failed matches are tried again
+                    done[record['mbid']] = record
+    return done
+
+def unmapped_index_venues(index_filename, venue_map):
+    """
+    Return list of MBIDs of venues in the app's event index (see event_index.py) that were never
+    matched to a Setlist.fm venue and aren't in venue_map
+    """
+    conn = sqlite3.connect('file:{}?mode=ro'.format(index_filename), uri=True)
+    rows = conn.execute("""SELECT DISTINCT venue_mbid FROM events
+        WHERE venue_mbid IS NOT NULL AND venue_slid IS NULL ORDER BY venue_mbid""").fetchall()
+    conn.close()
+    return [row[0] for row in rows if row[0] not in venue_map]
+
+def match_venues(venue_mbids, setlist_api_key, mapping_filename, checkpoint_filename, max_workers=4, \
+        write_every=50, rate_limiter=None, locator=None, distance_threshold=25, \
+        match_threshold=venue_matching.MATCH_THRESHOLD):
+    """
+    Match many MusicBrainz places to Setlist.fm venues, with up to max_workers searches at once
+    under rate_limiter. Every finished venue is appended to the checkpoint file, so an interrupted
+    run (or one that used up the daily Setlist.fm quota) picks up where it left off, and matches are
+    written into the mapping file every write_every matches. Return number of new matches
+
+    Keyword arguments:
+    venue_mbids -- list of MBIDs of MusicBrainz places
+    setlist_api_key -- Setlist.fm API key
+    mapping_filename -- venue mapping JSON file to add the matches to (created if missing)
+    checkpoint_filename -- file to record matched venues in, one JSON record per line
+    max_workers -- number of venues to match at the same time (default 4)
+    write_every -- number of new matches between writes of the mapping file (default 50)
+    rate_limiter -- instance of rate_limiting.TokenBucket (default None, Setlist.fm limits in this
+    process only)
+    locator -- instance of venue_matching.VenueLocator with venues to match against before
+    searching Setlist.fm (default None)
+    distance_threshold, match_threshold -- see match_venue_by_coordinates
+    """
+    if rate_limiter is None:
+        rate_limiter = rate_limiting.setlist_rate_limiter()
+    done = load_checkpoint(checkpoint_filename)
+    venue_mbids = list(dict.fromkeys(venue_mbids))
+    todo = [mbid for mbid in venue_mbids if mbid not in done]
+    print('{} venues to match, {} already done'.format(len(todo), len(venue_mbids) - len(todo)))
+    venue_map = load_venue_map(mapping_filename)
+    out_of_quota = threading.Event()
+
+    local_matches = []
+    if locator is not None:
+        # Venues the locator knows the coordinates of can all be matched locally in one go first
+        todo_set = set(todo)
+        known = [venue for venue in locator.venues \
+            if (venue['id']['mbid'] in todo_set) and (venue['id']['slid'] is None) \
+            and (venue['coords'][0] is not None)]
+        for mb_venue, sl_venue in zip(known, locator.match_many(known, \
+                distance_threshold=distance_threshold, match_threshold=match_threshold, claim=True)):
+            if sl_venue is not None:
+                matched_venue_dict = dict(mbid=mb_venue['id']['mbid'], mb_name=mb_venue['name']['mbname'], \
+                    venue_lat=mb_venue['coords'][0], venue_long=mb_venue['coords'][1])
+                set_setlist_venue(matched_venue_dict, sl_venue)
+                local_matches.append(matched_venue_dict)
+        print('Matched {} venues locally'.format(len(local_matches)))
+        matched_locally = set(venue['mbid'] for venue in local_matches)
+        todo = [mbid for mbid in todo if mbid not in matched_locally]
+
+    def match(venue_mbid):
+        if out_of_quota.is_set():
+            return None
+        try:
+            return match_venue_by_coordinates(venue_mbid, setlist_api_key, \
+                distance_threshold=distance_threshold, match_threshold=match_threshold, \
+                rate_limiter=rate_limiter, locator=locator)
+        except rate_limiting.QuotaExceededError:
+            out_of_quota.set()
+            return None
+
+    new_matches = 0
+    unwritten = 0
+
+    def save(record):
+        nonlocal new_matches, unwritten
+        checkpoint.write(json.dumps(record) + '\n')
+        checkpoint.flush()
+        if record['venue'] and record['venue']['slid']:
+            add_to_venue_map(record['venue'], venue_map)
+            new_matches += 1
+            unwritten += 1
+            if unwritten >= write_every:
+                write_venue_map(venue_map, mapping_filename)
+                unwritten = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            open(checkpoint_filename, 'a') as checkpoint:
+        futures = {executor.submit(match, mbid): mbid for mbid in todo}
+        for matched_venue_dict in local_matches:
+            save(dict(mbid=matched_venue_dict['mbid'], venue=matched_venue_dict, error=None))
+        for future in concurrent.futures.as_completed(futures):
+            record = dict(mbid=futures[future], venue=None, error=None)
+            try:
+                record['venue'] = future.result()
+            except Exception as err: # e.g. place not found or network errors; retried next run
+                record['error'] = repr(err)
+            if (record['venue'] is None) and (record['error'] is None):
+                continue # skipped after running out of quota
+            save(record)
+    if unwritten > 0:
+        write_venue_map(venue_map, mapping_filename)
+    if out_of_quota.is_set():
+        print('Out of Setlist.fm quota for today; run again later to match the rest')
+    print('Added {} venues to {}'.format(new_matches, mapping_filename))
+    return new_matches
+
 def main():
     musicbrainzngs.set_useragent(app="MusicBrainz to Setlist venue mapping", version="0")
 
@@ -100,8 +299,36 @@ def main():
     SETLIST_API_KEY = config['API Keys']['SETLIST_API_KEY']
 
     parser = argparse.ArgumentParser(description='MusicBrainz to Setlist venue mapping')
-    parser.add_argument('mbid')
+    parser.add_argument('mbid', nargs='?')
+    parser.add_argument('--batch', help='file with one MusicBrainz place MBID per line to match')
+    parser.add_argument('--from-index', help="match unmapped venues in the app's event index file")
+    parser.add_argument('--mapping', default=os.path.join('..', 'venue_mapping.json'), \
+        help='venue mapping JSON file to add batch matches to')
+    parser.add_argument('--checkpoint', default='venue_matches.jsonl', \
+        help='file recording matched venues, so interrupted batches can resume')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate-limit-state', \
+        help="Setlist.fm rate limiter state file, to share the limit with a running app")
+    parser.add_argument('--match-locally', \
+        help="event index file whose Setlist.fm venues are matched against before searching")
     args = parser.parse_args()
+
+    if args.batch or args.from_index:
+        venue_mbids = []
+        if args.batch:
+            with open(args.batch) as f:
+                venue_mbids += [line.strip() for line in f if line.strip()]
+        if args.from_index:
+            venue_mbids += unmapped_index_venues(args.from_index, load_venue_map(args.mapping))
+        locator = None
+        if args.match_locally:
+            locator = venue_matching.VenueLocator(venue_matching.venues_from_event_index(args.match_locally))
+        match_venues(venue_mbids, SETLIST_API_KEY, args.mapping, args.checkpoint, \
+            max_workers=args.workers, locator=locator, \
+            rate_limiter=rate_limiting.setlist_rate_limiter(state_file=args.rate_limit_state))
+        return
+    if args.mbid is None:
+        parser.error('give an MBID, --batch or --from-index')
     venue_mbid = args.mbid # La Sala Rossa: 1808696e-b997-4b3c-91e7-37f09022ebe0
 
     print('Testing venue matching function...')
@@ -0,0 +1,445 @@
+import re
+import sqlite3
+import threading
+import unicodedata
+import zlib
+import numpy as np
+import scipy.sparse
+import scipy.spatial
+
+EARTH_RADIUS = 6371 # km
+# Minimum VenueNameMatcher similarity for two nearby venues to be taken as the same one. Calibrated on
+# the 3371 venues in venue_mapping.json with both names: 99.1% of their MusicBrainz and Setlist.fm
+# names score above 75, while 0.6% of the MusicBrainz venues have another Setlist.fm venue within
+# 25 km scoring above 75 (1.6% above 70, mostly rooms of the same building, e.g. "Melkweg" and
+# "Melkweg The Max"). Names that only differ by a word (e.g. "Stadtgarten Köln" and "Stadtgarten")
+# score 75 to 80, which fuzz.ratio's old threshold of 80 was too strict for on this scale
+MATCH_THRESHOLD = 75
+
+#####################
+
+def haversine(lat1, long1, lat2, long2):
+  """
+  Return great-circle distance in km between points given in degrees. Takes numbers or NumPy
+  arrays, which broadcast against each other as usual
+
+  Keyword arguments:
+  lat1, long1 -- coordinates of the first point(s)
+  lat2, long2 -- coordinates of the second point(s)
+  """
+  lat1, long1, lat2, long2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, long1, lat2, long2))
+  a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((long2 - long1)/2)**2
+  return 2*EARTH_RADIUS*np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def unit_vectors(lats, longs):
+  """
+  Return (n, 3) array of points on the unit sphere for arrays of latitudes and longitudes in degrees
+  """
+  lats = np.radians(np.asarray(lats, dtype=float))
+  longs = np.radians(np.asarray(longs, dtype=float))
+  return np.column_stack([np.cos(lats)*np.cos(longs), np.cos(lats)*np.sin(longs), np.sin(lats)])
+
+def venue_position(venue):
+  """
+  Return (latitude, longitude) of a venue dictionary (as in venue_mapping.json): its own
+  coordinates if known (MusicBrainz places), else its city's (Setlist.fm venues), else None
+  """
+  for lat, long in (venue['coords'], venue['city']['coords']):
+    if (lat is not None) and (long is not None):
+      return float(lat), float(long)
+  return None
+
+#####################
+
+# Typographic quotes and dashes that NFKC leaves alone
+PUNCTUATION_VARIANTS = str.maketrans({'\u2018': "'", '\u2019': "'", '\u201a': "'", '\u201b': "'", \
+  '\u201c': '"', '\u201d': '"', '\u2010': '-', '\u2011': '-', '\u2012': '-', '\u2013': '-', '\u2014': '-'})
+
+def search_name(name):
+  """
+  Return venue name with Unicode compatibility characters folded (e.g. "O\u2082" to "O2") and
+  typographic quotes made plain, which Setlist.fm's search needs to find some venues
+  """
+  return unicodedata.normalize('NFKC', name).translate(PUNCTUATION_VARIANTS)
+
+def fold_name(name):
+  """
+  Return name folded for comparison: Unicode compatibility forms and accents folded, lower case,
+  "&" spelled out, apostrophes dropped and other punctuation removed
+  """
+  name = unicodedata.normalize('NFKD', search_name(name))
+  name = ''.join(c for c in name if not unicodedata.combining(c)).casefold()
+  name = name.replace('&', ' and ').replace("'", '')
+  return ' '.join(re.sub(r'[\W_]+', ' ', name).split())
+
+def normalize_venue_name(name):
+  """
+  Return venue name folded by fold_name, with the word "the" removed
+  """
+  return ' '.join(word for word in fold_name(name).split() if word != 'the')
+
+class VenueNameMatcher:
+  """
+  Compare venue names by the cosine similarity of their TF-IDF weighted character n-grams, after
+  normalize_venue_name, on a 0 to 100 scale. N-grams are hashed into a fixed number of columns, so
+  any name can be vectorized with the document frequencies of the names the matcher was built
+  with (with no names, every n-gram has the same weight)
+
+  best_matches compares many names with all of the matcher's names through one sparse matrix
+  product per chunk, which only touches pairs of names that share an n-gram, so it scales to tens
+  of thousands of venues
+
+  Keyword arguments:
+  names -- list of venue names to match against and to take document frequencies from (default
+  empty)
+  n -- length of the character n-grams (default 3)
+  n_features -- number of hashed n-gram columns (default 2**20)
+  """
+  def __init__(self, names=(), n=3, n_features=2**20):
+    self.n = n
+    self.n_features = n_features
+    self.names = list(names)
+    self.columns = {} # n-gram: hashed column, since hashing costs more than looking it up
+    self.idf = np.ones(n_features)
+    grams = [self.hashed_ngrams(name) for name in self.names]
+    if len(grams) > 0:
+      doc_freq = np.bincount(np.concatenate([np.unique(x) for x in grams] + \
+        [np.zeros(0, dtype=np.int64)]), minlength=n_features)
+      self.idf = np.log((1 + len(grams))/(1 + doc_freq)) + 1
+    self.matrix = self.vectorize_grams(grams)
+
+  def hashed_ngrams(self, name):
+    # Pad so that the start and end of each word make n-grams of their own
+    name = ' {} '.format(normalize_venue_name(name or ''))
+    columns = self.columns
+    out = []
+    for i in range(len(name) - self.n + 1):
+      gram = name[i:i + self.n]
+      column = columns.get(gram)
+      if column is None:
+        column = columns[gram] = zlib.crc32(gram.encode('utf-8')) % self.n_features
+      out.append(column)
+    return np.array(out, dtype=np.int64)
+
+  def vectorize(self, names):
+    """
+    Return sparse matrix with a row of L2-normalized TF-IDF weights for each name
+    """
+    return self.vectorize_grams([self.hashed_ngrams(name) for name in names])
+
+  def vectorize_grams(self, grams):
+    rows = np.repeat(np.arange(len(grams)), [len(x) for x in grams])
+    cols = np.concatenate(grams + [np.zeros(0, dtype=np.int64)])
+    vectors = scipy.sparse.csr_matrix((self.idf[cols], (rows, cols)), \
+      shape=(len(grams), self.n_features))
+    vectors.sum_duplicates() # also sorts each row's columns, which similarity relies on
+    row_of = np.repeat(np.arange(len(grams)), np.diff(vectors.indptr))
+    norms = np.sqrt(np.bincount(row_of, weights=vectors.data**2, minlength=len(grams)))
+    vectors.data /= np.where(norms > 0, norms, 1)[row_of]
+    return vectors
+
+  def similarity(self, name, other_names):
+    """
+    Return array of similarities (0 to 100) between name and each of other_names
+    """
+    if len(other_names) == 0:
+      return np.zeros(0)
+    query = self.vectorize([name])
+    others = self.vectorize(other_names)
+    if len(query.indices) == 0:
+      return np.zeros(len(other_names))
+    # Dot products row by row, looking each column up in the query's sorted columns; a sparse product
+    # would transpose a matrix with n_features columns on every call
+    position = np.minimum(np.searchsorted(query.indices, others.indices), len(query.indices) - 1)
+    products = np.where(query.indices[position] == others.indices, query.data[position]*others.data, 0)
+    row_of = np.repeat(np.arange(len(other_names)), np.diff(others.indptr))
+    return 100*np.bincount(row_of, weights=products, minlength=len(other_names))
+
+  def best_match(self, name, other_names, threshold=0):
+    """
+    Return (index, similarity) of the most similar of other_names to name, the first one in case of
+    ties, or (None, similarity) if that similarity isn't above threshold
+    """
+    scores = self.similarity(name, other_names)
+    if (len(scores) == 0) or (scores.max() <= threshold):
+      return None, (scores.max() if len(scores) > 0 else 0)
+    best = int(np.argmax(scores))
+    return best, scores[best]
+
+  def best_matches(self, query_names, threshold=0, chunk_size=1000):
+    """
+    Return arrays of the index of the most similar of the matcher's names to each of query_names
+    (-1 where no similarity is above threshold) and of those similarities
+
+    Keyword arguments:
+    query_names -- list of names to match
+    threshold -- minimum similarity (default 0)
+    chunk_size -- number of query names compared at once, to bound memory use (default 1000)
+    """
+    best = np.full(len(query_names), -1)
+    best_scores = np.zeros(len(query_names))
+    matrix_t = self.matrix.T.tocsr()
+    for start in range(0, len(query_names), chunk_size):
+      scores = (self.vectorize(query_names[start:start + chunk_size]) @ matrix_t).tocsr()
+      if scores.shape[1] == 0:
+        break
+      chunk_best = np.asarray(scores.argmax(axis=1)).ravel()
+      chunk_scores = 100*np.asarray(scores.max(axis=1).todense()).ravel()
+      found = chunk_scores > threshold
+      best[start:start + chunk_size][found] = chunk_best[found]
+      best_scores[start:start + chunk_size] = chunk_scores
+    return best, best_scores
+
+#####################
+
+class VenueLocator:
+  """
+  Spatial index of known venues, so that the venues near a point can be found locally instead of
+  through a Setlist.fm search. Venues are dictionaries as in venue_mapping.json, placed by
+  venue_position, and kept in a k-d tree on unit-sphere coordinates (where straight-line distance
+  grows with great-circle distance, so a ball query finds everything within a radius)
+
+  Venues added after the tree was built are checked with a vectorized scan until there are enough
+  of them to be worth rebuilding the tree. Names are compared with a VenueNameMatcher taking its
+  document frequencies from the venues' names when the tree was built. Matches made with claim=True
+  are recorded, so that neither venue is matched to anything else afterwards. Venues pulled later
+  can be added with add, or read from an event index with update_from_event_index
+
+  Keyword arguments:
+  venues -- list of venue dictionaries to start with (default empty)
+  """
+  def __init__(self, venues=()):
+    self.venues = [] # venues in the tree, then those added since
+    self.positions = [] # (latitude, longitude) of each venue
+    self.tree = None
+    self.tree_size = 0 # number of venues in the tree
+    self.keys = set() # (MBID, Setlist.fm ID) of every venue, to skip duplicates
+    self.claimed = set() # IDs of venues matched with claim=True
+    self.index_seeds = {} # (seed type, seed key): time of the pull, of event index seeds added
+    self.name_matcher = VenueNameMatcher()
+    self.lock = threading.Lock()
+    for venue in venues:
+      self.add(venue)
+    with self.lock:
+      self.rebuild()
+
+  def __len__(self):
+    return len(self.venues)
+
+  def add(self, venue):
+    """
+    Add venue dictionary, unless it has no coordinates or is already in the index
+    """
+    position = venue_position(venue)
+    key = (venue['id']['mbid'], venue['id']['slid'])
+    with self.lock:
+      if (position is None) or (key in self.keys):
+        return
+      self.keys.add(key)
+      self.venues.append(venue)
+      self.positions.append(position)
+
+  def update_from_event_index(self, filename, chunk_size=400):
+    """
+    Add the venues of the seeds recorded in an event index file (see event_index.py) since the last
+    call, including those recorded by other processes; seeds pulled again count as new. Return
+    number of venues added
+
+    Keyword arguments:
+    filename -- event index SQLite file
+    chunk_size -- number of seeds whose venues are read with one query (default 400)
+    """
+    conn = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
+    try:
+      seeds = conn.execute("SELECT seed_type, seed_key, pulled_at FROM seeds").fetchall()
+      changed = [(seed_type, seed_key) for seed_type, seed_key, pulled_at in seeds \
+        if self.index_seeds.get((seed_type, seed_key)) != pulled_at]
+      if len(changed) == len(seeds):
+        venues = event_index_venues(conn)
+      else:
+        venues = []
+        for start in range(0, len(changed), chunk_size):
+          venues += event_index_venues(conn, changed[start:start + chunk_size])
+    finally:
+      conn.close()
+    n_venues = len(self)
+    for venue in venues:
+      self.add(venue)
+    with self.lock:
+      self.index_seeds.update(((seed_type, seed_key), pulled_at) for seed_type, seed_key, pulled_at in seeds)
+      if self.tree_size == 0:
+        self.rebuild() # so that names are compared with the index's document frequencies
+    return len(self) - n_venues
+
+  def rebuild(self):
+    # Called with the lock held
+    if len(self.positions) > 0:
+      self.tree = scipy.spatial.cKDTree(unit_vectors(*zip(*self.positions)))
+      self.name_matcher = VenueNameMatcher([name for venue in self.venues \
+        for name in (venue['name']['mbname'], venue['name']['slname']) if name is not None])
+    self.tree_size = len(self.positions)
+
+  def refresh(self):
+    # Called with the lock held
+    if len(self.positions) - self.tree_size > max(1000, self.tree_size//10):
+      self.rebuild()
+
+  def chord(self, distance_threshold):
+    # Straight-line distance through the unit sphere for a great-circle distance
+    return 2*np.sin(min(distance_threshold/(2*EARTH_RADIUS), np.pi/2))
+
+  def within(self, lat, long, distance_threshold):
+    """
+    Return list of (distance in km, venue dictionary) pairs for the venues closer than
+    distance_threshold km to (lat, long), nearest first
+    """
+    with self.lock:
+      self.refresh()
+      found = []
+      if self.tree is not None:
+        found = self.tree.query_ball_point(unit_vectors([lat], [long])[0], self.chord(distance_threshold))
+      found = list(found) + list(range(self.tree_size, len(self.positions)))
+      if len(found) == 0:
+        return []
+      lats, longs = np.array([self.positions[i] for i in found]).T
+      distances = haversine(lat, long, lats, longs)
+      venues = [self.venues[i] for i in found]
+    keep = np.flatnonzero(distances < distance_threshold)
+    keep = keep[np.argsort(distances[keep], kind='stable')]
+    return [(float(distances[i]), venues[i]) for i in keep]
+
+  def unmapped(self, candidate, own_id, other_id, other_name):
+    # Whether candidate is a venue from the other source that can still be matched
+    return (candidate['id'][own_id] is None) and (candidate['id'][other_id] is not None) and \
+      (candidate['id'][other_id] not in self.claimed) and (candidate['name'][other_name] is not None)
+
+  def claim(self, venue, match):
+    """
+    Record that venue and match, venue dictionaries from each source, are the same venue, so that
+    neither is matched again. Return False if either was claimed already
+    """
+    own_id, other_id = match_fields(venue)[:2]
+    with self.lock:
+      if (venue['id'][own_id] in self.claimed) or (match['id'][other_id] in self.claimed):
+        return False
+      self.claimed.update((venue['id'][own_id], match['id'][other_id]))
+      return True
+
+  def match(self, venue, distance_threshold=25, match_threshold=MATCH_THRESHOLD, claim=False, exclude=None):
+    """
+    Return the venue dictionary from the other source (Setlist.fm for a MusicBrainz place and vice
+    versa) that isn't mapped or claimed yet, is closer than distance_threshold km and has the most
+    similar name (the nearest of those in case of ties), if that similarity is above
+    match_threshold; None otherwise
+
+    Keyword arguments:
+    venue -- venue dictionary with exactly one of its MBID and Setlist.fm ID set
+    distance_threshold -- maximum distance in km between the venues' positions (default 25)
+    match_threshold -- minimum name similarity from 0 to 100, see VenueNameMatcher (default
+    MATCH_THRESHOLD)
+    claim -- whether to claim the match for venue, see claim (default False)
+    exclude -- function of a venue dictionary returning True for venues not to match, e.g. those
+    mapped by another process (default None)
+    """
+    position = venue_position(venue)
+    if position is None:
+      return None
+    own_id, other_id, own_name, other_name = match_fields(venue)
+    while venue['id'][own_id] not in self.claimed:
+      candidates = [candidate for distance, candidate in \
+        self.within(position[0], position[1], distance_threshold) \
+        if self.unmapped(candidate, own_id, other_id, other_name) and not (exclude and exclude(candidate))]
+      best, similarity = self.name_matcher.best_match(venue['name'][own_name], \
+        [candidate['name'][other_name] for candidate in candidates], threshold=match_threshold)
+      if best is None:
+        return None
+      # Another thread may have claimed the same candidate since, then look again without it
+      if (not claim) or self.claim(venue, candidates[best]):
+        return candidates[best]
+    return None
+
+  def match_many(self, venues, distance_threshold=25, match_threshold=MATCH_THRESHOLD, chunk_size=1000, \
+    claim=False):
+    """
+    Same as calling match for each of venues, for matching tens of thousands of venues at once.
+    Instead of a spatial query per venue, the names are compared first, a chunk of venues at a time,
+    through one sparse product with the names of all unmapped venues from the other source (which
+    only touches pairs sharing an n-gram); the distances are then only worked out for the pairs with
+    similar enough names. Each venue from the other source is matched at most once, to the venue
+    with the most similar name. Return list of matches (None where there is none)
+
+    Keyword arguments:
+    venues -- list of venue dictionaries, each with exactly one of its MBID and Setlist.fm ID set
+    distance_threshold, match_threshold, claim -- see match
+    chunk_size -- number of venues compared at once, to bound memory use (default 1000)
+    """
+    with self.lock:
+      if self.tree_size < len(self.positions):
+        self.rebuild() # so that the name matcher knows every venue
+      name_matcher, candidates = self.name_matcher, list(self.venues)
+      positions = np.array(self.positions, dtype=float).reshape(-1, 2)
+    matches = [None]*len(venues)
+    taken = set() # indices of candidates matched so far
+    for own_id, other_id, own_name, other_name in (match_fields(dict(id=dict(slid=None))), \
+      match_fields(dict(id=dict(slid='')))):
+      queries = [i for i, venue in enumerate(venues) \
+        if (match_fields(venue)[0] == own_id) and (venue_position(venue) is not None)]
+      targets = np.array([j for j, candidate in enumerate(candidates) \
+        if self.unmapped(candidate, own_id, other_id, other_name)], dtype=np.int64)
+      if (len(queries) == 0) or (len(targets) == 0):
+        continue
+      target_vectors = name_matcher.vectorize([candidates[j]['name'][other_name] for j in targets]).T.tocsr()
+      query_positions = np.array([venue_position(venues[i]) for i in queries])
+      for start in range(0, len(queries), chunk_size):
+        chunk = queries[start:start + chunk_size]
+        scores = (name_matcher.vectorize([venues[i]['name'][own_name] for i in chunk]) @ target_vectors).tocoo()
+        similar = 100*scores.data > match_threshold
+        rows, cols, similarities = scores.row[similar] + start, scores.col[similar], 100*scores.data[similar]
+        target_positions = positions[targets[cols]]
+        distances = haversine(query_positions[rows, 0], query_positions[rows, 1], \
+          target_positions[:, 0], target_positions[:, 1])
+        near = distances < distance_threshold
+        rows, cols, similarities, distances = rows[near], cols[near], similarities[near], distances[near]
+        # Most similar pairs first, nearest first among ties, skipping venues matched already
+        for k in np.lexsort((distances, -similarities)):
+          venue, target = venues[queries[rows[k]]], targets[cols[k]]
+          if (matches[queries[rows[k]]] is None) and (target not in taken) and \
+            ((not claim) or self.claim(venue, candidates[target])):
+            matches[queries[rows[k]]] = candidates[target]
+            taken.add(target)
+    return matches
+
+def match_fields(venue):
+  """
+  Return names of the ID and name fields of venue dictionary's own source, then of the other source
+  """
+  if venue['id']['slid'] is None:
+    return 'mbid', 'slid', 'mbname', 'slname'
+  return 'slid', 'mbid', 'slname', 'mbname'
+
+def venues_from_event_index(filename):
+  """
+  Return list of venue dictionaries for the distinct venues in an event index file (see
+  event_index.py)
+  """
+  conn = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
+  try:
+    return event_index_venues(conn)
+  finally:
+    conn.close()
+
+def event_index_venues(conn, seeds=None):
+  """
+  Return list of venue dictionaries for the distinct venues in an event index connection, of the
+  events of seeds (list of (seed type, seed key) pairs) if given, else of all events
+  """
+  where = ''
+  if seeds is not None:
+    if len(seeds) == 0:
+      return []
+    where = 'WHERE (seed_type, seed_key) IN (VALUES {})'.format(', '.join(['(?, ?)']*len(seeds)))
+  rows = conn.execute("""SELECT venue_mbid, venue_slid, MAX(venue_mbname), MAX(venue_slname),
+    MAX(city_name), MAX(city_lat), MAX(city_long), MAX(venue_lat), MAX(venue_long) FROM events {}
+    GROUP BY venue_mbid, venue_slid""".format(where), [x for seed in seeds or () for x in seed]).fetchall()
+  return [dict(id=dict(mbid=row[0], slid=row[1]), name=dict(mbname=row[2], slname=row[3]), \
+    city=dict(name=row[4], coords=(row[5], row[6])), coords=(row[7], row[8])) for row in rows]